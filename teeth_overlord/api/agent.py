@@ -22,6 +22,7 @@ import cqlengine
 from teeth_rest import component
 from teeth_rest import responses
 
+from teeth_overlord.api import metrics
 from teeth_overlord import models
 from teeth_overlord import stats
 
@@ -72,6 +73,10 @@ class TeethAgentAPI(component.APIComponent):
         agent.ttl(models.Agent.TTL)
 
         chassis.agent_id = agent_id
+        # agents which restarted have lost their cache, so trust whatever
+        # they report, but leave older agents which don't report it alone
+        if 'cached_image_id' in data:
+            chassis.cached_image_id = data['cached_image_id']
 
         batch = cqlengine.BatchQuery()
         chassis.batch(batch).save()
@@ -91,3 +96,4 @@ class TeethAgentAPIServer(component.APIServer):
         super(TeethAgentAPIServer, self).__init__()
         self.config = config
         self.add_component('/v1', TeethAgentAPI(self.config))
+        self.add_component('/metrics', metrics.TeethMetricsAPI())
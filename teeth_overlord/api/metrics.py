@@ -0,0 +1,54 @@
+"""
+Copyright 2013 Rackspace, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+from teeth_rest import component
+from werkzeug import wrappers
+
+from teeth_overlord import stats
+
+
+# Content type of the Prometheus text exposition format
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+
+def render_metrics():
+    """Returns a response rendering the process's metrics registry."""
+    return wrappers.Response(stats.registry.render(),
+                             content_type=CONTENT_TYPE)
+
+
+class TeethMetricsAPI(component.APIComponent):
+
+    """Exposes the in-process metrics registry for scraping."""
+
+    def add_routes(self):
+        """Called during initialization. Override to map relative routes to
+        methods.
+        """
+        self.route('GET', '/', self.fetch_metrics)
+
+    def fetch_metrics(self, request):
+        """Renders every metric recorded by this process."""
+        return render_metrics()
+
+
+@wrappers.Request.application
+def metrics_app(request):
+    """A bare WSGI application serving the metrics registry, for processes
+    which don't otherwise serve an API.
+    """
+    return render_metrics()
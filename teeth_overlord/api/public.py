@@ -15,6 +15,7 @@ limitations under the License.
 """
 
 import base64
+import hashlib
 import re
 
 import cqlengine
@@ -22,13 +23,18 @@ import cqlengine
 from teeth_rest import component
 from teeth_rest import errors as rest_errors
 from teeth_rest import responses
+from werkzeug import http
+from werkzeug import wrappers
 
+from teeth_overlord.api import metrics
 from teeth_overlord import errors
 from teeth_overlord.images import base as images_base
 from teeth_overlord.jobs import base as jobs_base
 from teeth_overlord import models
 from teeth_overlord.networks import base as networks_base
 from teeth_overlord import stats
+from teeth_overlord import tracing
+from teeth_overlord import watch
 
 
 DEFAULT_LIMIT = 100
@@ -68,6 +74,16 @@ def _get_limit(request):
         raise errors.InvalidParametersError(msg)
 
 
+def _get_list_version(items, marker):
+    """Returns a version for a page of models, which changes whenever any
+    of the models or the next marker do.
+    """
+    digest = hashlib.sha1(repr(marker))
+    for item in items:
+        digest.update(item.get_version())
+    return digest.hexdigest()
+
+
 def _hostnameify(name):
     return re.sub(r'(?![A-Z0-9\-\.]).', '', name, flags=re.IGNORECASE)
 
@@ -131,6 +147,10 @@ class TeethPublicAPI(component.APIComponent):
             prefix='api')
         self.image_provider = images_base.get_image_provider(config)
         self.network_provider = networks_base.get_network_provider(config)
+        self.instance_hub = watch.ChangeHub(models.Instance,
+                                            config.WATCH_POLL_INTERVAL,
+                                            config.WATCH_MAX_WAITERS,
+                                            self.stats_client)
 
     def add_routes(self):
         """Called during initialization. Override to map relative routes to
@@ -214,30 +234,141 @@ class TeethPublicAPI(component.APIComponent):
         else:
             marker = None
 
-        return responses.PaginatedResponse(request,
-                                           items,
-                                           list_method,
-                                           marker,
-                                           limit)
+        return self._conditional(
+            request,
+            _get_list_version(items, marker),
+            lambda: responses.PaginatedResponse(request,
+                                                items,
+                                                list_method,
+                                                marker,
+                                                limit))
+
+    def _lookup_list(self, request, cls, list_method, lookup, **key):
+        """List the `cls` rows matching `key`, read from the `lookup` table
+        rather than filtering `cls` itself.
+        """
+        marker = _get_marker(request)
+        limit = _get_limit(request)
+        sources = lookup.__source_columns__
+        id_column = [column for column, source in sources.iteritems()
+                     if source == 'id'][0]
+        query = lookup.objects.filter(**key).limit(limit)
+
+        if marker:
+            query = query.filter(**{'{}__gt'.format(id_column): marker})
+
+        ids = [getattr(row, id_column) for row in query]
+
+        if ids:
+            found = dict((item.id, item)
+                         for item in cls.objects.filter(id__in=ids))
+        else:
+            found = {}
+
+        def _matches(item):
+            return all(getattr(item, sources[column]) == value
+                       for column, value in key.iteritems())
+
+        # skip rows which were deleted, or changed since they were looked up
+        items = [found[item_id] for item_id in ids
+                 if item_id in found and _matches(found[item_id])]
+
+        if len(ids) == limit:
+            marker = ids[-1]
+        else:
+            marker = None
+
+        return self._conditional(
+            request,
+            _get_list_version(items, marker),
+            lambda: responses.PaginatedResponse(request,
+                                                items,
+                                                list_method,
+                                                marker,
+                                                limit))
 
     def _crud_fetch(self, request, cls, query):
         try:
-            return responses.ItemResponse(query.get())
+            item = query.get()
+        except cls.DoesNotExist:
+            raise errors.RequestedObjectNotFoundError(cls, id)
+
+        return self._conditional(request,
+                                 item.get_version(),
+                                 lambda: responses.ItemResponse(item))
+
+    def _conditional(self, request, etag, make_response):
+        """Returns 304 Not Modified if the request's If-None-Match header
+        matches `etag`, otherwise the response built by `make_response`.
+        Either way the response carries `etag`, and `make_response` is only
+        called when the resource has to be serialized.
+        """
+        etags = http.parse_etags(request.headers.get('If-None-Match'))
+        if etags.contains_weak(etag):
+            return self._not_modified(etag)
+
+        response = make_response()
+        response.headers['ETag'] = http.quote_etag(etag)
+        return response
+
+    def _not_modified(self, etag):
+        self.stats_client.incr('not_modified')
+        return wrappers.Response(status=304,
+                                 headers={'ETag': http.quote_etag(etag)})
+
+    def _watch_fetch(self, request, cls, query, hub, version):
+        """Like _crud_fetch, but if the item's version is still `version`,
+        wait for it to change. Returns 304 Not Modified if it doesn't
+        change before WATCH_TIMEOUT.
+        """
+        try:
+            item = query.get()
         except cls.DoesNotExist:
             raise errors.RequestedObjectNotFoundError(cls, id)
 
+        if item.get_version() == version:
+            item = hub.wait(item.id, version, self.config.WATCH_TIMEOUT)
+            if item is None:
+                return self._not_modified(version)
+
+        return self._conditional(request,
+                                 item.get_version(),
+                                 lambda: responses.ItemResponse(item))
+
+    def _provider_list(self, request, list_items, list_method,
+                       does_not_exist):
+        """List a page of items from a provider, which reads `marker` and
+        `limit` itself rather than us fetching every item.
+        """
+        marker = _get_marker(request)
+        limit = _get_limit(request)
+
+        try:
+            items = list_items(marker=marker, limit=limit)
+        except does_not_exist:
+            raise errors.InvalidParametersError(
+                'The provided \'marker\' query parameter was not found.')
+
+        if len(items) == limit:
+            marker = items[-1].id
+        else:
+            marker = None
+
+        return responses.PaginatedResponse(request,
+                                           [i.serialize() for i in items],
+                                           list_method,
+                                           marker,
+                                           limit)
+
     @stats.incr_stat('networks.list')
     def list_networks(self, request):
         """List Networks.
         Returns 200 along with a list of Networks upon success.
         """
-        networks = self.network_provider.list_networks()
-        networks = [n.serialize() for n in networks]
-        return responses.PaginatedResponse(request,
-                                           networks,
-                                           self.list_networks,
-                                           None,
-                                           DEFAULT_LIMIT)
+        return self._provider_list(request,
+                                   self.network_provider.list_networks,
+                                   self.list_networks,
+                                   self.network_provider.NetworkDoesNotExist)
 
     @stats.incr_stat('networks.fetch')
     def fetch_network(self, request, network_id):
@@ -256,12 +387,10 @@ class TeethPublicAPI(component.APIComponent):
         """List Images.
         Returns 200 along with a list of Images upon success.
         """
-        images = [i.serialize() for i in self.image_provider.list_images()]
-        return responses.PaginatedResponse(request,
-                                           images,
-                                           self.list_images,
-                                           None,
-                                           DEFAULT_LIMIT)
+        return self._provider_list(request,
+                                   self.image_provider.list_images,
+                                   self.list_images,
+                                   self.image_provider.ImageDoesNotExist)
 
     @stats.incr_stat('images.fetch')
     def fetch_image(self, request, image_id):
@@ -644,8 +773,33 @@ class TeethPublicAPI(component.APIComponent):
                 ]
             }
 
+        The list may be filtered by `state`, or by `state` and
+        `chassis_model_id` together, e.g. ``?state=READY``.
+
         Returns 200 with a list of Chassis upon success.
         """
+        state = _get_single_param(request, 'state')
+        chassis_model_id = _get_single_param(request, 'chassis_model_id')
+
+        if chassis_model_id is not None:
+            if state is None:
+                raise errors.InvalidParametersError(
+                    'The \'chassis_model_id\' query parameter requires the '
+                    '\'state\' query parameter.')
+            return self._lookup_list(request,
+                                     models.Chassis,
+                                     self.list_chassis,
+                                     models.ChassisByStateAndModel,
+                                     state=state,
+                                     chassis_model_id=chassis_model_id)
+
+        if state is not None:
+            return self._lookup_list(request,
+                                     models.Chassis,
+                                     self.list_chassis,
+                                     models.ChassisByState,
+                                     state=state)
+
         return self._crud_list(request, models.Chassis, self.list_chassis)
 
     @stats.incr_stat('chassis.fetch')
@@ -714,6 +868,7 @@ class TeethPublicAPI(component.APIComponent):
 
         Returns 201 with a Location header upon success.
         """
+        trace = tracing.Trace('instances.create', self.stats_client)
         params = self.parse_content(request)
 
         # ask the network provider for default networks if we aren't
@@ -760,12 +915,15 @@ class TeethPublicAPI(component.APIComponent):
 
         # validate flavor
         self._validate_relation(instance, 'flavor_id', models.Flavor)
+        trace.record('validate', trace.started_at)
 
-        instance.save()
-        self.job_client.submit_job('instances.create',
-                                   instance_id=instance.id,
-                                   metadata=metadata,
-                                   files=files)
+        with trace.span('submit'):
+            instance.save()
+            self.job_client.submit_job('instances.create',
+                                       instance_id=instance.id,
+                                       metadata=metadata,
+                                       files=files,
+                                       trace=trace.serialize())
 
         return responses.CreatedResponse(request, self.fetch_instance, {
             'instance_id': instance.id,
@@ -795,11 +953,21 @@ class TeethPublicAPI(component.APIComponent):
                 "links": []
             }
 
+        The list may be filtered by `state`, e.g. ``?state=ACTIVE``.
+
         Returns 200 with a list of Instances upon success.
         """
+        state = _get_single_param(request, 'state')
+
+        if state is not None:
+            return self._lookup_list(request,
+                                     models.Instance,
+                                     self.list_instances,
+                                     models.InstanceByState,
+                                     state=state)
+
         return self._crud_list(request, models.Instance, self.list_instances)
 
-    @stats.incr_stat('instances.fetch')
     def fetch_instance(self, request, instance_id):
         """Retrieve an instance. Example::
 
@@ -811,10 +979,28 @@ class TeethPublicAPI(component.APIComponent):
                 "state": "ACTIVE"
             }
 
+        Clients waiting for an instance to change should pass the ETag of
+        the version they have as ``?wait_for_change=<version>``. The request
+        then returns as soon as the instance differs from that version, or
+        with 304 if it hasn't changed after a while.
+
         Returns 200 with the requested Instance upon success.
         """
         query = models.Instance.objects.filter(id=instance_id)
-        return self._crud_fetch(request, models.Instance, query)
+        version = _get_single_param(request, 'wait_for_change')
+
+        if version is not None:
+            # held polls are timed apart, so they don't skew fetch latency
+            version, weak = http.unquote_etag(version)
+            with stats.timed_stat(self.stats_client, 'instances.watch'):
+                return self._watch_fetch(request,
+                                         models.Instance,
+                                         query,
+                                         self.instance_hub,
+                                         version)
+
+        with stats.timed_stat(self.stats_client, 'instances.fetch'):
+            return self._crud_fetch(request, models.Instance, query)
 
     @stats.incr_stat('instances.request_delete')
     def delete_instance(self, request, instance_id):
@@ -853,3 +1039,4 @@ class TeethPublicAPIServer(component.APIServer):
         self.config = config
         self.add_component('/v1',
                            TeethPublicAPI(self.config, job_client=job_client))
+        self.add_component('/metrics', metrics.TeethMetricsAPI())
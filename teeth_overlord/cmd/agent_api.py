@@ -18,12 +18,14 @@ from cherrypy import wsgiserver
 
 from teeth_overlord.api import agent
 from teeth_overlord import config as teeth_config
+from teeth_overlord import profiler
 from teeth_overlord import service
 
 
 def run():
     config = teeth_config.get_config()
     service.global_setup(config)
+    profiler.install(profiler.get_profiler(config, 'agent_api'), config)
     api = agent.TeethAgentAPIServer(config)
     listen_address = (config.AGENT_API_HOST, config.AGENT_API_PORT)
     server = wsgiserver.CherryPyWSGIServer(listen_address, api)
@@ -18,15 +18,21 @@ from cherrypy import wsgiserver
 
 from teeth_overlord.api import public
 from teeth_overlord import config as teeth_config
+from teeth_overlord import profiler
 from teeth_overlord import service
 
 
 def run():
     config = teeth_config.get_config()
     service.global_setup(config)
+    profiler.install(profiler.get_profiler(config, 'public_api'), config)
     api = public.TeethPublicAPIServer(config)
     listen_address = (config.PUBLIC_API_HOST, config.PUBLIC_API_PORT)
-    server = wsgiserver.CherryPyWSGIServer(listen_address, api)
+    # requests waiting for changes each hold a thread
+    server = wsgiserver.CherryPyWSGIServer(
+        listen_address,
+        api,
+        numthreads=config.PUBLIC_API_THREADS)
     try:  # ^C doesn't work without this try/except
         server.start()
     except KeyboardInterrupt:
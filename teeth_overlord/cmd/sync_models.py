@@ -14,6 +14,7 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import cqlengine
 from cqlengine import management
 
 from teeth_overlord import config as teeth_config
@@ -21,7 +22,31 @@ from teeth_overlord import models
 from teeth_overlord import service
 
 
+# Rows read at a time while filling lookup tables.
+PAGE_SIZE = 1000
+
+
+def _fill_lookups(model):
+    """Add every row of `model` to its lookup tables, e.g. rows saved
+    before the lookup tables existed.
+    """
+    rows = list(model.objects.all().limit(PAGE_SIZE))
+    while rows:
+        for row in rows:
+            for lookup in model.__lookups__:
+                key = lookup.get_key(row)
+                if None not in key.values():
+                    lookup(**key).save()
+        marker = cqlengine.Token(rows[-1].pk)
+        rows = list(model.objects.filter(pk__token__gt=marker)
+                                 .limit(PAGE_SIZE))
+
+
 def run():
     service.global_setup(teeth_config.get_config())
     for model in models.all_models:
         management.sync_table(model)
+
+    for model in models.all_models:
+        if model.__lookups__:
+            _fill_lookups(model)
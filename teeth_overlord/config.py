@@ -147,6 +147,21 @@ class BoolConfigValue(ConfigValue):
         raise ValueError("'{}' must be one of {}.".format(value, keys))
 
 
+class DictConfigValue(ConfigValue):
+    """Dict configuration value."""
+
+    @classmethod
+    def parse(cls, value):
+        if isinstance(value, basestring):
+            value = json.loads(value)
+
+        if isinstance(value, dict):
+            return value
+
+        raise ValueError("'{}' must be a JSON object string or dict."
+                         .format(value))
+
+
 class Config(object):
     """This class exists to give some type safety to a configuration
     instance and allow some magic coersion of values that come from
@@ -162,6 +177,7 @@ class Config(object):
     _type_map = collections.OrderedDict([
         (bool, BoolConfigValue),
         (list, ListConfigValue),
+        (dict, DictConfigValue),
         (int, IntConfigValue),
         (float, FloatConfigValue),
         (str, StrConfigValue),
@@ -135,3 +135,13 @@ class MultipleChassisFound(errors.RESTError):
     def __init__(self, hardware):
         self.details = 'Multiple chassis with hardware {} were found.'
         self.details = self.details.format(hardware)
+
+
+class TooManyWatchersError(errors.RESTError):
+    """Error which is raised when a request asks to wait for a change, but
+    too many requests are already waiting.
+    """
+    message = 'Too many watchers'
+    status_code = 503
+    details = ('Too many requests are waiting for changes. Please try back '
+               'later.')
@@ -60,8 +60,11 @@ class BaseImageProvider(object):
         """
 
     @abc.abstractmethod
-    def list_images(self):
-        """Returns an list of ImageInfo instances."""
+    def list_images(self, marker=None, limit=None):
+        """Returns a list of up to `limit` ImageInfo instances, following
+        the image with id `marker`. Raises ImageDoesNotExist if there is
+        no such image.
+        """
 
 
 def get_image_provider(config):
@@ -15,6 +15,7 @@ limitations under the License.
 """
 
 from teeth_overlord.images import base
+from teeth_overlord import util
 
 FAKE_IMAGE_INFO = {
     'name': 'Default Example Image',
@@ -31,9 +32,14 @@ FAKE_IMAGE_INFO = {
 class FakeImageProvider(base.BaseImageProvider):
     """A static image provider useful in a dev environment."""
 
-    def list_images(self):
+    def list_images(self, marker=None, limit=None):
         """Returns an list of ImageInfo instances."""
-        return [self.get_image_info('image_id')]
+        images = [self.get_image_info(FAKE_IMAGE_INFO['id'])]
+        try:
+            return util.get_page(images, marker, limit)
+        except ValueError:
+            raise self.ImageDoesNotExist(
+                'Image with id {} does not exist'.format(marker))
 
     def get_image_info(self, image_id):
         """Returns an ImageInfo instance with information about the
@@ -17,15 +17,147 @@ import glanceclient
 from glanceclient import exc as glance_exceptions
 
 from keystoneclient.apiclient import exceptions as keystone_exceptions
-from keystoneclient.v2_0 import client as keystone_client
 
+import functools
 import hashlib
 import hmac
+import itertools
+import threading
+
+import structlog
 
 from teeth_overlord.images import base
+from teeth_overlord import keystone
+from teeth_overlord import util
 
 import time
 
+# Glance statuses of images which are gone, or going
+DELETED_STATUSES = ('deleted', 'pending_delete', 'killed')
+
+
+class LazyImageInfo(base.ImageInfo):
+    """ImageInfo which only builds its URLs, by calling `get_urls()`, when
+    they are first used. Signing Swift temp URLs isn't free, and many
+    callers only want to know that an image exists.
+    """
+    def __init__(self, get_urls, **kwargs):
+        self._get_urls = get_urls
+        self._urls = None
+        super(LazyImageInfo, self).__init__(urls=None, **kwargs)
+
+    @property
+    def urls(self):
+        if self._urls is None:
+            self._urls = self._get_urls()
+        return self._urls
+
+    @urls.setter
+    def urls(self, urls):
+        self._urls = urls
+
+
+class ImageCatalog(object):
+    """In-memory copy of the raw Glance images, loaded in full by the first
+    call to `list()` and then kept up to date by a background thread.
+
+    Every `refresh_interval` seconds the thread fetches only the images
+    changed since the newest one it has seen, using `list_images(since)`.
+    Images which are deleted, or being deleted, are dropped from the
+    catalog when a listing reports them. Glance leaves most deleted images
+    out of listings entirely, so every `full_refresh_interval` seconds it
+    lists everything instead.
+    """
+    def __init__(self, list_images, refresh_interval, full_refresh_interval):
+        self.list_images = list_images
+        self.refresh_interval = refresh_interval
+        self.full_refresh_interval = full_refresh_interval
+        # images by id, None until loaded. Replaced rather than modified, so
+        # readers need no locking.
+        self.images = None
+        # the same images, most recently created first, and the position of
+        # each id in that list
+        self.ordered = []
+        self.positions = {}
+        self.updated_at = None
+        self.full_refreshed_at = None
+        self.lock = threading.Lock()
+        self.thread = None
+        self.log = structlog.get_logger()
+
+    def get(self, image_id):
+        """Returns the image with `image_id`, or None if it isn't in the
+        catalog (or the catalog hasn't been loaded).
+        """
+        images = self.images
+        if images is None:
+            return None
+        return images.get(image_id)
+
+    def list(self, marker=None, limit=None):
+        """Returns up to `limit` images, most recently created first,
+        following the image with id `marker`. Raises KeyError if there is
+        no such image.
+        """
+        if self.images is None:
+            with self.lock:
+                if self.images is None:
+                    self.refresh(full=True)
+                    self._start_thread()
+
+        ordered, positions = self.ordered, self.positions
+        start = 0
+        if marker is not None:
+            start = positions[marker] + 1
+
+        if limit is None:
+            return ordered[start:]
+        return ordered[start:start + limit]
+
+    def refresh(self, full=False):
+        """Update the catalog with changed images, or replace it with a
+        full listing if `full` is True.
+        """
+        if full or self.images is None:
+            started_at = time.time()
+            listed = self.list_images()
+            images = {}
+            self.full_refreshed_at = started_at
+        else:
+            listed = self.list_images(self.updated_at)
+            images = dict(self.images)
+
+        # deleted images still move updated_at on, or they'd be listed again
+        updated_at = [self.updated_at] if self.images is not None else []
+        for image in listed:
+            updated_at.append(image.get('updated_at'))
+            if image.get('status') in DELETED_STATUSES:
+                images.pop(image['id'], None)
+            else:
+                images[image['id']] = image
+
+        ordered = sorted(images.values(),
+                         key=lambda i: (i.get('created_at'), i['id']),
+                         reverse=True)
+        self.updated_at = max(updated_at) if updated_at else None
+        self.images = images
+        self.ordered, self.positions = ordered, dict(
+            (image['id'], i) for i, image in enumerate(ordered))
+
+    def _start_thread(self):
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.refresh_interval)
+            since_full = time.time() - self.full_refreshed_at
+            try:
+                self.refresh(full=since_full >= self.full_refresh_interval)
+            except Exception as e:
+                self.log.error('error refreshing image catalog', exception=e)
+
 
 class GlanceImageProvider(base.BaseImageProvider):
     """A static image provider useful in a dev environment."""
@@ -36,21 +168,31 @@ class GlanceImageProvider(base.BaseImageProvider):
         self.backend_map = {}
         self.backend_map['swift'] = self._get_swift_temp_urls
         self.backend_map['glance'] = self._get_glance_urls
+        # raw Glance images, so that temp URLs are still signed per call
+        self.image_cache = util.TTLCache(config.PROVIDER_CACHE_TTL,
+                                         config.PROVIDER_CACHE_NEGATIVE_TTL,
+                                         config.PROVIDER_CACHE_SIZE)
+        self.client_pool = util.ClientPool(
+            self._get_glance_client,
+            config.JOB_EXECUTION_THREADS,
+            expected_errors=(glance_exceptions.HTTPNotFound,
+                             glance_exceptions.HTTPBadRequest))
+        self.catalog = None
+        if config.GLANCE_CATALOG_REFRESH_INTERVAL:
+            self.catalog = ImageCatalog(
+                self._list_images,
+                config.GLANCE_CATALOG_REFRESH_INTERVAL,
+                config.GLANCE_CATALOG_FULL_REFRESH_INTERVAL)
 
     def _get_auth_token(self):
         try:
-            auth = keystone_client.Client(
-                username=self.config.KEYSTONE_USER,
-                password=self.config.KEYSTONE_PASS,
-                tenant_id=self.config.KEYSTONE_TENANT_ID,
-                auth_url=self.config.KEYSTONE_AUTH_URL)
-            return auth.auth_token
+            return keystone.get_auth_token(self.config)
         except keystone_exceptions.ClientException as e:
             raise self.ImageProviderException(
                 'Cannot Initialize Keystone Client: {}'.format(str(e)))
 
-    def _get_glance_client(self):
-        auth_token = self._get_auth_token()
+    def _get_glance_client(self, token=None):
+        auth_token = token or self._get_auth_token()
         try:
             return glanceclient.Client(self.config.GLANCE_VERSION,
                                        endpoint=self.config.GLANCE_URL,
@@ -59,6 +201,25 @@ class GlanceImageProvider(base.BaseImageProvider):
             raise self.ImageProviderException(
                 'Cannot Initialize Glance Client: {}'.format(str(e)))
 
+    def _glance_client(self):
+        """Context manager checking out a pooled Glance client."""
+        return self.client_pool.get(self._get_auth_token())
+
+    def _call_glance(self, func):
+        """Returns `func` called with a pooled Glance client. If Glance
+        rejects the client's token, the token is invalidated and the call
+        is retried once with a new one.
+        """
+        token = self._get_auth_token()
+        try:
+            with self.client_pool.get(token) as glance:
+                return func(glance)
+        except glance_exceptions.HTTPUnauthorized:
+            keystone.invalidate_auth_token(self.config, token)
+
+        with self._glance_client() as glance:
+            return func(glance)
+
     def _get_swift_temp_urls(self, url):
         try:
             key = self.config.SWIFT_TEMP_URL_KEY.encode('ascii', 'ignore')
@@ -110,17 +271,16 @@ class GlanceImageProvider(base.BaseImageProvider):
                 self.backend_map.keys()
             ))
 
-        urls = self.backend_map[glance_backend](image)
-        return base.ImageInfo(id=image['id'],
-                              name=image['name'],
-                              urls=urls,
-                              hashes=self._get_hashes(image))
-
-    def get_image_info(self, image_id):
-        glance = self._get_glance_client()
+        get_urls = functools.partial(self.backend_map[glance_backend], image)
+        return LazyImageInfo(get_urls,
+                             id=image['id'],
+                             name=image['name'],
+                             hashes=self._get_hashes(image))
 
+    def _get_image(self, image_id):
         try:
-            image = glance.images.get(image_id)
+            return self._call_glance(
+                lambda glance: glance.images.get(image_id))
         except glance_exceptions.HTTPNotFound as e:
             raise self.ImageDoesNotExist(
                 'Image with id {} does not exist'.format(image_id))
@@ -128,16 +288,71 @@ class GlanceImageProvider(base.BaseImageProvider):
             raise self.ImageProviderException(
                 'Cannot Get Image From Glance: {}'.format(str(e)))
 
-        image_info = self._make_image_info(image)
-        return image_info
+    def _list_images(self, since=None):
+        """List raw Glance images, or if `since` is given, at least those
+        updated since then.
+        """
+        def _list(glance):
+            if since is None:
+                return [i for i in glance.images.list()]
+
+            # the v2 API can't filter on changes-since, but the listing is
+            # paged lazily, so stop paging at the first older image
+            filters = {'sort_key': 'updated_at', 'sort_dir': 'desc'}
+            images = []
+            for image in glance.images.list(filters=filters):
+                if image.get('updated_at') < since:
+                    break
+                images.append(image)
+            return images
+
+        try:
+            return self._call_glance(_list)
+        except glance_exceptions.BaseException as e:
+            raise self.ImageProviderException(
+                'Cannot List Images From Glance: {}'.format(str(e)))
 
-    def list_images(self):
-        glance = self._get_glance_client()
+    def _get_images_page(self, marker, limit):
+        """List up to `limit` raw Glance images following `marker`."""
+        kwargs = {'filters': {}}
+        if marker is not None:
+            kwargs['filters']['marker'] = marker
+        if limit is not None:
+            kwargs['page_size'] = limit
 
         try:
-            images = [i for i in glance.images.list()]
+            return self._call_glance(
+                lambda glance: list(itertools.islice(
+                    glance.images.list(**kwargs), limit)))
+        except glance_exceptions.HTTPBadRequest as e:
+            if marker is None:
+                raise self.ImageProviderException(
+                    'Cannot List Images From Glance: {}'.format(str(e)))
+            raise self.ImageDoesNotExist(
+                'Image with id {} does not exist'.format(marker))
         except glance_exceptions.BaseException as e:
             raise self.ImageProviderException(
                 'Cannot List Images From Glance: {}'.format(str(e)))
 
+    def get_image_info(self, image_id):
+        # callers use this to check that an image still exists, which the
+        # catalog can't say until its next full refresh, so ask Glance
+        image = self.image_cache.get_or_load(
+            image_id,
+            lambda: self._get_image(image_id),
+            missing=self.ImageDoesNotExist)
+
+        image_info = self._make_image_info(image)
+        return image_info
+
+    def list_images(self, marker=None, limit=None):
+        if self.catalog is None:
+            images = self._get_images_page(marker, limit)
+        else:
+            try:
+                images = self.catalog.list(marker, limit)
+            except KeyError:
+                raise self.ImageDoesNotExist(
+                    'Image with id {} does not exist'.format(marker))
+
         return [self._make_image_info(i) for i in images]
@@ -19,10 +19,12 @@ import signal
 import threading
 import uuid
 
+from cherrypy import wsgiserver
 from stevedore import driver
 import structlog
 
 from teeth_overlord import agent_client
+from teeth_overlord.api import metrics
 from teeth_overlord.images import base as images_base
 from teeth_overlord import locks
 from teeth_overlord import marconi
@@ -56,6 +58,10 @@ MAX_RETRY_DELAY = 3600
 BACKOFF_FACTOR = 1.5
 JITTER = .2
 
+# If a job can't lock the assets it operates on, put it back on the queue and
+# try again shortly instead of tying up an executor thread waiting.
+LOCKED_RETRY_DELAY = 10
+
 # Failing to process a job should return it to the queue with as long a grace
 # period as we can manage.
 CLAIM_GRACE = 60 * 60 * 12
@@ -64,6 +70,10 @@ CLAIM_GRACE = 60 * 60 * 12
 BASE_POLLING_INTERVAL = 0.1
 MAX_POLLING_INTERVAL = 30
 
+# Job run every IMAGE_PRECACHE_INTERVAL seconds by each executor. The job
+# skips itself if another executor's is already running.
+PRECACHE_JOB_TYPE = 'images.precache'
+
 
 class JobExecutor(service.SynchronousTeethService):
 
@@ -80,14 +90,28 @@ class JobExecutor(service.SynchronousTeethService):
         self.image_provider = images_base.get_image_provider(config)
         self.oob_provider = oob_base.get_oob_provider(config)
         self.network_provider = networks_base.get_network_provider(config)
-        self.scheduler = scheduler.TeethInstanceScheduler()
+        self.scheduler = scheduler.TeethInstanceScheduler(config)
         self.claim_lock = threading.Lock()
         self.queue = marconi.MarconiClient(base_url=config.MARCONI_URL)
         self.stats_client = stats.get_stats_client(config, 'jobs')
         self.concurrent_jobs_gauge = stats.ConcurrencyGauge(self.stats_client,
                                                             'concurrent_jobs')
+        self.metrics_server = None
         self._job_type_cache = {}
 
+    def _start_metrics_server(self):
+        """Serve the metrics registry over HTTP, since the executor has no
+        API of its own to expose it on.
+        """
+        listen_address = (self.config.JOB_EXECUTOR_METRICS_HOST,
+                          self.config.JOB_EXECUTOR_METRICS_PORT)
+        self.metrics_server = wsgiserver.CherryPyWSGIServer(
+            listen_address,
+            metrics.metrics_app)
+        thread = threading.Thread(target=self.metrics_server.start)
+        thread.daemon = True
+        thread.start()
+
     def _get_job_class(self, job_type):
         if job_type not in self._job_type_cache:
             self._job_type_cache[job_type] = driver.DriverManager(
@@ -141,20 +165,50 @@ class JobExecutor(service.SynchronousTeethService):
         while not self.stopping.isSet():
             self._process_next_message()
 
+    def _precache_images(self):
+        """Run the image precache job every IMAGE_PRECACHE_INTERVAL seconds.
+        It is run directly rather than submitted, as every executor runs it
+        and all but one skip themselves, and those runs shouldn't leave
+        JobRequests behind.
+        """
+        job_class = self._get_job_class(PRECACHE_JOB_TYPE)
+        while not self.stopping.wait(self.config.IMAGE_PRECACHE_INTERVAL):
+            job_request = models.JobRequest(job_type=PRECACHE_JOB_TYPE,
+                                            params={})
+            job = job_class(self, job_request, None, self.config)
+            try:
+                with stats.timed_stat(self.stats_client, PRECACHE_JOB_TYPE):
+                    job.precache()
+            except Exception as e:
+                self.log.error('error precaching images', exception=e)
+
     def run(self):
         """Start processing jobs."""
         super(JobExecutor, self).run()
+        if self.config.JOB_EXECUTOR_METRICS_PORT:
+            self._start_metrics_server()
+
         threads = [threading.Thread(target=self._process_messages)
                    for i in xrange(0, self.config.JOB_EXECUTION_THREADS)]
 
+        if self.config.IMAGE_PRECACHE_INTERVAL:
+            precache_thread = threading.Thread(target=self._precache_images)
+            precache_thread.daemon = True
+            precache_thread.start()
+
         for thread in threads:
             thread.start()
 
-        signal.pause()
+        # other signals, such as the profiler's, also interrupt pause()
+        while not self.stopping.isSet():
+            signal.pause()
 
         for thread in threads:
             thread.join()
 
+        if self.metrics_server:
+            self.metrics_server.stop()
+
 
 class JobClient(object):
 
@@ -202,11 +256,18 @@ class Job(object):
         raise NotImplementedError()
 
     def _save_request(self):
+        """Save the request and mark its assets. Returns False if the assets
+        were locked and couldn't be marked.
+        """
         try:
             self.request.save()
             self._mark_assets()
+        except locks.LockNotAcquired:
+            self.log.info('job request assets are locked, not marked')
+            return False
         except Exception as e:
             self.log.error('error saving JobRequest, ignoring', exception=e)
+        return True
 
     def _update_claim(self, ttl=CLAIM_TTL):
         try:
@@ -221,15 +282,43 @@ class Job(object):
         except Exception as e:
             self.log.error('error deleting message, ignoring', exception=e)
 
+    def _requeue_request(self):
+        """Return the job to the queue without counting it as a failed
+        attempt.
+        """
+        self.log.info('job request assets are locked, requeueing',
+                      retry_delay=LOCKED_RETRY_DELAY)
+        self.request.state = models.JobRequestState.READY
+        self.request.touch()
+        try:
+            self.request.save()
+        except Exception as e:
+            self.log.error('error saving JobRequest, ignoring', exception=e)
+        self._update_claim(ttl=LOCKED_RETRY_DELAY)
+
+    def _finish_request(self):
+        """Save a request which has completed or failed and delete its
+        message. If the request's assets couldn't be marked, leave the
+        message on the queue instead, so that `execute` can mark them when
+        it comes back.
+        """
+        if self._save_request():
+            self._delete_message()
+        else:
+            self.log.info('job request finished, retrying marking assets',
+                          retry_delay=LOCKED_RETRY_DELAY)
+            self._update_claim(ttl=LOCKED_RETRY_DELAY)
+
     def _reset_request(self):
         self.request.reset()
         if self.request.failed_attempts >= self.max_retries:
             self.log.info('job request exceeded retry limit',
                           max_retries=self.max_retries)
             self.request.fail()
-            self._save_request()
-            self._delete_message()
+            self._finish_request()
         else:
+            # if the assets are locked they keep the RUNNING state until
+            # the next attempt marks them again
             self._save_request()
             self._update_claim(ttl=INITIAL_RETRY_DELAY)
 
@@ -246,7 +335,8 @@ class Job(object):
                                   models.JobRequestState.COMPLETED):
             self.log.info('job request no longer valid, not executing',
                           state=self.request.state)
-            self._delete_message()
+            # the request may have finished without marking its assets
+            self._finish_request()
             return
 
         if self.request.state == models.JobRequestState.RUNNING:
@@ -257,15 +347,22 @@ class Job(object):
 
         self.log.info('executing job request')
         self.request.start()
-        self._save_request()
+        try:
+            self.request.save()
+            self._mark_assets()
+        except locks.LockNotAcquired:
+            self._requeue_request()
+            return
+        except Exception as e:
+            self.log.error('error saving JobRequest, ignoring', exception=e)
 
         try:
-            self._execute()
+            with stats.timed_stat(self.stats_client, self.request.job_type):
+                self._execute()
         except Exception as e:
             self.log.error('error executing job', exception=e)
             self._reset_request()
         else:
             self.log.info('successfully executed job request')
             self.request.complete()
-            self._save_request()
-            self._delete_message()
+            self._finish_request()
@@ -16,7 +16,6 @@ limitations under the License.
 
 from teeth_overlord.jobs import base
 from teeth_overlord import models
-from teeth_overlord import stats
 
 
 class DecommissionChassis(base.Job):
@@ -26,7 +25,6 @@ class DecommissionChassis(base.Job):
     """
     max_retries = 10
 
-    @stats.incr_stat('chassis.decommission')
     def _execute(self):
         params = self.request.params
         chassis = models.Chassis.objects.get(id=params['chassis_id'])
@@ -41,11 +39,11 @@ class DecommissionChassis(base.Job):
 
         # move to decom network
         macs = chassis.get_mac_addresses()
-        for mac in macs:
-            self.executor.network_provider.detach(mac)
-            self.executor.network_provider.attach(
-                mac,
-                self.executor.network_provider.get_service_network())
+        network_provider = self.executor.network_provider
+        network_provider.detach_many(macs)
+        network_provider.attach_many(
+            macs,
+            [network_provider.get_service_network()])
 
         self.executor.oob_provider.power_chassis_on(chassis)
 
@@ -63,5 +61,7 @@ class DecommissionChassis(base.Job):
         chassis.state = models.ChassisState.READY
         # Dissassociate any instances after clean completes.
         chassis.instance_id = None
+        # the agent's image cache doesn't survive the chassis being used
+        chassis.cached_image_id = None
         chassis.save()
         return
@@ -0,0 +1,211 @@
+"""
+Copyright 2013 Rackspace, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+import collections
+
+from teeth_overlord import errors
+from teeth_overlord.jobs import base
+from teeth_overlord import locks
+from teeth_overlord import models
+
+
+# Only one executor at a time spreads images across the chassis.
+PRECACHE_LOCK_KEY = '/jobs/images.precache'
+
+# A chassis which is locked is most likely being reserved, so don't wait
+# long before giving up on recording what its agent cached.
+CHASSIS_LOCK_TIMEOUT = 1
+
+
+def plan_precache(popular, chassis_list):
+    """Decide which of `chassis_list` should cache which images, so that
+    the images in `popular`, a list of (image_id, builds) pairs, are held
+    by shares of the chassis in proportion to their builds. Chassis already
+    holding one of the images are left alone, up to its share.
+
+    Returns a list of (chassis, image_id) pairs to cache.
+    """
+    total = sum(builds for image_id, builds in popular)
+    if not total or not chassis_list:
+        return []
+
+    shares = dict((image_id, len(chassis_list) * builds // total)
+                  for image_id, builds in popular)
+    # hand out the chassis left over to the images with the largest
+    # remainders, then the most popular
+    leftover = len(chassis_list) - sum(shares.itervalues())
+    by_remainder = sorted(
+        popular,
+        key=lambda item: (-(len(chassis_list) * item[1] % total), -item[1]))
+    for image_id, builds in by_remainder[:leftover]:
+        shares[image_id] += 1
+
+    held = collections.defaultdict(int)
+    spare = []
+    for chassis in chassis_list:
+        image_id = chassis.cached_image_id
+        if image_id in shares and held[image_id] < shares[image_id]:
+            held[image_id] += 1
+        else:
+            spare.append(chassis)
+
+    plan = []
+    for image_id, builds in popular:
+        for i in xrange(shares[image_id] - held[image_id]):
+            plan.append((spare.pop(), image_id))
+    return plan
+
+
+class PrecacheImages(base.Job):
+
+    """Job which has the agents of READY chassis cache the images most
+    often built for their flavors, so that building an instance from one of
+    them needn't wait for the image to download. Job executors run it every
+    IMAGE_PRECACHE_INTERVAL seconds with `precache`, without going through
+    the queue, but it can be submitted like any other job too.
+    """
+    max_retries = 1
+
+    def _mark_assets(self):
+        # chassis are locked individually when their cached image is saved
+        pass
+
+    def _get_demand(self):
+        """Returns the popular images for each chassis model, as a dict of
+        lists of (image_id, builds) pairs, most built first. The demand of
+        every flavor a chassis model provides is combined, so that its
+        chassis are only planned for once.
+        """
+        builds = collections.defaultdict(collections.Counter)
+        for flavor in models.Flavor.objects.filter(deleted=False):
+            popular = models.ImageDemand.get_popular(
+                flavor.id,
+                self.config.IMAGE_PRECACHE_DAYS)
+            popular = popular[:self.config.IMAGE_PRECACHE_COUNT]
+            if not popular:
+                continue
+
+            flavor_providers = models.FlavorProvider.objects.allow_filtering()
+            flavor_providers = flavor_providers.filter(flavor_id=flavor.id,
+                                                       deleted=False)
+            chassis_model_ids = set(flavor_provider.chassis_model_id
+                                    for flavor_provider in flavor_providers)
+            for chassis_model_id in chassis_model_ids:
+                builds[chassis_model_id].update(dict(popular))
+
+        demand = {}
+        for chassis_model_id, counts in builds.iteritems():
+            popular = sorted(counts.iteritems(),
+                             key=lambda item: (-item[1], item[0]))
+            demand[chassis_model_id] = (
+                popular[:self.config.IMAGE_PRECACHE_COUNT])
+        return demand
+
+    def _get_ready_chassis(self, chassis_model_id):
+        """Returns the READY chassis of `chassis_model_id`. Lookup rows can
+        be stale, so each chassis is checked against its row.
+        """
+        rows = models.ChassisByStateAndModel.objects.filter(
+            state=models.ChassisState.READY,
+            chassis_model_id=chassis_model_id)
+
+        chassis_list = []
+        for row in rows:
+            try:
+                chassis = models.Chassis.objects.get(id=row.chassis_id)
+            except models.Chassis.DoesNotExist:
+                continue
+
+            if (chassis.state == models.ChassisState.READY and
+                    chassis.chassis_model_id == chassis_model_id):
+                chassis_list.append(chassis)
+        return chassis_list
+
+    def _record_cached_image(self, chassis_id, image_id):
+        """Record that the agent of `chassis_id` has cached `image_id`,
+        unless the chassis has left READY since it was listed. Returns True
+        if it was recorded.
+        """
+        lock_key = '/chassis/{}'.format(chassis_id)
+        with self.lock_manager.acquire(lock_key,
+                                       timeout=CHASSIS_LOCK_TIMEOUT):
+            try:
+                chassis = models.Chassis.objects.get(id=chassis_id)
+            except models.Chassis.DoesNotExist:
+                return False
+            if chassis.state != models.ChassisState.READY:
+                return False
+            chassis.cached_image_id = image_id
+            chassis.save()
+            return True
+
+    def cache_image(self, chassis, image_id):
+        """Have the agent of `chassis` cache `image_id`, and record it."""
+        client = self.executor.agent_client
+        try:
+            agent = client.get_agent(chassis)
+            client.cache_image(agent, image_id)
+        except errors.AgentNotConnectedError:
+            self.log.info('agent not connected, not caching image',
+                          chassis_id=chassis.id,
+                          image_id=image_id)
+            return
+        except Exception as e:
+            self.log.error('error caching image',
+                           chassis_id=chassis.id,
+                           image_id=image_id,
+                           exception=e)
+            return
+
+        try:
+            recorded = self._record_cached_image(chassis.id, image_id)
+        except locks.LockNotAcquired:
+            self.log.info('chassis is locked, not recording cached image',
+                          chassis_id=chassis.id,
+                          image_id=image_id)
+            return
+        if not recorded:
+            self.log.info('chassis no longer READY, not recording cached'
+                          ' image',
+                          chassis_id=chassis.id,
+                          image_id=image_id)
+            return
+        self.stats_client.incr('images.precache.cached')
+
+    def precache_chassis_model(self, chassis_model_id, popular):
+        """Spread the images in `popular` across the READY chassis of
+        `chassis_model_id`.
+        """
+        chassis_list = self._get_ready_chassis(chassis_model_id)
+        for chassis, image_id in plan_precache(popular, chassis_list):
+            self.cache_image(chassis, image_id)
+
+    def precache(self):
+        """Spread popular images across the READY chassis, unless another
+        executor already is.
+        """
+        with self.lock_manager.try_acquire(PRECACHE_LOCK_KEY) as acquired:
+            if not acquired:
+                self.log.info('images already being precached, skipping')
+                return
+
+            demand = self._get_demand()
+            for chassis_model_id, popular in demand.iteritems():
+                self.precache_chassis_model(chassis_model_id, popular)
+
+    def _execute(self):
+        self.precache()
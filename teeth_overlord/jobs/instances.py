@@ -18,17 +18,27 @@ import cqlengine
 
 from teeth_overlord.jobs import base
 from teeth_overlord import models
-from teeth_overlord import stats
+from teeth_overlord import tracing
+
+
+# Don't wait on another job's lock on an instance for longer than this.
+INSTANCE_LOCK_TIMEOUT = 10
 
 
 class InstanceJob(base.Job):
     def _mark_assets(self):
         instance_id = self.request.params.get('instance_id')
         lock_key = '/instances/{}'.format(instance_id)
-        with self.lock_manager.acquire(lock_key):
+        with self.lock_manager.acquire(lock_key,
+                                       timeout=INSTANCE_LOCK_TIMEOUT):
             instance = models.Instance.objects.get(id=instance_id)
             if self.request.state in (models.JobRequestState.COMPLETED,
                                       models.JobRequestState.FAILED):
+                # a finished request is marked again if it comes back
+                # from the queue, by which time another job may own the
+                # instance
+                if instance.job_id != str(self.request.id):
+                    return
                 instance.job_id = None
                 instance.job_state = None
             else:
@@ -50,9 +60,7 @@ class CreateInstance(InstanceJob):
     def attach_networks(self, instance, chassis):
         """Attach chassis to any configured networks."""
         macs = chassis.get_mac_addresses()
-        for network in instance.network_ids:
-            for mac in macs:
-                self.executor.network_provider.attach(mac, network)
+        self.executor.network_provider.attach_many(macs, instance.network_ids)
 
     def prepare_and_run_image(self, instance, chassis, image_info, metadata,
                               files):
@@ -73,28 +81,53 @@ class CreateInstance(InstanceJob):
         chassis.batch(batch).save()
         batch.execute()
 
-    @stats.incr_stat('instances.create')
     def _execute(self):
         params = self.request.params
+        trace = tracing.Trace.deserialize('instances.create',
+                                          self.stats_client,
+                                          params.get(tracing.TRACE_PARAM))
+        # the trace was serialized when the request was first submitted, so
+        # a retry would count its backoff as queue time
+        first_attempt = not self.request.failed_attempts
+        if first_attempt:
+            trace.record_queued()
+
         instance = models.Instance.objects.get(id=params['instance_id'])
         image_id = instance.image_id
-        chassis = self.executor.scheduler.reserve_chassis(instance)
-        image_info = self.executor.image_provider.get_image_info(image_id)
+        with trace.span('reserve_chassis'):
+            chassis = self.executor.scheduler.reserve_chassis(instance)
+        with trace.span('get_image_info'):
+            image_info = self.executor.image_provider.get_image_info(image_id)
 
         # TODO(morgabra): After booting into an image, we need to detach
         #                 from the service network.
-        self.attach_networks(instance, chassis)
+        with trace.span('attach_networks'):
+            self.attach_networks(instance, chassis)
 
         metadata = params['metadata']
         files = params['files']
 
-        self.prepare_and_run_image(instance,
-                                   chassis,
-                                   image_info,
-                                   metadata,
-                                   files)
+        with trace.span('prepare_and_run_image'):
+            self.prepare_and_run_image(instance,
+                                       chassis,
+                                       image_info,
+                                       metadata,
+                                       files)
+
+        with trace.span('mark_active'):
+            self.mark_active(instance, chassis)
+
+        # counters can't be batched with the other writes, and the instance
+        # is already active, so don't fail the job over this
+        try:
+            models.ImageDemand.record(instance.flavor_id, image_id)
+        except Exception as e:
+            self.log.error('error recording image demand', exception=e)
 
-        self.mark_active(instance, chassis)
+        if first_attempt:
+            trace.record('total', trace.started_at)
+        else:
+            trace.record('total.retried', trace.started_at)
 
 
 class DeleteInstance(InstanceJob):
@@ -103,7 +136,6 @@ class DeleteInstance(InstanceJob):
     """
     max_retries = 10
 
-    @stats.incr_stat('instances.delete')
     def _execute(self):
         params = self.request.params
         instance = models.Instance.objects.get(id=params['instance_id'])
@@ -0,0 +1,117 @@
+"""
+Copyright 2013 Rackspace, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+import calendar
+import collections
+import threading
+import time
+
+from keystoneclient.v2_0 import client as keystone_client
+
+# Tokens are refreshed this many seconds before they expire. Until they
+# actually expire, callers keep using the old token while one of them
+# fetches a new one.
+REFRESH_MARGIN = 300
+
+
+class TokenCache(object):
+    """Thread-safe cache of Keystone tokens, keyed by credentials, so that
+    authenticating stays off the request path. Concurrent callers needing a
+    new token for the same credentials share a single request for it.
+    """
+    def __init__(self):
+        # credentials -> (token, refresh_at, expires_at)
+        self.tokens = {}
+        self.refresh_locks = collections.defaultdict(threading.Lock)
+        self.lock = threading.Lock()
+
+    def get_token(self, username, password, tenant_id, auth_url):
+        """Returns a token for the given credentials, authenticating if
+        there is no cached token or it is about to expire.
+        """
+        key = (username, password, tenant_id, auth_url)
+        entry = self.tokens.get(key)
+        now = time.time()
+        if entry is not None and now < entry[1]:
+            return entry[0]
+
+        with self.lock:
+            refresh_lock = self.refresh_locks[key]
+
+        if entry is not None and now < entry[2]:
+            # still valid, so only wait for a refresh if nobody else is
+            # already doing one
+            if not refresh_lock.acquire(False):
+                return entry[0]
+        else:
+            refresh_lock.acquire()
+
+        try:
+            entry = self.tokens.get(key)
+            if entry is not None and time.time() < entry[1]:
+                # refreshed while we waited
+                return entry[0]
+
+            auth = keystone_client.Client(username=username,
+                                          password=password,
+                                          tenant_id=tenant_id,
+                                          auth_url=auth_url)
+            expires_at = calendar.timegm(auth.auth_ref.expires.utctimetuple())
+            self.tokens[key] = (auth.auth_token,
+                                expires_at - REFRESH_MARGIN,
+                                expires_at)
+            return auth.auth_token
+        finally:
+            refresh_lock.release()
+
+    def invalidate(self, username, password, tenant_id, auth_url, token):
+        """Forget `token`, which was rejected, so that the next caller for
+        the given credentials authenticates again. Does nothing if the
+        cached token has already been replaced.
+        """
+        key = (username, password, tenant_id, auth_url)
+        with self.lock:
+            refresh_lock = self.refresh_locks[key]
+
+        with refresh_lock:
+            entry = self.tokens.get(key)
+            if entry is not None and entry[0] == token:
+                del self.tokens[key]
+
+
+token_cache = TokenCache()
+
+
+def get_auth_token(config):
+    """Returns a token for the configured Keystone credentials, from the
+    cache shared by everything in this process.
+    """
+    return token_cache.get_token(config.KEYSTONE_USER,
+                                 config.KEYSTONE_PASS,
+                                 config.KEYSTONE_TENANT_ID,
+                                 config.KEYSTONE_AUTH_URL)
+
+
+def invalidate_auth_token(config, token):
+    """Forget `token` for the configured Keystone credentials, after a
+    service rejected it.
+    """
+    token_cache.invalidate(config.KEYSTONE_USER,
+                           config.KEYSTONE_PASS,
+                           config.KEYSTONE_TENANT_ID,
+                           config.KEYSTONE_AUTH_URL,
+                           token)
@@ -15,25 +15,90 @@ limitations under the License.
 """
 
 import contextlib
+import heapq
+import itertools
+from multiprocessing import pool
 import threading
 import time
 
 import etcd
+from stevedore import driver
+import structlog
 
+from teeth_overlord import stats
 
-class EtcdLockManager(object):
 
-    """Manager for etcd-based locks."""
+# Maximum number of lock renewals which may be in flight at once. Renewals
+# are independent, so a slow response from etcd for one lock shouldn't hold
+# up renewing the others.
+RENEWAL_THREADS = 4
 
-    def __init__(self, config, client=None):
-        if client is not None:
-            self.client = client
-        else:
-            self.client = etcd.Client(config.ETCD_HOST, config.ETCD_PORT)
+# If renewing a lock fails for a reason other than the lock being gone, try
+# again after this many seconds.
+RENEWAL_RETRY_DELAY = 0.1
+
+# How long try_acquire() will wait on etcd once it has seen that the lock is
+# free. This only needs to cover a round trip, not another holder.
+TRY_ACQUIRE_TIMEOUT = 1
+
+# Threads in the same process contend for a key in memory before going to
+# etcd. Keys are spread across this many stripes, each with its own mutex.
+LOCAL_LOCK_STRIPES = 32
+
+
+class LockNotAcquired(Exception):
+    """Raised when a lock is held by someone else and we weren't willing to
+    wait (any longer) for it.
+    """
+    pass
+
+
+def _key_prefix(key):
+    """Returns the first path component of a lock key, for use in metric
+    names. For example, '/instances/<id>' has a prefix of 'instances'.
+    """
+    return key.strip('/').split('/')[0] or 'root'
+
+
+class _LocalStripe(object):
+
+    """Tracks which thread holds each key that hashes to this stripe, and how
+    many times it has acquired it.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.owners = {}
+
+
+class LockManager(object):
+
+    """Manager for TTL-based locks. Locks are obtained from `client`, which
+    must behave like an etcd client's `get_lock`. Held locks are renewed in
+    the background until they are released.
+
+    Before going to `client`, a thread must take ownership of the key within
+    the manager. Other threads in the process wait for the key in memory, so
+    only one of them at a time waits on etcd. A thread which already owns a
+    key may acquire it again without a round trip.
+    """
+
+    def __init__(self, config, client, stats_client=None,
+                 renewal_threads=RENEWAL_THREADS):
+        self.client = client
+        self.stats_client = stats_client or stats.get_stats_client(config,
+                                                                   'locks')
+        self.log = structlog.get_logger()
+        self.renewal_threads = renewal_threads
 
         self._event = threading.Event()
         self._lock = threading.Lock()
         self._locks = {}
+        # min-heap of (renew_at, sequence, lock), ordered by renewal deadline
+        self._renewals = []
+        self._sequence = itertools.count()
+        self._pool = None
+        self._stripes = [_LocalStripe() for i in xrange(LOCAL_LOCK_STRIPES)]
         self.stopping = False
         self._thread = threading.Thread(target=self._keep_locks_open)
         self._thread.daemon = True
@@ -44,6 +109,14 @@ class EtcdLockManager(object):
         with self._lock:
             self._event.set()
         self._thread.join()
+        if self._pool is not None:
+            self._pool.terminate()
+
+    def _get_pool(self):
+        # Only the renewal thread submits work, so this needs no locking.
+        if self._pool is None:
+            self._pool = pool.ThreadPool(self.renewal_threads)
+        return self._pool
 
     def _keep_locks_open(self):
         while not self.stopping:
@@ -55,23 +128,58 @@ class EtcdLockManager(object):
                 self._event.wait(next_interval)
 
     def _check_locks(self):
-        next_update = time.time() + 60  # check at least once per minute
-        locks = []
+        """Hand every lock whose renewal deadline has passed to the renewal
+        pool, and return the time at which the next deadline falls.
+        """
+        now = time.time()
+        next_update = now + 60  # check at least once per minute
+        due = []
         with self._lock:
-            locks = self._locks.values()
             self._event.clear()
-        for lock in locks:
-            time_to_renew = self._check_and_renew(lock)
-            next_update = min(next_update, time_to_renew)
+            while self._renewals and self._renewals[0][0] <= now:
+                renew_at, _, lock = heapq.heappop(self._renewals)
+                # skip entries left behind by locks which were released
+                if self._locks.get(lock.key) is lock:
+                    due.append((renew_at, lock))
+            if self._renewals:
+                next_update = min(next_update, self._renewals[0][0])
+
+        for renew_at, lock in due:
+            self._get_pool().apply_async(self._renew, (lock, renew_at))
         return next_update
 
+    def _schedule(self, lock, renew_at):
+        with self._lock:
+            if self._locks.get(lock.key) is lock:
+                entry = (renew_at, next(self._sequence), lock)
+                heapq.heappush(self._renewals, entry)
+                self._event.set()
+
+    def _renew(self, lock, renew_at):
+        lag = max(time.time() - renew_at, 0)
+        self.stats_client.timing(
+            '{}.renewal_lag'.format(_key_prefix(lock.key)),
+            int(lag * 1000))
+        try:
+            next_update = self._check_and_renew(lock)
+        except Exception as e:
+            self.log.error('error renewing lock', key=lock.key, exception=e)
+            next_update = time.time() + RENEWAL_RETRY_DELAY
+        self._schedule(lock, next_update)
+
     def _check_and_renew(self, lock):
         if self._should_renew(lock):
+            prefix = _key_prefix(lock.key)
             try:
                 lock.renew(lock.ttl)
             except etcd.EtcdException:
-                # lock was released or expired, clean it up
-                self._release(lock.key)
+                # lock was released or expired, clean it up unless the key
+                # has been released (and possibly re-acquired) since
+                if self._release_remote(lock.key, lock):
+                    self.stats_client.incr('{}.lost'.format(prefix))
+                    self.log.error('lost lock', key=lock.key)
+            else:
+                self.stats_client.incr('{}.renewed'.format(prefix))
             lock.expires_at = time.time() + lock.ttl
         next_update = lock.expires_at - lock.two_thirds_ttl
         return next_update
@@ -83,30 +191,308 @@ class EtcdLockManager(object):
 
     @contextlib.contextmanager
     def acquire(self, key, **kwargs):
+        """Hold the lock on `key` for the duration of the context. If a
+        `timeout` is given and the lock can't be acquired within that many
+        seconds, raises `LockNotAcquired`.
+        """
         self._acquire(key, **kwargs)
-        yield
-        self._release(key)
+        try:
+            yield
+        finally:
+            self._release(key)
+
+    @contextlib.contextmanager
+    def try_acquire(self, key, **kwargs):
+        """Acquire the lock on `key` only if nobody else holds it. Yields
+        True if the lock is held for the duration of the context, or False
+        if it was not acquired.
+        """
+        try:
+            self._acquire(key, blocking=False, **kwargs)
+        except LockNotAcquired:
+            yield False
+        else:
+            try:
+                yield True
+            finally:
+                self._release(key)
+
+    def _get_stripe(self, key):
+        return self._stripes[hash(key) % len(self._stripes)]
+
+    def _acquire_local(self, key, deadline=None, blocking=True):
+        """Take ownership of `key` within the process. Returns True if the
+        calling thread already owned it.
+        """
+        stripe = self._get_stripe(key)
+        current_thread = threading.current_thread()
+        with stripe.condition:
+            while True:
+                owner = stripe.owners.get(key)
+                if owner is None:
+                    stripe.owners[key] = [current_thread, 1]
+                    return False
+                if owner[0] is current_thread:
+                    owner[1] += 1
+                    return True
+                if not blocking:
+                    raise LockNotAcquired(key)
+
+                wait = None
+                if deadline is not None:
+                    wait = deadline - time.time()
+                    if wait <= 0:
+                        raise LockNotAcquired(key)
+                stripe.condition.wait(wait)
+
+    def _release_local(self, key):
+        """Give up ownership of `key` within the process."""
+        stripe = self._get_stripe(key)
+        with stripe.condition:
+            del stripe.owners[key]
+            stripe.condition.notify_all()
+
+    def _acquire(self, key, ttl=1, value=None, timeout=None, blocking=True):
+        prefix = _key_prefix(key)
+        start = time.time()
+        deadline = None
+        if timeout is not None:
+            deadline = start + timeout
+
+        try:
+            if self._acquire_local(key, deadline, blocking):
+                self.stats_client.incr('{}.reentrant'.format(prefix))
+                return
+        except LockNotAcquired:
+            if blocking:
+                self.stats_client.incr('{}.acquire_timeout'.format(prefix))
+            else:
+                self.stats_client.incr('{}.contended'.format(prefix))
+            raise
+
+        try:
+            self._acquire_remote(key, prefix, ttl, value, deadline, blocking)
+        except Exception:
+            self._release_local(key)
+            raise
+
+        now = time.time()
+        self.stats_client.timing('{}.acquire_wait'.format(prefix),
+                                 int((now - start) * 1000))
 
-    def _acquire(self, key, ttl=1, value=None):
+    def _acquire_remote(self, key, prefix, ttl, value, deadline, blocking):
         lock = self.client.get_lock(key, ttl=ttl, value=value)
-        lock.acquire()
+
+        timeout = None
+        if not blocking:
+            if lock.is_locked():
+                self.stats_client.incr('{}.contended'.format(prefix))
+                raise LockNotAcquired(key)
+            timeout = TRY_ACQUIRE_TIMEOUT
+        elif deadline is not None:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                self.stats_client.incr('{}.acquire_timeout'.format(prefix))
+                raise LockNotAcquired(key)
+
+        try:
+            lock.acquire(timeout=timeout)
+        except Exception:
+            # Without a timeout, acquire() only fails if etcd does.
+            if timeout is None:
+                raise
+            # Note that etcd may still hand the abandoned request the lock
+            # later on, but as nobody will renew it it expires after `ttl`.
+            self.stats_client.incr('{}.acquire_timeout'.format(prefix))
+            raise LockNotAcquired(key)
+
         now = time.time()
+        lock.acquired_at = now
         lock.expires_at = now + ttl
         lock.two_thirds_ttl = 2.0 * ttl / 3.0
         with self._lock:
             self._locks[key] = lock
-            self._event.set()
+        self._schedule(lock, lock.expires_at - lock.two_thirds_ttl)
 
     def _release(self, key):
+        stripe = self._get_stripe(key)
+        with stripe.condition:
+            owner = stripe.owners[key]
+            # only the outermost of nested acquisitions releases the lock
+            if owner[1] > 1:
+                owner[1] -= 1
+                return
+        try:
+            self._release_remote(key)
+        finally:
+            self._release_local(key)
+
+    def _release_remote(self, key, lock=None):
+        """Release the lock held on `key`. If `lock` is given, only release
+        it if it is still the lock registered for `key`. Returns True if a
+        lock was released.
+        """
         with self._lock:
-            lock = self._locks[key]
+            if lock is None:
+                lock = self._locks.get(key)
+            # the lock may have been lost, or replaced by a newer one
+            if lock is None or self._locks.get(key) is not lock:
+                return False
             del self._locks[key]
+        self.stats_client.timing('{}.hold'.format(_key_prefix(key)),
+                                 int((time.time() - lock.acquired_at) * 1000))
         try:
             lock.release()
         except etcd.EtcdException:
             # lock was already released or expired
             pass
+        return True
+
+
+class EtcdLockManager(LockManager):
+
+    """Manager for etcd-based locks."""
+
+    def __init__(self, config, client=None, **kwargs):
+        if client is None:
+            client = etcd.Client(config.ETCD_HOST, config.ETCD_PORT)
+        super(EtcdLockManager, self).__init__(config, client, **kwargs)
+
+
+class MemoryLock(object):
+
+    """A lock held in process memory, which follows the semantics of etcd's
+    lock module: it is held until it is released or its TTL runs out, and
+    acquiring it blocks until it is free.
+    """
+
+    def __init__(self, client, key, ttl=None, value=None):
+        self.client = client
+        self.key = key
+        self.ttl = ttl or 0
+        self.value = value
+        self._token = None
+
+    def _get_holder(self):
+        """Returns the (token, expires_at) of the current holder, or None.
+        Must be called with the client's condition held.
+        """
+        holder = self.client._holders.get(self.key)
+        if holder is not None:
+            expires_at = holder[1]
+            if expires_at is not None and expires_at <= time.time():
+                del self.client._holders[self.key]
+                self.client._condition.notify_all()
+                return None
+        return holder
+
+    def _check_held(self):
+        holder = self._get_holder()
+        if holder is None or holder[0] is not self._token:
+            raise etcd.EtcdException('Lock is non-existent (or expired)')
+
+    def _expires_at(self, ttl):
+        # like etcd, a TTL of 0 means the lock never expires
+        if not ttl:
+            return None
+        return time.time() + ttl
+
+    def acquire(self, timeout=None):
+        """Acquire the lock. Blocks until the lock is acquired, or raises
+        `etcd.EtcdException` after `timeout` seconds.
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        with self.client._condition:
+            while True:
+                holder = self._get_holder()
+                if holder is None:
+                    break
+
+                now = time.time()
+                wait = None
+                if holder[1] is not None:
+                    wait = holder[1] - now
+                if deadline is not None:
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        raise etcd.EtcdException('Lock acquisition timed out')
+                    wait = remaining if wait is None else min(wait, remaining)
+                self.client._condition.wait(wait)
+
+            self._token = object()
+            self.client._holders[self.key] = (self._token,
+                                              self._expires_at(self.ttl))
+        return self
+
+    def is_locked(self):
+        """Check if the lock is currently held by anyone."""
+        with self.client._condition:
+            return self._get_holder() is not None
+
+    def renew(self, new_ttl, timeout=None):
+        """Renew the TTL on this lock."""
+        with self.client._condition:
+            self._check_held()
+            self.client._holders[self.key] = (self._token,
+                                              self._expires_at(new_ttl))
+
+    def release(self):
+        """Release this lock."""
+        with self.client._condition:
+            self._check_held()
+            del self.client._holders[self.key]
+            self._token = None
+            self.client._condition.notify_all()
+
+
+class MemoryLockClient(object):
+
+    """Stands in for an etcd client, handing out locks which only exclude
+    other users of the same client.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._holders = {}
+
+    def get_lock(self, key, ttl=None, value=None):
+        return MemoryLock(self, key, ttl=ttl, value=value)
+
+
+# Shared by every MemoryLockManager in the process, so that they exclude
+# each other the way separate EtcdLockManagers do.
+_memory_lock_client = MemoryLockClient()
+
+
+class MemoryLockManager(LockManager):
+
+    """Manager for in-process locks. Suitable for single-node deployments
+    and tests, where there is nobody else to coordinate with.
+    """
+
+    def __init__(self, config, client=None, **kwargs):
+        if client is None:
+            client = _memory_lock_client
+        super(MemoryLockManager, self).__init__(config, client, **kwargs)
+
+
+# Lock managers are shared by everything in a process using the same config,
+# so that threads contending for a key can find each other in memory.
+_lock_managers = {}
+_lock_managers_lock = threading.Lock()
 
 
 def get_lock_manager(config):
-    return EtcdLockManager(config)
+    with _lock_managers_lock:
+        if config not in _lock_managers:
+            mgr = driver.DriverManager(
+                namespace='teeth_overlord.lock.managers',
+                name=config.LOCK_MANAGER,
+                invoke_on_load=True,
+                invoke_args=[config],
+            )
+            _lock_managers[config] = mgr.driver
+        return _lock_managers[config]
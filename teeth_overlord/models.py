@@ -16,6 +16,7 @@ limitations under the License.
 
 import collections
 import datetime
+import hashlib
 import json
 import struct
 import uuid
@@ -44,6 +45,19 @@ def uuid_str():
     return str(uuid.uuid4())
 
 
+def _canonical(value):
+    """Returns `value` with any dicts and sets replaced by sorted lists, so
+    that equal values have equal reprs.
+    """
+    if isinstance(value, dict):
+        return sorted((k, _canonical(v)) for k, v in value.iteritems())
+    if isinstance(value, (set, frozenset)):
+        return sorted(_canonical(v) for v in value)
+    if isinstance(value, (list, tuple)):
+        return [_canonical(v) for v in value]
+    return value
+
+
 class C2DateTime(columns.DateTime):
     """Hack until cqlengine supports Cassandra 2.0. See:
     http://stackoverflow.com/a/18992934
@@ -88,6 +102,104 @@ class Base(models.Model, encoding.Serializable):
     __abstract__ = True
     __keyspace__ = KEYSPACE_NAME
 
+    # LookupBase tables which are kept in sync with this model's rows.
+    __lookups__ = ()
+
+    @classmethod
+    def _get_lookup_columns(cls):
+        """Returns the names of the columns this model's lookups are keyed
+        on.
+        """
+        return set(source
+                   for lookup in cls.__lookups__
+                   for source in lookup.__source_columns__.itervalues())
+
+    def save(self):
+        """Save the model, and update any lookup tables whose key for it
+        changed, in the same batch if the model is saved in one.
+        """
+        names = self._get_lookup_columns()
+        changed = [name for name in names if self._values[name].changed]
+        persisted = self._is_persisted
+        if persisted and not changed:
+            super(Base, self).save()
+            return self
+
+        previous = None
+        if persisted:
+            previous = dict((name, self._values[name].previous_value)
+                            for name in names)
+        batch = self._batch
+
+        # validation fills in defaults, so only look at current values after
+        super(Base, self).save()
+
+        current = dict((name, getattr(self, name)) for name in names)
+        for lookup in self.__lookups__:
+            key = lookup.get_key(self, current)
+            if previous is not None:
+                previous_key = lookup.get_key(self, previous)
+                if key == previous_key:
+                    continue
+                if None not in previous_key.values():
+                    lookup(**previous_key).batch(batch).delete()
+            if None not in key.values():
+                lookup(**key).batch(batch).save()
+
+        return self
+
+    def get_version(self):
+        """Returns a string which changes whenever any of the model's column
+        values do. This is much cheaper than serializing the model, so it
+        is used to answer conditional requests.
+        """
+        digest = hashlib.sha1()
+        for name in self._columns:
+            digest.update(repr((name, _canonical(getattr(self, name)))))
+        return digest.hexdigest()
+
+    def delete(self):
+        """Delete the model, along with its lookup table rows."""
+        for lookup in self.__lookups__:
+            key = lookup.get_key(self)
+            if None not in key.values():
+                lookup(**key).batch(self._batch).delete()
+        super(Base, self).delete()
+
+
+class LookupBase(Base):
+    """Base class for tables mapping column values to the ids of the rows
+    having them, so that rows can be listed by those values with a single
+    partition read instead of a secondary index query.
+
+    Saving a model moves its lookup rows from the key it was loaded with
+    to the key it is saved with, without reading the stored row back, so
+    writers which change keyed columns should hold the row's lock and have
+    loaded it under the lock. Lookup rows can still go stale: two writers
+    may race, a model built afresh and saved over an existing row can't
+    know the old row's keys, and lookup writes outside a batch can fail
+    on their own. Readers must therefore treat lookup rows as candidates,
+    and check each against its source row before using it.
+    """
+    __abstract__ = True
+
+    # Maps each of the lookup table's columns to the source model's column
+    # it is taken from.
+    __source_columns__ = {}
+
+    @classmethod
+    def get_key(cls, model, values=None):
+        """Returns the lookup row for `model` as a dict. If `values` is
+        given, it maps the model's column names to the values to use
+        instead of the model's own.
+        """
+        if values is None:
+            return dict((column, getattr(model, source))
+                        for column, source
+                        in cls.__source_columns__.iteritems())
+        return dict((column, values[source])
+                    for column, source in cls.__source_columns__.iteritems())
+
 
 class MetadataBase(Base):
     __abstract__ = True
@@ -251,8 +363,52 @@ class SwitchPort(MetadataBase):
     switch_id = columns.Text(required=True, max_length=MAX_ID_LENGTH)
 
 
+class ChassisByState(LookupBase):
+    """Lookup table of Chassis ids by state."""
+    __source_columns__ = {'state': 'state', 'chassis_id': 'id'}
+
+    state = columns.Ascii(partition_key=True)
+    chassis_id = columns.Text(primary_key=True, max_length=MAX_ID_LENGTH)
+
+
+class ChassisByStateAndModel(LookupBase):
+    """Lookup table of Chassis ids by state and ChassisModel."""
+    __source_columns__ = {
+        'state': 'state',
+        'chassis_model_id': 'chassis_model_id',
+        'chassis_id': 'id',
+    }
+
+    state = columns.Ascii(partition_key=True)
+    chassis_model_id = columns.Text(partition_key=True,
+                                    max_length=MAX_ID_LENGTH)
+    chassis_id = columns.Text(primary_key=True, max_length=MAX_ID_LENGTH)
+
+
+class ChassisByCachedImage(LookupBase):
+    """Lookup table of Chassis ids by state, ChassisModel and the image
+    cached by their agent.
+    """
+    __source_columns__ = {
+        'state': 'state',
+        'chassis_model_id': 'chassis_model_id',
+        'cached_image_id': 'cached_image_id',
+        'chassis_id': 'id',
+    }
+
+    state = columns.Ascii(partition_key=True)
+    chassis_model_id = columns.Text(partition_key=True,
+                                    max_length=MAX_ID_LENGTH)
+    cached_image_id = columns.Text(partition_key=True,
+                                   max_length=MAX_ID_LENGTH)
+    chassis_id = columns.Text(primary_key=True, max_length=MAX_ID_LENGTH)
+
+
 class Chassis(MetadataBase):
     """Model for an individual Chassis."""
+    __lookups__ = (ChassisByState, ChassisByStateAndModel,
+                   ChassisByCachedImage)
+
     id = columns.Text(primary_key=True,
                       default=uuid_str,
                       max_length=MAX_ID_LENGTH)
@@ -267,6 +423,9 @@ class Chassis(MetadataBase):
     ipmi_username = columns.Text()
     ipmi_password = columns.Text()
     agent_id = columns.Text(max_length=MAX_ID_LENGTH)
+    # image the chassis' agent has cached while in standby, as last
+    # requested by the precache job or reported in a heartbeat
+    cached_image_id = columns.Text(max_length=MAX_ID_LENGTH)
 
     def serialize(self, view):
         """Turn a Chassis into a dict."""
@@ -372,8 +531,18 @@ class InstanceState(object):
     DELETED = 'DELETED'
 
 
+class InstanceByState(LookupBase):
+    """Lookup table of Instance ids by state."""
+    __source_columns__ = {'state': 'state', 'instance_id': 'id'}
+
+    state = columns.Ascii(partition_key=True)
+    instance_id = columns.Text(primary_key=True, max_length=MAX_ID_LENGTH)
+
+
 class Instance(MetadataBase):
     """Model for an Instance."""
+    __lookups__ = (InstanceByState,)
+
     id = columns.Text(primary_key=True,
                       default=uuid_str,
                       max_length=MAX_ID_LENGTH)
@@ -427,6 +596,41 @@ class Instance(MetadataBase):
             return None
 
 
+class ImageDemand(Base):
+    """Counts of instances built from each image, by flavor and day. The
+    image pre-caching job uses these to find the popular images.
+    """
+    flavor_id = columns.Text(partition_key=True, max_length=MAX_ID_LENGTH)
+    day = columns.Ascii(partition_key=True)
+    image_id = columns.Text(primary_key=True, max_length=MAX_ID_LENGTH)
+    builds = columns.Counter()
+
+    @staticmethod
+    def _get_day(when):
+        return when.strftime('%Y-%m-%d')
+
+    @classmethod
+    def record(cls, flavor_id, image_id):
+        """Count an instance of `flavor_id` built from `image_id`."""
+        day = cls._get_day(datetime.datetime.utcnow())
+        cls(flavor_id=flavor_id, day=day, image_id=image_id, builds=1).save()
+
+    @classmethod
+    def get_popular(cls, flavor_id, days):
+        """Returns (image_id, builds) pairs for the images built for
+        `flavor_id` over the last `days` days, most built first.
+        """
+        now = datetime.datetime.utcnow()
+        builds = collections.defaultdict(int)
+        for i in xrange(days):
+            day = cls._get_day(now - datetime.timedelta(days=i))
+            for row in cls.objects.filter(flavor_id=flavor_id, day=day):
+                builds[row.image_id] += row.builds
+
+        return sorted(builds.iteritems(),
+                      key=lambda item: (-item[1], item[0]))
+
+
 class AgentState(object):
     """Possible states that an Agent can be in."""
     STANDBY = 'STANDBY'
@@ -524,9 +728,14 @@ class JobRequest(Base):
 
 all_models = [
     Chassis,
+    ChassisByState,
+    ChassisByStateAndModel,
+    ChassisByCachedImage,
     HardwareToChassis,
     Instance,
+    InstanceByState,
     Agent,
+    ImageDemand,
     JobRequest,
     Flavor,
     FlavorProvider,
@@ -19,6 +19,8 @@ import collections
 
 from stevedore import driver
 
+from teeth_overlord import util
+
 
 class NetworkInfo(object):
 
@@ -96,6 +98,16 @@ class BaseNetworkProvider(object):
     class SubnetDoesNotExist(NetworkProviderException):
         pass
 
+    class PortOperationsFailed(NetworkProviderException):
+        """Raised when some of a batch of port operations failed, with the
+        exception from each failure in `errors`.
+        """
+        def __init__(self, errors):
+            self.errors = errors
+            super(BaseNetworkProvider.PortOperationsFailed, self).__init__(
+                '{} port operations failed: {}'.format(
+                    len(errors), '; '.join(str(e) for e in errors)))
+
     def __init__(self, config):
         self.config = config
 
@@ -110,8 +122,54 @@ class BaseNetworkProvider(object):
         pass
 
     @abc.abstractmethod
-    def list_networks(self):
-        """List avaiable networks."""
+    def delete_port(self, port_id):
+        """Delete the port with id `port_id`."""
+        pass
+
+    def attach_many(self, mac_addresses, network_ids):
+        """Attach each of `mac_addresses` to each of `network_ids`, and
+        return the created ports. Providers with a bulk API should
+        override this to avoid a request per port.
+
+        Ports are attached concurrently. If any attach fails, the ports
+        which were attached are deleted again before raising
+        PortOperationsFailed, so that the caller can simply retry. Only
+        the ports created by this call are deleted, not any others the MAC
+        addresses already had.
+        """
+        pairs = [(mac_address, network_id)
+                 for network_id in network_ids
+                 for mac_address in mac_addresses]
+        outcomes = util.map_concurrently(lambda pair: self.attach(*pair),
+                                         pairs,
+                                         self.config.NETWORK_PORT_THREADS)
+        errors = [error for port, error in outcomes if error is not None]
+        if not errors:
+            return [port for port, error in outcomes]
+
+        attached = [port for port, error in outcomes if error is None]
+        outcomes = util.map_concurrently(
+            lambda port: self.delete_port(port.id),
+            attached,
+            self.config.NETWORK_PORT_THREADS)
+        errors.extend(error for _, error in outcomes if error is not None)
+        raise self.PortOperationsFailed(errors)
+
+    def detach_many(self, mac_addresses, network_id=None):
+        """Detach each of `mac_addresses` from networks, concurrently."""
+        outcomes = util.map_concurrently(
+            lambda mac_address: self.detach(mac_address, network_id),
+            mac_addresses,
+            self.config.NETWORK_PORT_THREADS)
+        errors = [error for _, error in outcomes if error is not None]
+        if errors:
+            raise self.PortOperationsFailed(errors)
+
+    @abc.abstractmethod
+    def list_networks(self, marker=None, limit=None):
+        """List up to `limit` avaiable networks, following the network with
+        id `marker`. Raises NetworkDoesNotExist if there is no such network.
+        """
         pass
 
     @abc.abstractmethod
@@ -17,6 +17,7 @@ limitations under the License.
 import structlog
 
 from teeth_overlord.networks import base
+from teeth_overlord import util
 
 
 FAKE_SUBNETS = {
@@ -95,6 +96,16 @@ class FakeNetworkProvider(base.BaseNetworkProvider):
     def detach(self, mac_address, network_id=None):
         pass
 
+    def delete_port(self, port_id):
+        pass
+
+    def attach_many(self, mac_addresses, network_ids):
+        return [FAKE_PORT for network_id in network_ids
+                for mac_address in mac_addresses]
+
+    def detach_many(self, mac_addresses, network_id=None):
+        pass
+
     def list_ports(self, mac_address):
         return [FAKE_PORT]
 
@@ -104,8 +115,12 @@ class FakeNetworkProvider(base.BaseNetworkProvider):
         except KeyError:
             raise self.NetworkDoesNotExist()
 
-    def list_networks(self):
-        return FAKE_NETWORKS.values()
+    def list_networks(self, marker=None, limit=None):
+        networks = sorted(FAKE_NETWORKS.values(), key=lambda n: n.id)
+        try:
+            return util.get_page(networks, marker, limit)
+        except ValueError:
+            raise self.NetworkDoesNotExist()
 
     def get_default_networks(self):
         return DEFAULT_NETWORKS
@@ -14,31 +14,103 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import functools
+import operator
+
 import structlog
 
+from teeth_overlord import keystone
 from teeth_overlord.networks import base
+from teeth_overlord import util
 
 from keystoneclient.apiclient import exceptions as keystone_exceptions
-from keystoneclient.v2_0 import client as keystone_client
 
 from neutronclient.common import exceptions as neutron_exceptions
 from neutronclient.neutron import client as neutron_client
 
 
-def list_networks(client):
+# Cap on the number of ids filtered on by each list request, to keep
+# request URLs reasonably short.
+MAX_IDS_PER_REQUEST = 50
+
+
+def _list_by_ids(list_method, key, ids):
+    """Fetch the resources with `ids` using as few filtered list requests
+    as possible, and return them in a dict by id.
+    """
+    ids = list(set(ids))
+    found = {}
+    for start in xrange(0, len(ids), MAX_IDS_PER_REQUEST):
+        items = list_method(id=ids[start:start + MAX_IDS_PER_REQUEST])[key]
+        for item in items:
+            found[item['id']] = item
+    return found
+
+
+def _deserialize_networks(networks, client):
+    """Deserialize network bodies, fetching all of their subnets at once."""
+    subnet_ids = [s for network in networks for s in network.get('subnets')]
+    subnets = get_subnets(subnet_ids, client)
+    return [NeutronNetworkInfo.deserialize(n, client, subnets)
+            for n in networks]
+
+
+def list_networks(client, marker=None, limit=None):
     try:
-        netwrks = client.list_networks()['networks']
-        netwrks = [NeutronNetworkInfo.deserialize(n, client) for n in netwrks]
-        return netwrks
+        if limit is None and marker is None:
+            netwrks = client.list_networks()['networks']
+        else:
+            netwrks = _list_networks_page(client, marker, limit)
+        return _deserialize_networks(netwrks, client)
     except neutron_exceptions.NeutronException as e:
+        if marker is not None and '404 Not Found' in e.message:
+            raise NeutronProvider.NetworkDoesNotExist(
+                'Network with id {} does not exist'.format(marker))
         raise NeutronProvider.NetworkProviderException(str(e))
 
 
+def _list_networks_page(client, marker, limit):
+    params = {}
+    if marker is not None:
+        params['marker'] = marker
+    if limit is not None:
+        params['limit'] = limit
+
+    # only fetch the first page, rather than following the next links
+    pages = client.list_networks(retrieve_all=False, **params)
+    netwrks = next(iter(pages), {}).get('networks', [])
+
+    # Neutron ignores the pagination parameters unless allow_pagination is
+    # enabled, in which case page the full list here
+    ids = [n['id'] for n in netwrks]
+    if marker in ids or (limit is not None and len(netwrks) > limit):
+        try:
+            netwrks = util.get_page(netwrks, marker, limit,
+                                    operator.itemgetter('id'))
+        except ValueError:
+            raise NeutronProvider.NetworkDoesNotExist(
+                'Network with id {} does not exist'.format(marker))
+    return netwrks
+
+
+def _deserialize_ports(ports, client):
+    """Deserialize port bodies, fetching all of their networks at once."""
+    network_ids = [p.get('network_id') for p in ports]
+    netwrks = _list_by_ids(client.list_networks, 'networks', network_ids)
+    for network_id in network_ids:
+        if network_id not in netwrks:
+            raise NeutronProvider.NetworkDoesNotExist(
+                'Network with id {} does not exist'.format(network_id))
+
+    netwrks = _deserialize_networks(netwrks.values(), client)
+    netwrks = dict((n.id, n) for n in netwrks)
+    return [NeutronPortInfo.deserialize(p, client, netwrks) for p in ports]
+
+
 def list_ports(mac_address, client):
     try:
         ports = client.list_ports(mac_address=mac_address)['ports']
-        ports = [NeutronPortInfo.deserialize(p, client) for p in ports]
-        return ports
+        return _deserialize_ports(ports, client)
     except neutron_exceptions.NeutronException as e:
         raise NeutronProvider.NetworkProviderException(str(e))
 
@@ -55,16 +127,20 @@ def get_network_info(network_id, client):
             raise NeutronProvider.NetworkProviderException(str(e))
 
 
-def get_subnet_info(subnet_id, client):
+def get_subnets(subnet_ids, client):
+    """Returns a dict of NeutronSubnetInfos by id for `subnet_ids`."""
     try:
-        subnet = client.show_subnet(subnet_id)['subnet']
-        return NeutronSubnetInfo.deserialize(subnet, client)
+        subnets = _list_by_ids(client.list_subnets, 'subnets', subnet_ids)
     except neutron_exceptions.NeutronException as e:
-        if '404 Not Found' in e.message:
+        raise NeutronProvider.NetworkProviderException(str(e))
+
+    for subnet_id in subnet_ids:
+        if subnet_id not in subnets:
             raise NeutronProvider.SubnetDoesNotExist(
                 'Subnet with id {} does not exist'.format(subnet_id))
-        else:
-            raise NeutronProvider.NetworkProviderException(str(e))
+
+    return dict((subnet_id, NeutronSubnetInfo.deserialize(subnet, client))
+                for subnet_id, subnet in subnets.iteritems())
 
 
 class NeutronSubnetInfo(base.SubnetInfo):
@@ -86,15 +162,20 @@ class NeutronSubnetInfo(base.SubnetInfo):
 class NeutronNetworkInfo(base.NetworkInfo):
 
     @classmethod
-    def deserialize(cls, body, client):
+    def deserialize(cls, body, client, subnets=None):
+        """Turn a Neutron network into a NeutronNetworkInfo. `subnets` may
+        be a dict of its NeutronSubnetInfos by id, which are otherwise
+        fetched.
+        """
         d = {
             'id': body.get('id'),
             'name': body.get('name'),
             'status': body.get('status')
         }
 
-        subnets = [get_subnet_info(s, client) for s in body.get('subnets')]
-        d['subnets'] = [s.serialize() for s in subnets]
+        if subnets is None:
+            subnets = get_subnets(body.get('subnets'), client)
+        d['subnets'] = [subnets[s].serialize() for s in body.get('subnets')]
 
         return cls(**d)
 
@@ -102,7 +183,11 @@ class NeutronNetworkInfo(base.NetworkInfo):
 class NeutronPortInfo(base.PortInfo):
 
     @classmethod
-    def deserialize(cls, body, client):
+    def deserialize(cls, body, client, networks=None):
+        """Turn a Neutron port into a NeutronPortInfo. `networks` may be a
+        dict of NeutronNetworkInfos by id including the port's network,
+        which is otherwise fetched.
+        """
         d = {
             'id': body.get('id'),
             'name': body.get('name'),
@@ -111,7 +196,10 @@ class NeutronPortInfo(base.PortInfo):
             'fixed_ips': body.get('fixed_ips')
         }
 
-        n = get_network_info(body.get('network_id'), client)
+        if networks is None:
+            n = get_network_info(body.get('network_id'), client)
+        else:
+            n = networks[body.get('network_id')]
         d['network'] = n.serialize()
 
         return cls(**d)
@@ -122,81 +210,201 @@ class NeutronProvider(base.BaseNetworkProvider):
     def __init__(self, config):
         super(NeutronProvider, self).__init__(config)
         self.log = structlog.get_logger()
+        self.network_cache = util.TTLCache(
+            config.PROVIDER_CACHE_TTL,
+            config.PROVIDER_CACHE_NEGATIVE_TTL,
+            config.PROVIDER_CACHE_SIZE)
+        self.client_pool = util.ClientPool(
+            self._get_neutron_client,
+            config.JOB_EXECUTION_THREADS,
+            expected_errors=(self.NetworkDoesNotExist,
+                             self.SubnetDoesNotExist))
 
     def _get_auth_token(self):
         try:
-            auth = keystone_client.Client(
-                username=self.config.KEYSTONE_USER,
-                password=self.config.KEYSTONE_PASS,
-                tenant_id=self.config.KEYSTONE_TENANT_ID,
-                auth_url=self.config.KEYSTONE_AUTH_URL)
-            return auth.auth_token
+            return keystone.get_auth_token(self.config)
         except keystone_exceptions.ClientException as e:
             raise self.NetworkProviderException(
                 'Cannot Initialize Keystone Client: {}'.format(str(e)))
 
-    def _get_neutron_client(self):
+    def _get_neutron_client(self, token=None):
         try:
-            return neutron_client.Client(self.config.NEUTRON_VERSION,
-                                         endpoint_url=self.config.NEUTRON_URL,
-                                         token=self._get_auth_token())
+            client = neutron_client.Client(
+                self.config.NEUTRON_VERSION,
+                endpoint_url=self.config.NEUTRON_URL,
+                token=token or self._get_auth_token())
         except neutron_exceptions.NeutronException as e:
             raise self.NetworkProviderException(
                 'Cannot Initialize Neutron Client: {}'.format(str(e)))
 
+        # when Neutron rejects the token, the client calls authenticate()
+        # and retries the request once. It has no credentials of its own,
+        # so hand it a new token from the shared cache instead.
+        client.httpclient.authenticate = functools.partial(
+            self._reauthenticate, client.httpclient)
+        return client
+
+    def _reauthenticate(self, httpclient):
+        keystone.invalidate_auth_token(self.config, httpclient.auth_token)
+        httpclient.auth_token = self._get_auth_token()
+
+    def _neutron_client(self):
+        """Context manager checking out a pooled Neutron client."""
+        return self.client_pool.get(self._get_auth_token())
+
     def attach(self, mac_address, network_id):
         """Attach a chassis to a given network_id."""
-        client = self._get_neutron_client()
-
         p = {
             'network_id': network_id,
             'admin_state_up': True,
             'mac_address': mac_address
         }
-        try:
-            self.log.info('attaching port', **{'mac_address': mac_address,
-                                               'network_id': network_id})
-            port = client.create_port({'port': p})['port']
-        except neutron_exceptions.NeutronException as e:
-            self.log.error('failed attaching port', exc=str(e))
-            raise self.NetworkProviderException(str(e))
-
-        return NeutronPortInfo.deserialize(port, client)
+        with self._neutron_client() as client:
+            try:
+                self.log.info('attaching port',
+                              **{'mac_address': mac_address,
+                                 'network_id': network_id})
+                port = client.create_port({'port': p})['port']
+            except neutron_exceptions.NeutronException as e:
+                self.log.error('failed attaching port', exc=str(e))
+                raise self.NetworkProviderException(str(e))
+
+            return NeutronPortInfo.deserialize(port, client)
 
     def detach(self, mac_address, network_id=None):
         """Detatch a mac_address from networks."""
-        client = self._get_neutron_client()
-
-        try:
-            list_args = {'mac_address': mac_address}
-            if network_id:
-                list_args['network_id'] = network_id
-
-            ports = client.list_ports(**list_args)['ports']
-
-            for port in ports:
+        with self._neutron_client() as client:
+            try:
+                list_args = {'mac_address': mac_address}
+                if network_id:
+                    list_args['network_id'] = network_id
+
+                ports = client.list_ports(**list_args)['ports']
+
+                for port in ports:
+                    self.log.info('detatching port',
+                                  **{'mac_address': port['mac_address'],
+                                     'port_id': port['id'],
+                                     'network_id': port['network_id']})
+                    client.delete_port(port['id'])
+
+            except neutron_exceptions.NeutronException as e:
+                self.log.error('failed detaching port', exc=str(e))
+                raise self.NetworkProviderException(str(e))
+
+    def delete_port(self, port_id):
+        """Delete the port with id `port_id`."""
+        with self._neutron_client() as client:
+            try:
+                self.log.info('deleting port', port_id=port_id)
+                client.delete_port(port_id)
+            except neutron_exceptions.NeutronException as e:
+                self.log.error('failed deleting port', exc=str(e))
+                raise self.NetworkProviderException(str(e))
+
+    def attach_many(self, mac_addresses, network_ids):
+        """Attach each of `mac_addresses` to each of `network_ids` with a
+        single bulk port create.
+        """
+        ports = [{'network_id': network_id,
+                  'admin_state_up': True,
+                  'mac_address': mac_address}
+                 for network_id in network_ids
+                 for mac_address in mac_addresses]
+        if not ports:
+            return []
+
+        with self._neutron_client() as client:
+            try:
+                self.log.info('attaching ports',
+                              mac_addresses=list(mac_addresses),
+                              network_ids=list(network_ids))
+                ports = client.create_port({'ports': ports})['ports']
+            except neutron_exceptions.NeutronException as e:
+                self.log.error('failed attaching ports', exc=str(e))
+                raise self.NetworkProviderException(str(e))
+
+            # the ports exist now, so don't leak them if they can't be
+            # described
+            try:
+                return _deserialize_ports(ports, client)
+            except neutron_exceptions.NeutronException as e:
+                self._delete_created_ports(ports, client)
+                raise self.NetworkProviderException(str(e))
+            except Exception:
+                self._delete_created_ports(ports, client)
+                raise
+
+    def _delete_created_ports(self, ports, client):
+        """Delete `ports`, which were created by a failed attach_many."""
+        for port in ports:
+            try:
+                self.log.info('deleting port created by failed attach',
+                              **{'mac_address': port['mac_address'],
+                                 'port_id': port['id'],
+                                 'network_id': port['network_id']})
+                client.delete_port(port['id'])
+            except neutron_exceptions.NeutronException as e:
+                self.log.error('failed deleting port', port_id=port['id'],
+                               exc=str(e))
+
+    def detach_many(self, mac_addresses, network_id=None):
+        """Detach each of `mac_addresses` from networks. Their ports are
+        listed with one request, then deleted concurrently, since Neutron
+        has no bulk delete.
+        """
+        mac_addresses = list(mac_addresses)
+        if not mac_addresses:
+            return
+
+        with self._neutron_client() as client:
+            try:
+                list_args = {'mac_address': mac_addresses}
+                if network_id:
+                    list_args['network_id'] = network_id
+
+                ports = client.list_ports(**list_args)['ports']
+            except neutron_exceptions.NeutronException as e:
+                self.log.error('failed detaching ports', exc=str(e))
+                raise self.NetworkProviderException(str(e))
+
+        outcomes = util.map_concurrently(self._delete_port,
+                                         ports,
+                                         self.config.NETWORK_PORT_THREADS)
+        errors = [error for _, error in outcomes if error is not None]
+        if errors:
+            raise self.PortOperationsFailed(errors)
+
+    def _delete_port(self, port):
+        # each thread checks out its own client, as they aren't thread-safe
+        with self._neutron_client() as client:
+            try:
                 self.log.info('detatching port',
                               **{'mac_address': port['mac_address'],
                                  'port_id': port['id'],
                                  'network_id': port['network_id']})
                 client.delete_port(port['id'])
-
-        except neutron_exceptions.NeutronException as e:
-            self.log.error('failed detaching port', exc=str(e))
-            raise self.NetworkProviderException(str(e))
+            except neutron_exceptions.NeutronException as e:
+                self.log.error('failed detaching port', exc=str(e))
+                raise self.NetworkProviderException(str(e))
 
     def list_ports(self, mac_address):
-        client = self._get_neutron_client()
-        return list_ports(mac_address, client)
+        with self._neutron_client() as client:
+            return list_ports(mac_address, client)
 
     def get_network_info(self, network_id):
-        client = self._get_neutron_client()
-        network = get_network_info(network_id, client)
-        return network
-
-    def list_networks(self):
-        client = self._get_neutron_client()
-        return list_networks(client)
+        def _load():
+            with self._neutron_client() as client:
+                return get_network_info(network_id, client)
+
+        return self.network_cache.get_or_load(
+            network_id,
+            _load,
+            missing=self.NetworkDoesNotExist)
+
+    def list_networks(self, marker=None, limit=None):
+        with self._neutron_client() as client:
+            return list_networks(client, marker, limit)
 
     def get_default_networks(self):
         return [self.config.NEUTRON_PUBLIC_NETWORK,
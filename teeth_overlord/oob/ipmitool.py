@@ -113,7 +113,7 @@ class IPMIToolProvider(base.BaseOutOfBandProvider):
         cmd = cmd + command.split(' ')
 
         try:
-            self.log.info('executing ipmi command', **log_dict)
+            self.log.debug('executing ipmi command', **log_dict)
             result = subprocess.check_output(cmd)
             self.log.info('finished ipmi command', result=result, **log_dict)
             return result
@@ -0,0 +1,165 @@
+"""
+Copyright 2013 Rackspace, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+import atexit
+import collections
+import os
+import signal
+import sys
+import threading
+import time
+
+import structlog
+
+
+# Sending this signal to a teeth process toggles its profiler.
+PROFILER_SIGNAL = signal.SIGUSR2
+
+# Rewrite the output file this often (in seconds) while profiling, so that
+# long-running profiles survive the process being killed.
+WRITE_INTERVAL = 60
+
+# Deeper stacks are truncated, keeping the frames nearest the leaf, which
+# is where the sampled time is being spent.
+MAX_STACK_DEPTH = 128
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return '{} ({}:{})'.format(code.co_name,
+                               code.co_filename,
+                               code.co_firstlineno)
+
+
+class SamplingProfiler(object):
+    """Samples the stacks of every thread in the process every `interval`
+    seconds, counting how often each distinct stack is seen. Profiles are
+    written to `output_dir` in the collapsed stack format understood by
+    flamegraph.pl: one `root;...;leaf count` line per stack.
+
+    The cost is a walk of each thread's stack per sample, so with an
+    interval in the tens of milliseconds it can be left running.
+    """
+    def __init__(self, name, interval, output_dir):
+        self.name = name
+        self.interval = interval
+        self.output_dir = output_dir
+        self.log = structlog.get_logger(profiler=name)
+        self.stacks = collections.Counter()
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = None
+        self.started_at = None
+
+    @property
+    def running(self):
+        return self.thread is not None
+
+    def start(self):
+        """Start sampling, unless already sampling."""
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.stacks.clear()
+            self.started_at = time.time()
+            self.stopping.clear()
+            self.thread = threading.Thread(target=self._run)
+            self.thread.daemon = True
+            self.thread.start()
+        self.log.info('started profiler', interval=self.interval)
+
+    def stop(self):
+        """Stop sampling, writing out the profile. Returns the path it was
+        written to, or None if the profiler wasn't running.
+        """
+        with self.lock:
+            thread, self.thread = self.thread, None
+            if thread is None:
+                return None
+            self.stopping.set()
+        thread.join()
+        path = self.write()
+        self.log.info('stopped profiler', path=path)
+        return path
+
+    def toggle(self):
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+
+    def get_path(self):
+        filename = '{}-{}-{}.folded'.format(self.name,
+                                            os.getpid(),
+                                            int(self.started_at))
+        return os.path.join(self.output_dir, filename)
+
+    def write(self):
+        """Write the profile gathered so far, returning its path."""
+        path = self.get_path()
+        with self.lock:
+            stacks = self.stacks.items()
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            for stack, count in stacks:
+                f.write('{} {}\n'.format(stack, count))
+        os.rename(tmp_path, path)
+        return path
+
+    def sample(self, ignore_thread=None):
+        """Record the current stack of every thread, except
+        `ignore_thread`'s.
+        """
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == ignore_thread:
+                continue
+            names = []
+            while frame is not None and len(names) < MAX_STACK_DEPTH:
+                names.append(_frame_name(frame))
+                frame = frame.f_back
+            names.reverse()
+            self.stacks[';'.join(names)] += 1
+
+    def _run(self):
+        thread_id = threading.current_thread().ident
+        last_write = time.time()
+        while not self.stopping.wait(self.interval):
+            try:
+                self.sample(ignore_thread=thread_id)
+                if time.time() - last_write >= WRITE_INTERVAL:
+                    self.write()
+                    last_write = time.time()
+            except Exception as e:
+                self.log.error('error sampling stacks', exception=e)
+
+
+def get_profiler(config, name):
+    """Gets a profiler for the process named `name`."""
+    return SamplingProfiler(name,
+                            config.PROFILER_INTERVAL,
+                            config.PROFILER_OUTPUT_DIR)
+
+
+def install(profiler, config):
+    """Let `PROFILER_SIGNAL` toggle `profiler` and make sure its profile is
+    written on exit, starting it if enabled in `config`. Must be called from
+    the main thread.
+    """
+    signal.signal(PROFILER_SIGNAL, lambda signum, frame: profiler.toggle())
+    atexit.register(profiler.stop)
+    if config.PROFILER_ENABLED:
+        profiler.start()
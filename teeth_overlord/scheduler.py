@@ -20,13 +20,20 @@ import cqlengine
 import structlog
 
 from teeth_overlord import errors
+from teeth_overlord import locks
 from teeth_overlord import models
 
 
+# Don't wait on another reservation's (or the precache job's) lock on a
+# chassis for longer than this, as there are usually others to choose from.
+CHASSIS_LOCK_TIMEOUT = 5
+
+
 class TeethInstanceScheduler(object):
     """Schedule instances onto chassis."""
-    def __init__(self):
+    def __init__(self, config):
         self.log = structlog.get_logger()
+        self.lock_manager = locks.get_lock_manager(config)
 
     def reserve_chassis(self, instance, retry=True):
         """Locate and reserve a chassis for the specified instance."""
@@ -59,6 +66,14 @@ class TeethInstanceScheduler(object):
                                   reverse=True)
 
         for flavor_provider in flavor_providers:
+            # Prefer chassis whose agent already has the image cached, so
+            # that it is written from local disk rather than downloaded.
+            chassis = self._retrieve_warm_chassis(
+                flavor_provider.chassis_model_id,
+                instance.image_id)
+            if chassis:
+                return chassis
+
             chassis_list = models.Chassis.objects
             chassis_list = chassis_list.filter(state=models.ChassisState.READY)
             chassis_list = chassis_list.filter(
@@ -71,28 +86,61 @@ class TeethInstanceScheduler(object):
 
         raise errors.InsufficientCapacityError()
 
+    def _retrieve_warm_chassis(self, chassis_model_id, image_id):
+        """Retrieve a random READY chassis of `chassis_model_id` whose
+        agent has `image_id` cached, or None if there isn't one. Lookup
+        rows which no longer match their chassis are deleted as they are
+        found, so that they aren't picked again.
+        """
+        rows = list(models.ChassisByCachedImage.objects.filter(
+            state=models.ChassisState.READY,
+            chassis_model_id=chassis_model_id,
+            cached_image_id=image_id))
+        random.shuffle(rows)
+
+        for row in rows:
+            try:
+                chassis = models.Chassis.objects.get(id=row.chassis_id)
+            except models.Chassis.DoesNotExist:
+                chassis = None
+
+            if (chassis is not None and
+                    chassis.state == models.ChassisState.READY and
+                    chassis.chassis_model_id == chassis_model_id and
+                    chassis.cached_image_id == image_id):
+                return chassis
+
+            # If the chassis changes back in the meantime this loses its
+            # row, which only costs it its preference until its next save.
+            self.log.info('deleting stale cached image lookup row',
+                          chassis_id=row.chassis_id,
+                          image_id=image_id)
+            row.delete()
+
+        return None
+
     def _mark_chassis_reserved(self, chassis, instance):
         """Mark the selected chassis as belonging to this instance, and
         put it into a `BUILD` state.
         """
-        # TODO(russellhaering): Lock around instance reservation
-        # self.lock_manager.lock('/chassis/{chassis_id}'.format(
-        #     chassis_id=str(chassis.id)
-        # ))
-
-        # Re-fetch the chassis while we hold the lock
-        chassis = models.Chassis.objects.filter(id=chassis.id).get()
-
-        if chassis.state != models.ChassisState.READY:
+        lock_key = '/chassis/{}'.format(chassis.id)
+        try:
+            with self.lock_manager.acquire(lock_key,
+                                           timeout=CHASSIS_LOCK_TIMEOUT):
+                # Re-fetch the chassis while we hold the lock
+                chassis = models.Chassis.objects.filter(id=chassis.id).get()
+
+                if chassis.state != models.ChassisState.READY:
+                    raise errors.ChassisAlreadyReservedError(chassis)
+
+                batch = cqlengine.BatchQuery()
+                instance.chassis_id = chassis.id
+                instance.state = models.InstanceState.INACTIVE
+                instance.batch(batch).save()
+                chassis.state = models.ChassisState.BUILD
+                chassis.batch(batch).save()
+                batch.execute()
+        except locks.LockNotAcquired:
             raise errors.ChassisAlreadyReservedError(chassis)
 
-        batch = cqlengine.BatchQuery()
-        instance.chassis_id = chassis.id
-        instance.state = models.InstanceState.INACTIVE
-        instance.batch(batch).save()
-        chassis.state = models.ChassisState.BUILD
-        chassis.batch(batch).save()
-        batch.execute()
-
-        # TODO(russellhaering): unlock
         return chassis
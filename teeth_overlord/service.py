@@ -14,8 +14,15 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import atexit
+import collections
+import functools
+import Queue
+import random
+import re
 import signal
 import string
+import sys
 import threading
 import traceback
 
@@ -23,6 +30,9 @@ from cqlengine import connection
 import structlog
 
 from teeth_overlord import config as teeth_config
+from teeth_overlord import profiler
+from teeth_overlord import stats
+from teeth_overlord import util
 
 # Sometimes global setup is necessary. Make sure that if we try to do it twice:
 #   a. We don't actually do it twice
@@ -31,38 +41,252 @@ _global_config = None
 
 EXCEPTION_LOG_METHODS = ['error']
 
+# Numeric severity of each logger method, used to drop events below the
+# configured LOG_LEVEL before doing any other processing. Methods which
+# aren't listed (such as `msg`) are treated as `info`.
+LOG_LEVELS = {
+    'debug': 10,
+    'info': 20,
+    'warn': 30,
+    'warning': 30,
+    'err': 40,
+    'error': 40,
+    'exception': 40,
+    'critical': 50,
+}
+
+# Log events are mostly formatted from a handful of literal strings, so
+# parsed templates are cached by event string. Cap the cache in case events
+# are built dynamically.
+FORMAT_CACHE_SIZE = 1024
+
+# Parsed templates, keyed by event string: None for events with nothing to
+# format, otherwise a list of (literal, field name) pairs.
+_format_cache = {}
+
+# Cached for templates which use anything besides plain `{name}` fields,
+# which are formatted with a string.Formatter instead.
+_COMPLEX_TEMPLATE = object()
+
+
+def _get_level_filter(level):
+    """Returns a processor dropping events logged below `level`."""
+    min_level = LOG_LEVELS[level]
+
+    def _filter_level(logger, method, event):
+        if LOG_LEVELS.get(method, LOG_LEVELS['info']) < min_level:
+            raise structlog.DropEvent
+        return event
+    return _filter_level
+
+
+class LogThrottle(object):
+    """Processor keeping the volume of high-frequency events bounded.
+    `sample_rates` maps event strings to the fraction of those events to
+    keep, and `rate_limits` maps event strings to `[rate, burst]` pairs
+    for a token bucket allowing `rate` events per second.
+
+    Suppressed events are counted as `<reason>.<event>` stats, and the next
+    event of the same kind that is logged carries a `suppressed` count.
+    """
+    def __init__(self, sample_rates, rate_limits, stats_client):
+        self.sample_rates = sample_rates
+        self.buckets = dict((event, util.TokenBucket(rate, burst))
+                            for event, (rate, burst)
+                            in rate_limits.iteritems())
+        self.stats_client = stats_client
+        self.suppressed = collections.defaultdict(int)
+        self.lock = threading.Lock()
+
+    def __call__(self, logger, method, event):
+        key = event.get('event')
+        if not isinstance(key, basestring):
+            return event
+
+        rate = self.sample_rates.get(key)
+        if rate is not None and random.random() >= rate:
+            self._suppress(key, 'sampled')
+
+        bucket = self.buckets.get(key)
+        if bucket is not None and not bucket.consume():
+            self._suppress(key, 'rate_limited')
+
+        if key in self.suppressed:
+            with self.lock:
+                suppressed = self.suppressed.pop(key, 0)
+            if suppressed:
+                event['suppressed'] = suppressed
+        return event
+
+    def _suppress(self, key, reason):
+        with self.lock:
+            self.suppressed[key] += 1
+        stat = _STAT_UNSAFE_CHARS.sub('_', key)
+        self.stats_client.incr('{}.{}'.format(reason, stat))
+        raise structlog.DropEvent
+
+
+_STAT_UNSAFE_CHARS = re.compile('[^a-zA-Z0-9_-]+')
+
 
 def _capture_stack_trace(logger, method, event):
-    if method in EXCEPTION_LOG_METHODS:
+    if method in EXCEPTION_LOG_METHODS and sys.exc_info()[0] is not None:
         event['exception'] = traceback.format_exc()
     return event
 
 
+def _parse_template(template):
+    """Parse `template` into (literal, field name) pairs, or return None if
+    there is nothing to format, or _COMPLEX_TEMPLATE if it uses format specs,
+    conversions, attribute/index access or positional fields.
+    """
+    parts = []
+    for literal, field, spec, conversion in string.Formatter().parse(template):
+        if field is None:
+            parts.append((literal, None))
+            continue
+        if spec or conversion or not field or not _is_identifier(field):
+            return _COMPLEX_TEMPLATE
+        parts.append((literal, field))
+
+    if all(field is None for literal, field in parts):
+        # unless there were escaped braces, the template is the event
+        literals = ''.join(literal for literal, field in parts)
+        if literals == template:
+            return None
+    return parts
+
+
+def _is_identifier(field):
+    return field.replace('_', 'a').isalnum() and not field[0].isdigit()
+
+
+def _get_template(template):
+    try:
+        return _format_cache[template]
+    except KeyError:
+        parts = _parse_template(template)
+        if len(_format_cache) < FORMAT_CACHE_SIZE:
+            _format_cache[template] = parts
+        return parts
+
+
 def _format_event(logger, method, event):
     """Formats the log message using keyword args.
     log('hello {keyword}', keyword='world') should log: "hello world"
-    Removes the keywords used for formatting from the logged message.
     Throws a KeyError if the log message requires formatting but doesn't
     have enough keys to format.
     """
     if 'event' not in event:
         # nothing to format, e.g. _log_request in teeth_rest/component
         return event
-    # Get a list of fields that need to be filled.
-    formatter = string.Formatter()
+
+    template = event['event']
+    if not isinstance(template, basestring):
+        return event
+
+    parts = _get_template(template)
+    if parts is None:
+        return event
+
+    if parts is _COMPLEX_TEMPLATE:
+        formatter = string.Formatter()
+        try:
+            event['event'] = formatter.format(template, **event)
+        except KeyError:
+            keys = [item[1] for item in formatter.parse(template)]
+            _raise_missing_keys(keys, event)
+        return event
+
     try:
-        formatted = formatter.format(event['event'], **event)
+        event['event'] = ''.join(
+            literal if field is None else literal + format(event[field])
+            for literal, field in parts)
     except KeyError:
-        keys = formatter.parse(event['event'])
-        # index 1 is the key name
-        keys = [item[1] for item in keys]
-        missing_keys = list(set(keys) - set(event))
-        raise KeyError("Log formatter missing keys: {}, cannot format."
-                       .format(missing_keys))
-    event['event'] = formatted
+        _raise_missing_keys([field for literal, field in parts], event)
     return event
 
 
+def _raise_missing_keys(keys, event):
+    missing_keys = list(set(keys) - set(event) - set([None]))
+    raise KeyError("Log formatter missing keys: {}, cannot format."
+                   .format(missing_keys))
+
+
+class AsyncLogWriter(object):
+    """Renders and writes log events from a background thread, so that
+    callers only pay for queueing them. When more than `queue_size` events
+    are waiting, further events are dropped (and counted) rather than
+    blocking the caller.
+    """
+    def __init__(self, renderer, queue_size, file=None):
+        self.renderer = renderer
+        self.file = file or sys.stdout
+        self.queue = Queue.Queue(queue_size)
+        self.dropped = 0
+        self.dropped_lock = threading.Lock()
+        self.thread = threading.Thread(target=self._write_events)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def log(self, method, event):
+        try:
+            self.queue.put_nowait((method, event))
+        except Queue.Full:
+            with self.dropped_lock:
+                self.dropped += 1
+
+    def _write_events(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            self._write(*item)
+
+            if self.queue.empty():
+                self._write_dropped()
+                self.file.flush()
+        # stopping may have kept the queue from ever running dry
+        self._write_dropped()
+        self.file.flush()
+
+    def _write(self, method, event):
+        try:
+            message = self.renderer(None, method, event)
+        except Exception:
+            message = repr(event)
+        self.file.write(message + '\n')
+
+    def _write_dropped(self):
+        with self.dropped_lock:
+            dropped, self.dropped = self.dropped, 0
+        if dropped:
+            self._write('warning', {'event': 'log queue full, dropped events',
+                                    'dropped': dropped})
+
+    def stop(self):
+        """Write out any queued events and stop the writer thread."""
+        self.queue.put(None)
+        self.thread.join()
+
+
+class AsyncLogger(object):
+    """Logger handing processed event dicts to an `AsyncLogWriter`."""
+    def __init__(self, writer):
+        self.writer = writer
+
+    def __getattr__(self, method):
+        return functools.partial(self._log, method)
+
+    def _log(self, method, event):
+        self.writer.log(method, event)
+
+
+def _defer_rendering(logger, method, event):
+    """Final processor handing the event dict itself to the logger."""
+    return (event,), {}
+
+
 def global_setup(config):
     """Perform global cofiguration. In a given process, this should only
     ever be called with a single configuration instance. Doing otherwise
@@ -75,25 +299,48 @@ def global_setup(config):
         connection.setup([str(v) for v in config.CASSANDRA_CLUSTER],
                          consistency=config.CASSANDRA_CONSISTENCY)
 
+        throttle = LogThrottle(config.LOG_SAMPLE_RATES,
+                               config.LOG_RATE_LIMITS,
+                               stats.get_stats_client(config, 'logging'))
         processors = [
+            _get_level_filter(config.LOG_LEVEL),
+            throttle,
             _capture_stack_trace,
             _format_event,
         ]
 
         if config.PRETTY_LOGGING:
-            processors.append(structlog.processors.ExceptionPrettyPrinter())
-            processors.append(structlog.processors.KeyValueRenderer())
+            renderers = [structlog.processors.ExceptionPrettyPrinter(),
+                         structlog.processors.KeyValueRenderer()]
         else:
-            processors.append(structlog.processors.JSONRenderer())
+            renderers = [structlog.processors.JSONRenderer()]
 
-        structlog.configure(
-            processors=processors
-        )
+        if config.LOG_ASYNC:
+            # render on the writer thread rather than the caller's
+            writer = AsyncLogWriter(_chain(renderers), config.LOG_QUEUE_SIZE)
+            atexit.register(writer.stop)
+            logger = AsyncLogger(writer)
+            structlog.configure(
+                processors=processors + [_defer_rendering],
+                logger_factory=lambda *args: logger
+            )
+        else:
+            structlog.configure(
+                processors=processors + renderers
+            )
     elif _global_config != config:
         raise Exception('global_setup called twice with different '
                         'configurations')
 
 
+def _chain(processors):
+    def _process(logger, method, event):
+        for processor in processors:
+            event = processor(logger, method, event)
+        return event
+    return _process
+
+
 class TeethServiceRunner(object):
     """Instantiate and run a SynchronousTeethService."""
 
@@ -102,6 +349,7 @@ class TeethServiceRunner(object):
         self.signal_map = {
             signal.SIGTERM: self._terminate,
             signal.SIGINT: self._terminate,
+            profiler.PROFILER_SIGNAL: self._toggle_profiler,
         }
 
     def run(self):
@@ -114,18 +362,26 @@ class TeethServiceRunner(object):
     def _terminate(self, signum, frame):
         self.service.stop()
 
+    def _toggle_profiler(self, signum, frame):
+        self.service.profiler.toggle()
+
 
 class SynchronousTeethService(object):
     """Base class for all Teeth services."""
     def __init__(self, config):
         self.config = config
         self.stopping = threading.Event()
+        self.profiler = profiler.get_profiler(config,
+                                              self.__class__.__name__)
 
     def run(self):
         """Run the service to completion."""
         global_setup(self.config)
         self.stopping.clear()
+        if self.config.PROFILER_ENABLED:
+            self.profiler.start()
 
     def stop(self):
         """Attempt to gracefully stop."""
         self.stopping.set()
+        self.profiler.stop()
@@ -14,10 +14,23 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import atexit
+import bisect
+import collections
+import contextlib
 import functools
+import re
 import threading
+import time
+import weakref
 
 import statsd
+from statsd import client as statsd_client
+import structlog
+
+
+# statsd servers generally drop datagrams larger than this
+MAX_PACKET_SIZE = 512
 
 
 class NoopStatsClient(object):
@@ -29,11 +42,145 @@ class NoopStatsClient(object):
     timing = _noop
     gauge = _noop
     set = _noop
+    send = _noop
+
+    def timer(self, stat, rate=1):
+        """Returns a timer usable as a context manager or decorator, which
+        reports to this (noop) client.
+        """
+        return statsd_client.Timer(self, stat, rate)
+
+    def pipeline(self):
+        """Returns a noop pipeline, which is just this client."""
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.send()
+
+
+class StatsBuffer(object):
+    """Collects metrics from any number of `BufferedStatsClient` instances
+    and sends them to statsd in batched, newline-separated packets, either
+    every `flush_interval` seconds or once `max_buffered` metrics are
+    pending, whichever comes first.
+
+    Counters are aggregated in memory, so incrementing the same stat many
+    times between flushes costs a single line on the wire. Gauges only keep
+    the latest value. Everything else is sent as-is.
+    """
+    def __init__(self, host, port, flush_interval, max_buffered):
+        self.log = structlog.get_logger()
+        self.client = statsd.StatsClient(host, port)
+        self.flush_interval = flush_interval
+        self.max_buffered = max_buffered
+        self.lock = threading.Lock()
+        self.counters = collections.OrderedDict()
+        self.gauges = collections.OrderedDict()
+        self.lines = []
+        self.event = threading.Event()
+        self.thread = threading.Thread(target=self._flush_periodically)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _pending(self):
+        return len(self.counters) + len(self.gauges) + len(self.lines)
+
+    def incr(self, stat, count):
+        with self.lock:
+            self.counters[stat] = self.counters.get(stat, 0) + count
+            full = self._pending() >= self.max_buffered
+        if full:
+            self.flush()
+
+    def gauge(self, stat, value):
+        with self.lock:
+            self.gauges[stat] = value
+            full = self._pending() >= self.max_buffered
+        if full:
+            self.flush()
+
+    def append(self, data):
+        with self.lock:
+            self.lines.append(data)
+            full = self._pending() >= self.max_buffered
+        if full:
+            self.flush()
+
+    def flush(self):
+        """Send all pending metrics."""
+        with self.lock:
+            counters, self.counters = self.counters, collections.OrderedDict()
+            gauges, self.gauges = self.gauges, collections.OrderedDict()
+            lines, self.lines = self.lines, []
+
+        lines.extend('{}:{}|c'.format(stat, count)
+                     for stat, count in counters.iteritems())
+        lines.extend('{}:{}|g'.format(stat, value)
+                     for stat, value in gauges.iteritems())
+
+        for packet in _pack(lines, MAX_PACKET_SIZE):
+            self.client._send(packet)
 
-    # TODO(jimrollenhagen) implement timer (context manager and decorater)
-    # TODO(jimrollenhagen) implement pipeline noop (context manager and method)
-    # TODO(jimrollenhagen) implement send (method, sends pipelined commands)
-    # (we aren't using any of these yet)
+    def _flush_periodically(self):
+        while not self.event.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                self.log.error('error flushing stats', exception=e)
+
+    def stop(self):
+        self.event.set()
+        self.flush()
+
+
+def _pack(lines, max_size):
+    """Joins `lines` into as few newline-separated packets of at most
+    `max_size` bytes as possible, preserving order.
+    """
+    packet = None
+    for line in lines:
+        if packet is None:
+            packet = line
+        elif len(packet) + len(line) + 1 > max_size:
+            yield packet
+            packet = line
+        else:
+            packet = '{}\n{}'.format(packet, line)
+    if packet is not None:
+        yield packet
+
+
+class BufferedStatsClient(statsd.StatsClient):
+    """A statsd client which hands metrics to a shared `StatsBuffer` rather
+    than sending a datagram per metric.
+    """
+    def __init__(self, buffer, prefix=None):
+        self._buffer = buffer
+        self._prefix = prefix
+
+    def _after(self, data):
+        self._buffer.append(data)
+
+    def _prefixed(self, stat):
+        if self._prefix:
+            return '{}.{}'.format(self._prefix, stat)
+        return stat
+
+    def incr(self, stat, count=1, rate=1):
+        # sampled counters have to be sent with their rate
+        if rate < 1:
+            return super(BufferedStatsClient, self).incr(stat, count, rate)
+        self._buffer.incr(self._prefixed(stat), count)
+
+    def gauge(self, stat, value, rate=1, delta=False):
+        # deltas can't be collapsed into the latest value
+        if delta or rate < 1:
+            return super(BufferedStatsClient, self).gauge(stat, value, rate,
+                                                          delta)
+        self._buffer.gauge(self._prefixed(stat), value)
 
 
 class ConcurrencyGauge(object):
@@ -71,27 +218,289 @@ class ConcurrencyGauge(object):
         self.client.gauge(self.name, self.value)
 
 
+# Upper bounds, in milliseconds, of the histogram buckets timings are counted
+# in by the metrics registry. Anything slower lands in the implicit +Inf
+# bucket.
+HISTOGRAM_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000,
+                     30000, 60000)
+
+
+class _MetricsShard(object):
+    """Metrics recorded by a single thread."""
+    def __init__(self):
+        self.counters = {}
+        # name -> [count per bucket..., sum, count]
+        self.histograms = {}
+
+    def merge(self, shard):
+        """Add the metrics recorded in `shard` to this one."""
+        # items() copies atomically, the owning thread may be recording
+        for name, count in shard.counters.items():
+            self.counters[name] = self.counters.get(name, 0) + count
+        for name, histogram in shard.histograms.items():
+            merged = self.histograms.setdefault(name, [0] * len(histogram))
+            for i, value in enumerate(list(histogram)):
+                merged[i] += value
+
+
+class MetricsRegistry(object):
+    """Keeps counters, gauges and fixed-bucket histograms in process so
+    they can be scraped, independently of whether statsd is reachable.
+
+    Counters and histograms are recorded in a shard owned by the recording
+    thread, so recording never takes a lock; shards are only merged when
+    the registry is rendered. Once a thread exits its shard is folded into
+    a retired shard, so short-lived threads don't each leave one behind.
+    """
+    def __init__(self, buckets=HISTOGRAM_BUCKETS):
+        self.buckets = buckets
+        self._local = threading.local()
+        # (weakref to the owning thread, shard) pairs
+        self._shards = []
+        self._retired = _MetricsShard()
+        self._shards_lock = threading.Lock()
+        self._gauges = {}
+        self._gauges_lock = threading.Lock()
+
+    def _get_shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = _MetricsShard()
+            thread = weakref.ref(threading.current_thread())
+            with self._shards_lock:
+                self._retire_shards()
+                self._shards.append((thread, shard))
+            self._local.shard = shard
+            return shard
+
+    def _retire_shards(self):
+        """Fold the shards of threads which have exited into the retired
+        shard. Must be called with the shards lock held.
+        """
+        live = []
+        for thread, shard in self._shards:
+            thread = thread()
+            if thread is not None and thread.is_alive():
+                live.append((weakref.ref(thread), shard))
+            else:
+                self._retired.merge(shard)
+        self._shards = live
+
+    def incr(self, name, count=1):
+        counters = self._get_shard().counters
+        counters[name] = counters.get(name, 0) + count
+
+    def gauge(self, name, value, delta=False):
+        if not delta:
+            self._gauges[name] = value
+            return
+        with self._gauges_lock:
+            self._gauges[name] = self._gauges.get(name, 0) + value
+
+    def timing(self, name, ms):
+        histograms = self._get_shard().histograms
+        histogram = histograms.get(name)
+        if histogram is None:
+            histogram = [0] * (len(self.buckets) + 3)
+            histograms[name] = histogram
+        histogram[bisect.bisect_left(self.buckets, ms)] += 1
+        histogram[-2] += ms
+        histogram[-1] += 1
+
+    def snapshot(self):
+        """Returns merged `(counters, gauges, histograms)` dicts. Histograms
+        are `(cumulative bucket counts, sum, count)` tuples, the last bucket
+        count being the +Inf bucket.
+        """
+        merged = _MetricsShard()
+        with self._shards_lock:
+            self._retire_shards()
+            merged.merge(self._retired)
+            shards = [shard for thread, shard in self._shards]
+
+        for shard in shards:
+            merged.merge(shard)
+
+        counters = merged.counters
+        histograms = merged.histograms
+        for name, histogram in histograms.items():
+            histograms[name] = (list(_accumulate(histogram[:-2])),
+                                histogram[-2],
+                                histogram[-1])
+
+        return counters, dict(self._gauges), histograms
+
+    def render(self):
+        """Renders the registry in the Prometheus text exposition format."""
+        counters, gauges, histograms = self.snapshot()
+        lines = []
+        for name, value in sorted(counters.iteritems()):
+            name = _metric_name(name)
+            lines.append('# TYPE {} counter'.format(name))
+            lines.append('{} {}'.format(name, value))
+        for name, value in sorted(gauges.iteritems()):
+            name = _metric_name(name)
+            lines.append('# TYPE {} gauge'.format(name))
+            lines.append('{} {}'.format(name, value))
+        for name, (buckets, total, count) in sorted(histograms.iteritems()):
+            name = _metric_name(name)
+            lines.append('# TYPE {} histogram'.format(name))
+            bounds = [str(b) for b in self.buckets] + ['+Inf']
+            for bound, value in zip(bounds, buckets):
+                line = '{}_bucket{{le="{}"}} {}'.format(name, bound, value)
+                lines.append(line)
+            lines.append('{}_sum {}'.format(name, total))
+            lines.append('{}_count {}'.format(name, count))
+        lines.append('')
+        return '\n'.join(lines)
+
+
+def _accumulate(values):
+    total = 0
+    for value in values:
+        total += value
+        yield total
+
+
+def _metric_name(name):
+    return _INVALID_METRIC_CHARS.sub('_', name)
+
+
+_INVALID_METRIC_CHARS = re.compile('[^a-zA-Z0-9_:]')
+
+# the registry every stats client in this process records into
+registry = MetricsRegistry()
+
+
+class RecordingStatsClient(object):
+    """Wraps a statsd client, recording every metric sent through it into a
+    `MetricsRegistry` as well.
+
+    A sample `rate` only applies to what the statsd client sends, since
+    statsd scales sampled metrics back up itself. The registry records
+    every call whatever its rate, so its counts are exact rather than
+    sampled, and aren't scaled.
+    """
+    def __init__(self, client, registry, prefix=None):
+        self._client = client
+        self._registry = registry
+        self._prefix = prefix
+
+    def _prefixed(self, stat):
+        if self._prefix:
+            return '{}.{}'.format(self._prefix, stat)
+        return stat
+
+    def incr(self, stat, count=1, rate=1):
+        self._registry.incr(self._prefixed(stat), count)
+        self._client.incr(stat, count, rate)
+
+    def decr(self, stat, count=1, rate=1):
+        self.incr(stat, -count, rate)
+
+    def timing(self, stat, delta, rate=1):
+        self._registry.timing(self._prefixed(stat), delta)
+        self._client.timing(stat, delta, rate)
+
+    def gauge(self, stat, value, rate=1, delta=False):
+        self._registry.gauge(self._prefixed(stat), value, delta)
+        self._client.gauge(stat, value, rate, delta)
+
+    def set(self, stat, value, rate=1):
+        # sets aren't kept in the registry
+        self._client.set(stat, value, rate)
+
+    def timer(self, stat, rate=1):
+        return statsd_client.Timer(self, stat, rate)
+
+    def pipeline(self):
+        # each metric is handed to the underlying client straight away, and
+        # get_stats_client's clients already batch them
+        return self
+
+    def send(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.send()
+
+
 def get_stats_client(config, prefix=None):
     """Gets statsd client with additional prefix.
     For example, if the config prefix is 'teeth' and 'api' is passed in,
-    the prefix would be teeth.api.
+    the prefix would be teeth.api. Everything sent through the client is
+    also recorded in the process's metrics `registry`.
     """
     if prefix is not None:
         prefix = '{0}.{1}'.format(config.STATSD_PREFIX, prefix)
     else:
         prefix = config.STATSD_PREFIX
 
+    return RecordingStatsClient(_get_statsd_client(config, prefix),
+                                registry,
+                                prefix=prefix)
+
+
+def _get_statsd_client(config, prefix):
     if not config.STATSD_ENABLED:
         return NoopStatsClient()
 
-    return statsd.StatsClient(config.STATSD_HOST,
+    if not config.STATSD_FLUSH_INTERVAL:
+        return statsd.StatsClient(config.STATSD_HOST,
+                                  config.STATSD_PORT,
+                                  prefix=prefix)
+
+    return BufferedStatsClient(_get_stats_buffer(config), prefix=prefix)
+
+
+_stats_buffers = {}
+_stats_buffers_lock = threading.Lock()
+
+
+def _get_stats_buffer(config):
+    """Gets the `StatsBuffer` shared by every buffered client in this
+    process which sends to the configured statsd server.
+    """
+    key = (config.STATSD_HOST, config.STATSD_PORT)
+    with _stats_buffers_lock:
+        if key not in _stats_buffers:
+            buf = StatsBuffer(config.STATSD_HOST,
                               config.STATSD_PORT,
-                              prefix=prefix)
+                              config.STATSD_FLUSH_INTERVAL,
+                              config.STATSD_MAX_BUFFERED)
+            atexit.register(buf.stop)
+            _stats_buffers[key] = buf
+        return _stats_buffers[key]
+
+
+@contextlib.contextmanager
+def timed_stat(client, key):
+    """Context manager which increments `key.success` or `key.error`
+    depending on whether the block raises, and records how long it took as
+    the `key.time` timing (in milliseconds), from which statsd derives
+    percentiles.
+    """
+    start = time.time()
+    try:
+        yield
+    except Exception:
+        client.incr('{}.error'.format(key))
+        raise
+    else:
+        client.incr('{}.success'.format(key))
+    finally:
+        client.timing('{}.time'.format(key),
+                      int(round((time.time() - start) * 1000)))
 
 
 def incr_stat(key):
-    """Decorator that increments a stat with the given key. Decorated function
-    must be a bound method on a class that has a stats_client attribute.
+    """Decorator that increments a stat with the given key, and times the
+    call, using `timed_stat`. Decorated function must be a bound method on a
+    class that has a stats_client attribute.
     """
     # TODO(jimrollenhagen) what about the case where e.g. no chassis available
     # to create an instance?  this won't raise an exception (right?), but
@@ -100,14 +509,7 @@ def incr_stat(key):
     def incr_decorator(func):
         @functools.wraps(func)
         def wrapper(self, *args, **kwargs):
-            client = self.stats_client
-            try:
-                ret = func(self, *args, **kwargs)
-            except Exception:
-                client.incr('{}.error'.format(key))
-                raise
-            else:
-                client.incr('{}.success'.format(key))
-                return ret
+            with timed_stat(self.stats_client, key):
+                return func(self, *args, **kwargs)
         return wrapper
     return incr_decorator
@@ -34,6 +34,11 @@ TEST_CONFIG = {
 
     "PUBLIC_API_HOST": "0.0.0.0",
     "PUBLIC_API_PORT": 8080,
+    "PUBLIC_API_THREADS": 64,
+
+    "WATCH_TIMEOUT": 30,
+    "WATCH_POLL_INTERVAL": 1.0,
+    "WATCH_MAX_WAITERS": 32,
 
     "AGENT_API_HOST": "0.0.0.0",
     "AGENT_API_PORT": 8081,
@@ -48,6 +53,11 @@ TEST_CONFIG = {
     "MAX_INSTANCE_FILE_SIZE": 4096,
 
     "JOB_EXECUTION_THREADS": 16,
+    "IMAGE_PRECACHE_INTERVAL": 300,
+    "IMAGE_PRECACHE_DAYS": 7,
+    "IMAGE_PRECACHE_COUNT": 3,
+    "JOB_EXECUTOR_METRICS_HOST": "127.0.0.1",
+    "JOB_EXECUTOR_METRICS_PORT": 8082,
 
     "MARCONI_URL": "http://localhost:8888",
 
@@ -55,13 +65,31 @@ TEST_CONFIG = {
     "OOB_PROVIDER": "fake",
     "AGENT_CLIENT": "fake",
     "NETWORK_PROVIDER": "fake",
+    "NETWORK_PORT_THREADS": 8,
+    "PROVIDER_CACHE_TTL": 60,
+    "PROVIDER_CACHE_NEGATIVE_TTL": 5,
+    "PROVIDER_CACHE_SIZE": 1000,
+    "GLANCE_CATALOG_REFRESH_INTERVAL": 30,
+    "GLANCE_CATALOG_FULL_REFRESH_INTERVAL": 600,
     "PRETTY_LOGGING": True,
+    "LOG_LEVEL": "info",
+    "LOG_ASYNC": False,
+    "LOG_QUEUE_SIZE": 10000,
+    "LOG_SAMPLE_RATES": {},
+    "LOG_RATE_LIMITS": {},
+
+    "PROFILER_ENABLED": False,
+    "PROFILER_INTERVAL": 0.05,
+    "PROFILER_OUTPUT_DIR": "/tmp",
 
     "STATSD_HOST": "localhost",
     "STATSD_PORT": 8125,
     "STATSD_PREFIX": "teeth",
     "STATSD_ENABLED": True,
+    "STATSD_FLUSH_INTERVAL": 1,
+    "STATSD_MAX_BUFFERED": 100,
 
+    "LOCK_MANAGER": "memory",
     "ETCD_HOST": "localhost",
     "ETCD_PORT": 4001,
     "ETC_CONFIG_DIR": "teeth_config",
@@ -288,7 +316,8 @@ class TeethMockTestUtilities(unittest.TestCase):
         self.api = public.TeethPublicAPIServer(self.config,
                                                self.job_client_mock)
 
-    def _get_env_builder(self, method, path, data=None, query=None):
+    def _get_env_builder(self, method, path, data=None, query=None,
+                         headers=None):
         if data:
             data = json.dumps(data)
 
@@ -300,15 +329,18 @@ class TeethMockTestUtilities(unittest.TestCase):
                                    data=data,
                                    content_type='application/json',
                                    query_string=query,
+                                   headers=headers,
                                    environ_base=environ_base)
 
     def build_request(self, method, path, data=None, query=None):
         env_builder = self._get_env_builder(method, path, data, query)
         return env_builder.get_request(wrappers.BaseRequest)
 
-    def make_request(self, method, path, data=None, query=None):
+    def make_request(self, method, path, data=None, query=None,
+                     headers=None):
         client = test.Client(self.api, wrappers.BaseResponse)
-        return client.open(self._get_env_builder(method, path, data, query))
+        return client.open(self._get_env_builder(method, path, data, query,
+                                                 headers))
 
     def _mock_model(self, cls, return_value=None, side_effect=None):
         """Patches a cqlengine model with a dummy queryset and a few other
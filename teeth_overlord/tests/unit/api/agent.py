@@ -17,7 +17,9 @@ limitations under the License.
 import mock
 
 from teeth_overlord.api import agent as agent_api
+from teeth_overlord.api import metrics as metrics_api
 from teeth_overlord import models
+from teeth_overlord import stats
 from teeth_overlord import tests
 
 
@@ -65,3 +67,44 @@ class TestAgentAPI(tests.TeethAPITestCase):
         self.assertEqual(response.status_code, 204)
         heartbeat_before = response.headers['Heartbeat-Before']
         self.assertEqual(heartbeat_before, str(models.Agent.TTL))
+
+    def test_update_agent_cached_image(self):
+        self.chassis.cached_image_id = 'old_image'
+        data = {
+            'version': '0.1',
+            'mode': models.AgentState.STANDBY,
+            'cached_image_id': 'image_id',
+            'hardware': [
+                {'type': 'mac_address', 'id': '0:1:2:3:4:5'},
+            ]
+        }
+
+        response = self.make_request('PUT', self.url, data=data)
+
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(self.chassis.cached_image_id, 'image_id')
+
+    def test_update_agent_without_cached_image(self):
+        self.chassis.cached_image_id = 'image_id'
+        data = {
+            'version': '0.1',
+            'mode': models.AgentState.STANDBY,
+            'hardware': [
+                {'type': 'mac_address', 'id': '0:1:2:3:4:5'},
+            ]
+        }
+
+        response = self.make_request('PUT', self.url, data=data)
+
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(self.chassis.cached_image_id, 'image_id')
+
+    def test_fetch_metrics(self):
+        stats.registry.incr('teeth.agent_api.test_fetch_metrics')
+
+        response = self.make_request('GET', '/metrics')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Content-Type'],
+                         metrics_api.CONTENT_TYPE)
+        self.assertIn('teeth_agent_api_test_fetch_metrics 1', response.data)
@@ -46,6 +46,64 @@ class TestChassisAPI(tests.TeethAPITestCase):
                        self.url,
                        [self.chassis1, self.chassis2])
 
+    def test_list_chassis_by_state(self):
+        lookup_mock = self.add_mock(models.ChassisByState)
+        lookup_mock.return_value = [
+            models.ChassisByState(state=models.ChassisState.READY,
+                                  chassis_id='chassis1'),
+        ]
+        self.chassis_objects_mock.return_value = [self.chassis1]
+
+        response = self.make_request('GET', self.url,
+                                     query={'state': 'READY'})
+
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data)
+        self.assertEqual([c['id'] for c in data['items']], ['chassis1'])
+        lookup_mock.assert_called_once_with('filter', state='READY')
+
+    def test_list_chassis_by_state_skips_stale_rows(self):
+        lookup_mock = self.add_mock(models.ChassisByState)
+        lookup_mock.return_value = [
+            models.ChassisByState(state=models.ChassisState.READY,
+                                  chassis_id='chassis1'),
+            models.ChassisByState(state=models.ChassisState.READY,
+                                  chassis_id='chassis2'),
+            models.ChassisByState(state=models.ChassisState.READY,
+                                  chassis_id='deleted'),
+        ]
+        # chassis2 has since gone into BUILD
+        self.chassis_objects_mock.return_value = [self.chassis1,
+                                                  self.chassis2]
+
+        response = self.make_request('GET', self.url,
+                                     query={'state': 'READY'})
+
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data)
+        self.assertEqual([c['id'] for c in data['items']], ['chassis1'])
+
+    def test_list_chassis_by_state_and_model(self):
+        lookup_mock = self.add_mock(models.ChassisByStateAndModel)
+        lookup_mock.return_value = []
+
+        response = self.make_request('GET', self.url,
+                                     query={'state': 'READY',
+                                            'chassis_model_id': 'model'})
+
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data)
+        self.assertEqual(data['items'], [])
+        lookup_mock.assert_called_once_with('filter',
+                                            state='READY',
+                                            chassis_model_id='model')
+        self.assertEqual(self.chassis_objects_mock.call_count('filter'), 0)
+
+    def test_list_chassis_by_model_requires_state(self):
+        response = self.make_request('GET', self.url,
+                                     query={'chassis_model_id': 'model'})
+        self.assertEqual(response.status_code, 400)
+
     def test_fetch_chassis_one(self):
         self.fetch_one(models.Chassis,
                        self.chassis_objects_mock,
@@ -0,0 +1,60 @@
+"""
+Copyright 2013 Rackspace, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+import json
+
+from teeth_overlord.images import fake as fake_images
+from teeth_overlord import tests
+
+
+class TestImageAPI(tests.TeethAPITestCase):
+
+    def setUp(self):
+        super(TestImageAPI, self).setUp()
+        self.url = '/v1/images'
+        self.image_id = fake_images.FAKE_IMAGE_INFO['id']
+
+    def test_list_images(self):
+        response = self.make_request('GET', self.url)
+
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data)
+        self.assertEqual([i['id'] for i in data['items']], [self.image_id])
+        self.assertEqual(data['links'], [])
+
+    def test_list_images_limit(self):
+        response = self.make_request('GET', self.url, query={'limit': 1})
+
+        data = json.loads(response.data)
+        self.assertEqual([i['id'] for i in data['items']], [self.image_id])
+        self.assertEqual(len(data['links']), 1)
+        self.assertIn('marker={}'.format(self.image_id),
+                      data['links'][0]['href'])
+
+    def test_list_images_marker(self):
+        response = self.make_request('GET', self.url,
+                                     query={'marker': self.image_id})
+
+        data = json.loads(response.data)
+        self.assertEqual(data['items'], [])
+        self.assertEqual(data['links'], [])
+
+    def test_list_images_unknown_marker(self):
+        response = self.make_request('GET', self.url,
+                                     query={'marker': 'does_not_exist'})
+
+        self.assertEqual(response.status_code, 400)
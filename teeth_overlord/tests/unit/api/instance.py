@@ -22,7 +22,9 @@ from teeth_overlord import errors
 from teeth_overlord.jobs import instances as instance_jobs
 from teeth_overlord import models
 from teeth_overlord.networks import fake as network_provider
+from teeth_overlord import stats
 from teeth_overlord import tests
+from teeth_overlord import watch
 
 
 class TestInstanceAPI(tests.TeethAPITestCase):
@@ -155,12 +157,139 @@ class TestInstanceAPI(tests.TeethAPITestCase):
                        self.url,
                        [self.instance1, self.instance2])
 
+    def test_list_instances_by_state(self):
+        lookup_mock = self.add_mock(models.InstanceByState)
+        lookup_mock.return_value = [
+            models.InstanceByState(state=models.InstanceState.ACTIVE,
+                                   instance_id='instance1'),
+            models.InstanceByState(state=models.InstanceState.ACTIVE,
+                                   instance_id='instance2'),
+        ]
+        # instance2 is no longer ACTIVE
+        self.instance_objects_mock.return_value = [self.instance1,
+                                                   self.instance2]
+
+        response = self.make_request('GET', self.url,
+                                     query={'state': 'ACTIVE'})
+
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data)
+        self.assertEqual([i['id'] for i in data['items']], ['instance1'])
+        lookup_mock.assert_called_once_with('filter', state='ACTIVE')
+        self.instance_objects_mock.assert_called_once_with(
+            'filter',
+            id__in=['instance1', 'instance2'])
+
     def test_fetch_instance_one(self):
         self.fetch_one(models.Instance,
                        self.instance_objects_mock,
                        self.url,
                        [self.instance1, self.instance2])
 
+    def test_fetch_instance_etag(self):
+        self.instance_objects_mock.return_value = [self.instance1]
+        etag = '"{}"'.format(self.instance1.get_version())
+
+        response = self.make_request('GET', '{}/instance1'.format(self.url))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['ETag'], etag)
+
+        response = self.make_request('GET', '{}/instance1'.format(self.url),
+                                     headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers['ETag'], etag)
+        self.assertEqual(response.data, '')
+
+    def test_fetch_instance_etag_changed(self):
+        self.instance_objects_mock.return_value = [self.instance1]
+        etag = '"{}"'.format(self.instance1.get_version())
+        self.instance1.state = models.InstanceState.DELETED
+
+        response = self.make_request('GET', '{}/instance1'.format(self.url),
+                                     headers={'If-None-Match': etag})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        data = json.loads(response.data)
+        self.assertEqual(data['state'], models.InstanceState.DELETED)
+
+    @mock.patch.object(watch.ChangeHub, 'wait')
+    def test_fetch_instance_wait_for_change_already_changed(self, wait_mock):
+        self.instance_objects_mock.return_value = [self.instance1]
+
+        response = self.make_request('GET', '{}/instance1'.format(self.url),
+                                     query={'wait_for_change': 'old'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(wait_mock.call_count, 0)
+
+    @mock.patch.object(watch.ChangeHub, 'wait')
+    def test_fetch_instance_wait_for_change(self, wait_mock):
+        self.instance_objects_mock.return_value = [self.instance1]
+        version = self.instance1.get_version()
+        changed = models.Instance(id='instance1',
+                                  name='instance1_name',
+                                  flavor_id='flavor1',
+                                  image_id='image1',
+                                  chassis_id='chassis1',
+                                  state=models.InstanceState.DELETED)
+        wait_mock.return_value = changed
+
+        response = self.make_request('GET', '{}/instance1'.format(self.url),
+                                     query={'wait_for_change': version})
+
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data)
+        self.assertEqual(data['state'], models.InstanceState.DELETED)
+        self.assertEqual(response.headers['ETag'],
+                         '"{}"'.format(changed.get_version()))
+        wait_mock.assert_called_once_with('instance1',
+                                          version,
+                                          self.config.WATCH_TIMEOUT)
+
+    @mock.patch.object(stats, 'timed_stat')
+    @mock.patch.object(watch.ChangeHub, 'wait')
+    def test_fetch_instance_wait_for_change_timed_apart(self, wait_mock,
+                                                        timed_stat_mock):
+        self.instance_objects_mock.return_value = [self.instance1]
+        wait_mock.return_value = None
+
+        self.make_request('GET', '{}/instance1'.format(self.url),
+                          query={'wait_for_change': 'old'})
+        self.make_request('GET', '{}/instance1'.format(self.url))
+
+        keys = [args[1] for args, kwargs in timed_stat_mock.call_args_list]
+        self.assertEqual(keys, ['instances.watch', 'instances.fetch'])
+
+    @mock.patch.object(watch.ChangeHub, 'wait')
+    def test_fetch_instance_wait_for_change_timed_out(self, wait_mock):
+        self.instance_objects_mock.return_value = [self.instance1]
+        etag = '"{}"'.format(self.instance1.get_version())
+        wait_mock.return_value = None
+
+        response = self.make_request('GET', '{}/instance1'.format(self.url),
+                                     query={'wait_for_change': etag})
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers['ETag'], etag)
+
+    def test_list_instances_etag(self):
+        self.instance_objects_mock.return_value = [self.instance1,
+                                                   self.instance2]
+
+        response = self.make_request('GET', self.url)
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers['ETag']
+
+        response = self.make_request('GET', self.url,
+                                     headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+        self.instance2.name = 'renamed'
+        response = self.make_request('GET', self.url,
+                                     headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+
     def test_fetch_instance_none(self):
         self.fetch_none(models.Instance,
                         self.instance_objects_mock,
@@ -215,7 +344,8 @@ class TestInstanceAPI(tests.TeethAPITestCase):
             'instances.create',
             instance_id=instance.id,
             metadata=metadata,
-            files={})
+            files={},
+            trace=mock.ANY)
 
         self.assertEqual(response.status_code, 201)
 
@@ -268,7 +398,8 @@ class TestInstanceAPI(tests.TeethAPITestCase):
             'instances.create',
             instance_id=instance.id,
             metadata=metadata,
-            files={})
+            files={},
+            trace=mock.ANY)
 
         self.assertEqual(response.status_code, 201)
 
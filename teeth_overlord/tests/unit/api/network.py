@@ -0,0 +1,60 @@
+"""
+Copyright 2013 Rackspace, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+import json
+
+from teeth_overlord import tests
+
+
+class TestNetworkAPI(tests.TeethAPITestCase):
+
+    def setUp(self):
+        super(TestNetworkAPI, self).setUp()
+        self.url = '/v1/networks'
+
+    def test_list_networks(self):
+        response = self.make_request('GET', self.url)
+
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data)
+        self.assertEqual([n['id'] for n in data['items']],
+                         ['PRIVATE_NETWORK', 'PUBLIC_NETWORK',
+                          'SERVICE_NETWORK'])
+        self.assertEqual(data['links'], [])
+
+    def test_list_networks_paged(self):
+        response = self.make_request('GET', self.url, query={'limit': 2})
+
+        data = json.loads(response.data)
+        self.assertEqual([n['id'] for n in data['items']],
+                         ['PRIVATE_NETWORK', 'PUBLIC_NETWORK'])
+        self.assertIn('marker=PUBLIC_NETWORK', data['links'][0]['href'])
+
+        response = self.make_request('GET', self.url,
+                                     query={'limit': 2,
+                                            'marker': 'PUBLIC_NETWORK'})
+
+        data = json.loads(response.data)
+        self.assertEqual([n['id'] for n in data['items']],
+                         ['SERVICE_NETWORK'])
+        self.assertEqual(data['links'], [])
+
+    def test_list_networks_unknown_marker(self):
+        response = self.make_request('GET', self.url,
+                                     query={'marker': 'does_not_exist'})
+
+        self.assertEqual(response.status_code, 400)
@@ -114,6 +114,20 @@ class TestConfig(tests.TeethMockTestUtilities):
         # set invalid type
         self.assertRaises(ValueError, c.set, *("FOO", 1))
 
+    def test_config_set_dict(self):
+        c = config.Config()
+
+        c.set("FOO", {"bar": 1})
+        self.assertEqual(c.get("FOO"), {"bar": 1})
+
+        # set JSON
+        c.set("FOO", '{"baz": [1, 2]}')
+        self.assertEqual(c.get("FOO"), {"baz": [1, 2]})
+
+        # set invalid type
+        self.assertRaises(ValueError, c.set, *("FOO", "[1, 2]"))
+        self.assertRaises(ValueError, c.set, *("FOO", 1))
+
     def test_config_set_int(self):
         c = config.Config()
 
@@ -15,6 +15,7 @@ limitations under the License.
 """
 
 import collections
+import datetime
 import glanceclient
 from glanceclient import exc as glance_exceptions
 
@@ -27,6 +28,7 @@ import time
 
 from teeth_overlord import config
 from teeth_overlord.images import glance
+from teeth_overlord import keystone
 from teeth_overlord import tests
 
 
@@ -144,12 +146,29 @@ class TestGlanceProvider(tests.TeethMockTestUtilities):
             'SWIFT_URL': 'http://10.127.75.253:8080/',
             'SWIFT_TEMP_URL_KEY': 'b3968d0207b54ece87cccc06515a89d4',
             'SWIFT_TEMP_URL_DURATION': 3600,
-            'SWIFT_TEMP_URL_METHOD': 'GET'
+            'SWIFT_TEMP_URL_METHOD': 'GET',
+            'PROVIDER_CACHE_TTL': 60,
+            'PROVIDER_CACHE_NEGATIVE_TTL': 5,
+            'PROVIDER_CACHE_SIZE': 1000,
+            'JOB_EXECUTION_THREADS': 16,
+            'GLANCE_CATALOG_REFRESH_INTERVAL': 30,
+            'GLANCE_CATALOG_FULL_REFRESH_INTERVAL': 600
         })
         self.glance_mock = self.add_mock(glanceclient, 'Client')
 
         self.keystone_mock = self.add_mock(keystoneclient, 'Client')
         self.keystone_mock.return_value.auth_token = 'auth_token'
+        self.keystone_mock.return_value.auth_ref.expires = (
+            datetime.datetime(2100, 1, 1))
+        # don't share tokens between tests
+        token_cache_patcher = mock.patch.object(keystone,
+                                                'token_cache',
+                                                keystone.TokenCache())
+        token_cache_patcher.start()
+        self.addCleanup(token_cache_patcher.stop)
+
+        # refresh catalogs by hand
+        self.add_mock(glance.ImageCatalog, '_start_thread')
 
         self.provider = glance.GlanceImageProvider
 
@@ -159,8 +178,8 @@ class TestGlanceProvider(tests.TeethMockTestUtilities):
         self.glance_mock.return_value.images.get.return_value = r
 
         p = self.provider(self.config)
-        hmac.new = mock.Mock(return_value=hmac.new('abc'))
-        time.time = mock.Mock(return_value=42)
+        self.add_mock(hmac, 'new', return_value=hmac.new('abc'))
+        self.add_mock(time, 'time', return_value=42)
 
         info = p.get_image_info('foo')
 
@@ -179,6 +198,43 @@ class TestGlanceProvider(tests.TeethMockTestUtilities):
 
         self.assertEqual(info.serialize(), FAKE_IMAGE_INFO[0])
 
+    def test_get_image_info_unauthorized_retries_with_new_token(self):
+        stale, new = mock.Mock(), mock.Mock()
+        stale.auth_token = 'stale_token'
+        new.auth_token = 'new_token'
+        for client in (stale, new):
+            client.auth_ref.expires = datetime.datetime(2100, 1, 1)
+        self.keystone_mock.side_effect = [stale, new]
+
+        r = FAKE_IMAGES_RESPONSE[0]
+        self.glance_mock.return_value.images.get.side_effect = [
+            glance_exceptions.HTTPUnauthorized, r]
+
+        p = self.provider(self.config)
+        self.add_mock(hmac, 'new', return_value=hmac.new('abc'))
+        self.add_mock(time, 'time', return_value=42)
+
+        info = p.get_image_info('foo')
+
+        self.assertEqual(info.serialize(), FAKE_IMAGE_INFO[0])
+        self.assertEqual(self.keystone_mock.call_count, 2)
+        self.assertEqual(self.glance_mock.call_args_list, [
+            mock.call(self.config.GLANCE_VERSION,
+                      endpoint=self.config.GLANCE_URL,
+                      token='stale_token'),
+            mock.call(self.config.GLANCE_VERSION,
+                      endpoint=self.config.GLANCE_URL,
+                      token='new_token')])
+
+    def test_get_image_info_unauthorized_twice(self):
+        self.glance_mock.return_value.images.get.side_effect = (
+            glance_exceptions.HTTPUnauthorized)
+
+        p = self.provider(self.config)
+        self.assertRaises(p.ImageProviderException, p.get_image_info, 'foo')
+        self.assertEqual(self.glance_mock.return_value.images.get.call_count,
+                         2)
+
     def test_get_glance_image_info(self):
         # Switch glance_backend to test default url handler
         self.config = config.LazyConfig(config={
@@ -193,15 +249,21 @@ class TestGlanceProvider(tests.TeethMockTestUtilities):
             'SWIFT_URL': 'http://10.127.75.253:8080/',
             'SWIFT_TEMP_URL_KEY': 'b3968d0207b54ece87cccc06515a89d4',
             'SWIFT_TEMP_URL_DURATION': 3600,
-            'SWIFT_TEMP_URL_METHOD': 'GET'
+            'SWIFT_TEMP_URL_METHOD': 'GET',
+            'PROVIDER_CACHE_TTL': 60,
+            'PROVIDER_CACHE_NEGATIVE_TTL': 5,
+            'PROVIDER_CACHE_SIZE': 1000,
+            'JOB_EXECUTION_THREADS': 16,
+            'GLANCE_CATALOG_REFRESH_INTERVAL': 30,
+            'GLANCE_CATALOG_FULL_REFRESH_INTERVAL': 600
         })
 
         r = FAKE_IMAGES_RESPONSE[0]
         self.glance_mock.return_value.images.get.return_value = r
 
         p = self.provider(self.config)
-        hmac.new = mock.Mock(return_value=hmac.new('abc'))
-        time.time = mock.Mock(return_value=42)
+        self.add_mock(hmac, 'new', return_value=hmac.new('abc'))
+        self.add_mock(time, 'time', return_value=42)
 
         info = p.get_image_info('foo')
 
@@ -250,6 +312,39 @@ class TestGlanceProvider(tests.TeethMockTestUtilities):
 
         self.assertRaises(p.ImageDoesNotExist, p.get_image_info, 'foo')
 
+    def test_get_image_info_cached(self):
+        r = FAKE_IMAGES_RESPONSE[0]
+        self.glance_mock.return_value.images.get.return_value = r
+
+        p = self.provider(self.config)
+        p.get_image_info('foo')
+        info = p.get_image_info('foo')
+
+        self.glance_mock().images.get.assert_called_once_with('foo')
+        self.assertEqual(self.keystone_mock.call_count, 1)
+        self.assertEqual(info.id, r['id'])
+
+    def test_glance_client_reused(self):
+        r = FAKE_IMAGES_RESPONSE
+        self.glance_mock.return_value.images.list.return_value = r
+
+        p = self.provider(self.config)
+        p.list_images()
+        p.list_images()
+
+        self.assertEqual(self.glance_mock.call_count, 1)
+        self.assertEqual(self.keystone_mock.call_count, 1)
+
+    def test_get_image_none_cached(self):
+        e = glance_exceptions.HTTPNotFound
+        self.glance_mock.return_value.images.get.side_effect = e
+
+        p = self.provider(self.config)
+
+        self.assertRaises(p.ImageDoesNotExist, p.get_image_info, 'foo')
+        self.assertRaises(p.ImageDoesNotExist, p.get_image_info, 'foo')
+        self.assertEqual(self.glance_mock().images.get.call_count, 1)
+
     def test_list_image_none(self):
 
         self.glance_mock.return_value.images.list.return_value = []
@@ -285,3 +380,195 @@ class TestGlanceProvider(tests.TeethMockTestUtilities):
         p = self.provider(self.config)
 
         self.assertRaises(p.ImageProviderException, p.list_images)
+
+    def test_list_images_cached(self):
+        r = FAKE_IMAGES_RESPONSE
+        self.glance_mock.return_value.images.list.return_value = r
+
+        p = self.provider(self.config)
+        p.list_images()
+        info = p.list_images()
+
+        self.glance_mock().images.list.assert_called_once_with()
+        self.assertEqual([i.id for i in info], [i['id'] for i in r])
+        p.catalog._start_thread.assert_called_once_with()
+
+    def test_list_images_catalog_disabled(self):
+        self.config.GLANCE_CATALOG_REFRESH_INTERVAL = 0
+        r = FAKE_IMAGES_RESPONSE
+        self.glance_mock.return_value.images.list.return_value = r
+
+        p = self.provider(self.config)
+        p.list_images()
+        p.list_images()
+
+        self.assertIsNone(p.catalog)
+        self.assertEqual(self.glance_mock().images.list.call_count, 2)
+
+    def test_get_image_info_in_catalog_checks_glance(self):
+        r = FAKE_IMAGES_RESPONSE
+        self.glance_mock.return_value.images.list.return_value = r
+        self.glance_mock.return_value.images.get.side_effect = (
+            glance_exceptions.HTTPNotFound)
+
+        p = self.provider(self.config)
+        p.list_images()
+
+        self.assertRaises(p.ImageDoesNotExist,
+                          p.get_image_info,
+                          r[1]['id'])
+        self.glance_mock().images.get.assert_called_once_with(r[1]['id'])
+
+    def test_get_image_info_not_in_catalog(self):
+        self.glance_mock.return_value.images.list.return_value = []
+        r = FAKE_IMAGES_RESPONSE[0]
+        self.glance_mock.return_value.images.get.return_value = r
+
+        p = self.provider(self.config)
+        p.list_images()
+        info = p.get_image_info(r['id'])
+
+        self.assertEqual(info.id, r['id'])
+        self.glance_mock().images.get.assert_called_once_with(r['id'])
+
+    def test_image_urls_signed_lazily(self):
+        r = FAKE_IMAGES_RESPONSE[0]
+        self.glance_mock.return_value.images.get.return_value = r
+        hmac_mock = self.add_mock(hmac, 'new', return_value=hmac.new('abc'))
+        self.add_mock(time, 'time', return_value=42)
+
+        p = self.provider(self.config)
+        info = p.get_image_info('foo')
+
+        self.assertEqual(hmac_mock.call_count, 0)
+        self.assertEqual(info.urls, FAKE_IMAGE_INFO[0]['urls'])
+        self.assertEqual(info.urls, FAKE_IMAGE_INFO[0]['urls'])
+        self.assertEqual(hmac_mock.call_count, 1)
+
+    def test_list_images_paged(self):
+        r = FAKE_IMAGES_RESPONSE
+        self.glance_mock.return_value.images.list.return_value = r
+
+        p = self.provider(self.config)
+        first = p.list_images(limit=2)
+        second = p.list_images(marker=first[-1].id, limit=2)
+
+        self.assertEqual([i.id for i in first], [r[0]['id'], r[1]['id']])
+        self.assertEqual([i.id for i in second], [r[2]['id']])
+        self.glance_mock().images.list.assert_called_once_with()
+
+    def test_list_images_unknown_marker(self):
+        self.glance_mock.return_value.images.list.return_value = []
+
+        p = self.provider(self.config)
+
+        self.assertRaises(p.ImageDoesNotExist, p.list_images, 'foo', 2)
+
+    def test_list_images_paged_catalog_disabled(self):
+        self.config.GLANCE_CATALOG_REFRESH_INTERVAL = 0
+        r = FAKE_IMAGES_RESPONSE
+        self.glance_mock.return_value.images.list.return_value = iter(r)
+
+        p = self.provider(self.config)
+        info = p.list_images(marker='foo', limit=2)
+
+        self.glance_mock().images.list.assert_called_once_with(
+            filters={'marker': 'foo'}, page_size=2)
+        self.assertEqual([i.id for i in info], [r[0]['id'], r[1]['id']])
+
+    def test_list_images_unknown_marker_catalog_disabled(self):
+        self.config.GLANCE_CATALOG_REFRESH_INTERVAL = 0
+        e = glance_exceptions.HTTPBadRequest
+        self.glance_mock.return_value.images.list.side_effect = e
+
+        p = self.provider(self.config)
+
+        self.assertRaises(p.ImageDoesNotExist, p.list_images, 'foo', 2)
+
+    def test_list_images_since(self):
+        r = FAKE_IMAGES_RESPONSE
+        self.glance_mock.return_value.images.list.return_value = iter(r)
+
+        p = self.provider(self.config)
+        images = p._list_images(since=u'2014-01-10T18:53:24Z')
+
+        self.glance_mock().images.list.assert_called_once_with(
+            filters={'sort_key': 'updated_at', 'sort_dir': 'desc'})
+        self.assertEqual(images, r[:2])
+
+
+class TestImageCatalog(tests.TeethMockTestUtilities):
+
+    def setUp(self):
+        super(TestImageCatalog, self).setUp()
+        self.list_images = mock.Mock()
+        self.catalog = glance.ImageCatalog(self.list_images, 30, 600)
+        self.add_mock(self.catalog, '_start_thread')
+
+    def _image(self, id, created_at, updated_at=None, status='active'):
+        return {'id': id,
+                'status': status,
+                'created_at': created_at,
+                'updated_at': updated_at or created_at}
+
+    def test_get_before_load(self):
+        self.assertIsNone(self.catalog.get('foo'))
+        self.assertEqual(self.list_images.call_count, 0)
+
+    def test_list_ordered(self):
+        images = [self._image('a', '2014-01-01T00:00:00Z'),
+                  self._image('b', '2014-01-03T00:00:00Z'),
+                  self._image('c', '2014-01-02T00:00:00Z')]
+        self.list_images.return_value = images
+
+        self.assertEqual([i['id'] for i in self.catalog.list()],
+                         ['b', 'c', 'a'])
+        self.assertEqual(self.catalog.get('a'), images[0])
+        self.assertEqual(self.catalog.updated_at, '2014-01-03T00:00:00Z')
+
+    def test_incremental_refresh(self):
+        a = self._image('a', '2014-01-01T00:00:00Z')
+        b = self._image('b', '2014-01-02T00:00:00Z')
+        self.list_images.return_value = [a, b]
+        self.catalog.list()
+
+        new_a = self._image('a', '2014-01-01T00:00:00Z',
+                            '2014-01-04T00:00:00Z')
+        c = self._image('c', '2014-01-03T00:00:00Z')
+        self.list_images.return_value = [new_a, c]
+        self.catalog.refresh()
+
+        self.list_images.assert_called_with('2014-01-02T00:00:00Z')
+        self.assertEqual(self.catalog.list(), [c, b, new_a])
+        self.assertEqual(self.catalog.updated_at, '2014-01-04T00:00:00Z')
+
+    def test_full_refresh_drops_deleted(self):
+        a = self._image('a', '2014-01-01T00:00:00Z')
+        b = self._image('b', '2014-01-02T00:00:00Z')
+        self.list_images.return_value = [a, b]
+        self.catalog.list()
+
+        self.list_images.return_value = [a]
+        self.catalog.refresh(full=True)
+
+        self.list_images.assert_called_with()
+        self.assertEqual(self.catalog.list(), [a])
+        self.assertIsNone(self.catalog.get('b'))
+
+    def test_incremental_refresh_drops_deleted(self):
+        a = self._image('a', '2014-01-01T00:00:00Z')
+        b = self._image('b', '2014-01-02T00:00:00Z')
+        self.list_images.return_value = [a, b]
+        self.catalog.list()
+
+        deleted_a = self._image('a', '2014-01-01T00:00:00Z',
+                                '2014-01-04T00:00:00Z', status='deleted')
+        killed_c = self._image('c', '2014-01-03T00:00:00Z', status='killed')
+        self.list_images.return_value = [deleted_a, killed_c]
+        self.catalog.refresh()
+
+        self.assertEqual(self.catalog.list(), [b])
+        self.assertIsNone(self.catalog.get('a'))
+        self.assertIsNone(self.catalog.get('c'))
+        # so they aren't listed again next time
+        self.assertEqual(self.catalog.updated_at, '2014-01-04T00:00:00Z')
@@ -23,6 +23,7 @@ from teeth_overlord import config
 from teeth_overlord.images import fake as image_fake
 from teeth_overlord.jobs import base as jobs_base
 from teeth_overlord.jobs import instances as instance_jobs
+from teeth_overlord import locks
 from teeth_overlord import marconi
 from teeth_overlord import models
 from teeth_overlord.networks import fake as network_fake
@@ -126,3 +127,185 @@ class TestJobClient(tests.TeethMockTestUtilities):
         self.assertEqual(saved_instance.job_id, None)
         self.assertEqual(saved_instance.job_state, None)
         self.assertEqual(instance_save.call_count, 1)
+
+    @mock.patch('teeth_overlord.locks.get_lock_manager')
+    def test_execute_requeues_when_assets_locked(self, get_lock_manager_mock):
+        lock_manager = get_lock_manager_mock.return_value
+        lock_manager.acquire.side_effect = locks.LockNotAcquired(
+            '/instances/test_instance')
+
+        job_params = {'instance_id': 'test_instance'}
+        job_request = models.JobRequest(id='test_job',
+                                        job_type='instances.create',
+                                        params=job_params,
+                                        state=models.JobRequestState.READY,
+                                        failed_attempts=0)
+        executor = MockJobExecutor()
+        message = mock.Mock()
+        job = instance_jobs.CreateInstance(executor,
+                                           job_request,
+                                           message,
+                                           self.config)
+        job._execute = mock.Mock()
+
+        job.execute()
+
+        self.assertEqual(job._execute.call_count, 0)
+        self.assertEqual(job_request.state, models.JobRequestState.READY)
+        self.assertEqual(job_request.failed_attempts, 0)
+        executor.queue.update_claim.assert_called_once_with(
+            message,
+            jobs_base.LOCKED_RETRY_DELAY)
+        self.assertEqual(executor.queue.delete_message.call_count, 0)
+
+    @mock.patch('teeth_overlord.locks.get_lock_manager')
+    def test_execute_retries_marking_when_completed_assets_locked(
+            self, get_lock_manager_mock):
+        lock_manager = get_lock_manager_mock.return_value
+        job_params = {'instance_id': 'test_instance'}
+        job_request = models.JobRequest(id='test_job',
+                                        job_type='instances.create',
+                                        params=job_params,
+                                        state=models.JobRequestState.READY,
+                                        failed_attempts=0)
+        executor = MockJobExecutor()
+        message = mock.Mock()
+        job = instance_jobs.CreateInstance(executor,
+                                           job_request,
+                                           message,
+                                           self.config)
+
+        def _execute():
+            lock_manager.acquire.side_effect = locks.LockNotAcquired(
+                '/instances/test_instance')
+        job._execute = mock.Mock(side_effect=_execute)
+
+        job.execute()
+
+        self.assertEqual(job_request.state, models.JobRequestState.COMPLETED)
+        executor.queue.update_claim.assert_called_once_with(
+            message,
+            jobs_base.LOCKED_RETRY_DELAY)
+        self.assertEqual(executor.queue.delete_message.call_count, 0)
+
+    def test_execute_times_job_type(self):
+        job_params = {'instance_id': 'test_instance'}
+        job_request = models.JobRequest(id='test_job',
+                                        job_type='instances.create',
+                                        params=job_params,
+                                        state=models.JobRequestState.READY,
+                                        failed_attempts=0)
+        executor = MockJobExecutor()
+        job = instance_jobs.CreateInstance(executor,
+                                           job_request,
+                                           mock.Mock(),
+                                           self.config)
+        job._execute = mock.Mock()
+
+        job.execute()
+
+        executor.stats_client.incr.assert_called_once_with(
+            'instances.create.success')
+        executor.stats_client.timing.assert_called_once_with(
+            'instances.create.time', mock.ANY)
+
+    def test_execute_times_failed_job(self):
+        job_params = {'instance_id': 'test_instance'}
+        job_request = models.JobRequest(id='test_job',
+                                        job_type='instances.create',
+                                        params=job_params,
+                                        state=models.JobRequestState.READY,
+                                        failed_attempts=0)
+        executor = MockJobExecutor()
+        job = instance_jobs.CreateInstance(executor,
+                                           job_request,
+                                           mock.Mock(),
+                                           self.config)
+        job._execute = mock.Mock(side_effect=ValueError())
+
+        job.execute()
+
+        executor.stats_client.incr.assert_called_once_with(
+            'instances.create.error')
+        executor.stats_client.timing.assert_called_once_with(
+            'instances.create.time', mock.ANY)
+
+    def test_execute_marks_assets_of_finished_request(self):
+        instance = models.Instance(id='test_instance',
+                                   name='test',
+                                   flavor_id='flavor',
+                                   image_id='image',
+                                   job_id='test_job',
+                                   job_state=models.JobRequestState.RUNNING)
+        self.instance_mock.return_value = [instance]
+        instance_save = self.get_mock(models.Instance, 'save')
+
+        job_params = {'instance_id': 'test_instance'}
+        job_request = models.JobRequest(
+            id='test_job',
+            job_type='instances.create',
+            params=job_params,
+            state=models.JobRequestState.COMPLETED)
+        executor = MockJobExecutor()
+        message = mock.Mock()
+        job = instance_jobs.CreateInstance(executor,
+                                           job_request,
+                                           message,
+                                           self.config)
+        job._execute = mock.Mock()
+
+        job.execute()
+
+        self.assertEqual(job._execute.call_count, 0)
+        self.assertEqual(instance_save.call_count, 1)
+        self.assertEqual(instance.job_id, None)
+        self.assertEqual(instance.job_state, None)
+        executor.queue.delete_message.assert_called_once_with(message)
+
+    def test_mark_assets_of_finished_request_keeps_newer_job(self):
+        instance = models.Instance(id='test_instance',
+                                   name='test',
+                                   flavor_id='flavor',
+                                   image_id='image',
+                                   job_id='newer_job',
+                                   job_state=models.JobRequestState.RUNNING)
+        self.instance_mock.return_value = [instance]
+        instance_save = self.get_mock(models.Instance, 'save')
+
+        job_request = models.JobRequest(
+            id='test_job',
+            job_type='instances.create',
+            params={'instance_id': 'test_instance'},
+            state=models.JobRequestState.COMPLETED)
+        job = instance_jobs.CreateInstance(MockJobExecutor(),
+                                           job_request,
+                                           mock.Mock(),
+                                           self.config)
+        job._mark_assets()
+
+        self.assertEqual(instance_save.call_count, 0)
+        self.assertEqual(instance.job_id, 'newer_job')
+
+
+class TestJobExecutor(tests.TeethMockTestUtilities):
+    def test_precache_images_runs_without_submitting(self):
+        executor = MockJobExecutor()
+        executor.config = self.config
+        executor.stopping = mock.Mock()
+        executor.stopping.wait.side_effect = [False, False, True]
+        job_class = mock.Mock()
+        job_class.return_value.precache.side_effect = [ValueError(), None]
+        executor._get_job_class = mock.Mock(return_value=job_class)
+
+        executor._precache_images()
+
+        executor._get_job_class.assert_called_once_with(
+            jobs_base.PRECACHE_JOB_TYPE)
+        executor.stopping.wait.assert_called_with(
+            self.config.IMAGE_PRECACHE_INTERVAL)
+        # an error in one run doesn't stop the next
+        self.assertEqual(job_class.return_value.precache.call_count, 2)
+        executor.stats_client.incr.assert_has_calls([
+            mock.call('images.precache.error'),
+            mock.call('images.precache.success')])
+        self.assertEqual(executor.job_client.submit_job.call_count, 0)
@@ -0,0 +1,266 @@
+"""
+Copyright 2013 Rackspace, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+import contextlib
+import mock
+
+from teeth_overlord import errors
+from teeth_overlord.jobs import images as image_jobs
+from teeth_overlord import locks
+from teeth_overlord import models
+from teeth_overlord import tests
+from teeth_overlord.tests.unit.jobs import base as jobs_tests_base
+
+
+def _chassis(id, cached_image_id=None):
+    return models.Chassis(id=id,
+                          state=models.ChassisState.READY,
+                          chassis_model_id='chassis_model',
+                          cached_image_id=cached_image_id)
+
+
+class PlanPrecacheTestCase(tests.TeethMockTestUtilities):
+    def _plan(self, popular, chassis_list):
+        plan = image_jobs.plan_precache(popular, chassis_list)
+        return sorted((image_id, chassis.id) for chassis, image_id in plan)
+
+    def test_proportional(self):
+        chassis_list = [_chassis(str(i)) for i in xrange(4)]
+
+        plan = self._plan([('a', 30), ('b', 10)], chassis_list)
+
+        self.assertEqual([image_id for image_id, chassis_id in plan],
+                         ['a', 'a', 'a', 'b'])
+
+    def test_remainder_goes_to_most_popular(self):
+        chassis_list = [_chassis(str(i)) for i in xrange(2)]
+
+        plan = self._plan([('a', 2), ('b', 1), ('c', 1)], chassis_list)
+
+        self.assertEqual([image_id for image_id, chassis_id in plan],
+                         ['a', 'b'])
+
+    def test_remainder_ties_go_to_most_popular(self):
+        chassis_list = [_chassis(str(i)) for i in xrange(3)]
+
+        plan = self._plan([('a', 3), ('b', 2), ('c', 1)], chassis_list)
+
+        # 'a' and 'c' are both owed half a chassis
+        self.assertEqual([image_id for image_id, chassis_id in plan],
+                         ['a', 'a', 'b'])
+
+    def test_cached_images_kept(self):
+        chassis_list = [_chassis('1', 'a'),
+                        _chassis('2', 'a'),
+                        _chassis('3', 'old'),
+                        _chassis('4')]
+
+        plan = self._plan([('a', 1), ('b', 1)], chassis_list)
+
+        # one of the chassis holding 'a' is over its share
+        self.assertEqual(len(plan), 2)
+        self.assertEqual([image_id for image_id, chassis_id in plan],
+                         ['b', 'b'])
+        self.assertNotIn('1', [chassis_id for _, chassis_id in plan])
+
+    def test_nothing_to_do(self):
+        self.assertEqual(self._plan([], [_chassis('1')]), [])
+        self.assertEqual(self._plan([('a', 1)], []), [])
+        self.assertEqual(self._plan([('a', 1)], [_chassis('1', 'a')]), [])
+
+
+class PrecacheImagesTestCase(tests.TeethMockTestUtilities):
+    def setUp(self):
+        super(PrecacheImagesTestCase, self).setUp()
+
+        self.flavor_objects_mock = self.add_mock(models.Flavor)
+        self.flavor_provider_objects_mock = self.add_mock(
+            models.FlavorProvider)
+        self.chassis_objects_mock = self.add_mock(models.Chassis)
+        self.lookup_objects_mock = self.add_mock(
+            models.ChassisByStateAndModel)
+        self.chassis_save_mock = self.add_mock(models.Chassis, 'save')
+        self.popular_mock = self.add_mock(models.ImageDemand, 'get_popular')
+
+        self.flavor_objects_mock.return_value = [
+            models.Flavor(id='flavor', name='flavor')]
+        self.flavor_provider_objects_mock.return_value = [
+            models.FlavorProvider(flavor_id='flavor',
+                                  chassis_model_id='chassis_model')]
+        self.chassis = [_chassis('chassis1'), _chassis('chassis2')]
+        self.lookup_objects_mock.return_value = [
+            models.ChassisByStateAndModel(state=models.ChassisState.READY,
+                                          chassis_model_id='chassis_model',
+                                          chassis_id=c.id)
+            for c in self.chassis]
+        self.chassis_objects_mock.get = mock.Mock(
+            side_effect=lambda id: dict((c.id, c) for c in self.chassis)[id])
+        self.popular_mock.return_value = [('a', 2), ('b', 1), ('c', 1)]
+
+        self.lock_manager = mock.Mock(spec=locks.LockManager)
+        self.add_mock(locks, 'get_lock_manager',
+                      return_value=self.lock_manager)
+
+        @contextlib.contextmanager
+        def _acquire(key, timeout=None):
+            yield
+        self.lock_manager.acquire.side_effect = _acquire
+
+        self.executor = jobs_tests_base.MockJobExecutor()
+        self.job_request = models.JobRequest(id='test_request',
+                                             job_type='images.precache',
+                                             params={})
+        self.job = image_jobs.PrecacheImages(self.executor,
+                                             self.job_request,
+                                             {'body': {}},
+                                             self.config)
+
+    def _locked(self, acquired):
+        @contextlib.contextmanager
+        def _try_acquire(key):
+            self.assertEqual(key, image_jobs.PRECACHE_LOCK_KEY)
+            yield acquired
+        self.lock_manager.try_acquire.side_effect = _try_acquire
+
+    def test_precache(self):
+        self._locked(True)
+
+        self.job._execute()
+
+        self.popular_mock.assert_called_once_with(
+            'flavor', self.config.IMAGE_PRECACHE_DAYS)
+        self.lookup_objects_mock.assert_called_once_with(
+            'filter',
+            state=models.ChassisState.READY,
+            chassis_model_id='chassis_model')
+        self.assertEqual(
+            self.chassis_objects_mock.call_count('allow_filtering'), 0)
+        cache_image = self.executor.agent_client.cache_image
+        self.assertEqual(sorted(args[1] for args, kwargs
+                                in cache_image.call_args_list),
+                         ['a', 'b'])
+        self.assertEqual(sorted(c.cached_image_id for c in self.chassis),
+                         ['a', 'b'])
+        self.assertEqual(self.chassis_save_mock.call_count, 2)
+        self.assertEqual(
+            sorted(args[0] for args, kwargs
+                   in self.lock_manager.acquire.call_args_list),
+            ['/chassis/chassis1', '/chassis/chassis2'])
+
+    def test_precache_flavors_sharing_chassis_model(self):
+        self._locked(True)
+        self.flavor_objects_mock.return_value = [
+            models.Flavor(id='flavor1', name='flavor1'),
+            models.Flavor(id='flavor2', name='flavor2')]
+        demand = {'flavor1': [('a', 2), ('b', 1)],
+                  'flavor2': [('c', 4)]}
+        self.popular_mock.side_effect = lambda flavor_id, days: (
+            demand[flavor_id])
+
+        self.job._execute()
+
+        # both flavors' demand is planned for at once, so each chassis is
+        # only handed one image
+        self.assertEqual(self.popular_mock.call_count, 2)
+        cache_image = self.executor.agent_client.cache_image
+        self.assertEqual(sorted(args[1] for args, kwargs
+                                in cache_image.call_args_list),
+                         ['a', 'c'])
+        get_agent = self.executor.agent_client.get_agent
+        self.assertEqual(sorted(args[0].id for args, kwargs
+                                in get_agent.call_args_list),
+                         ['chassis1', 'chassis2'])
+
+    def test_precache_skips_stale_lookup_rows(self):
+        self._locked(True)
+        self.chassis[0].state = models.ChassisState.BUILD
+        self.chassis[1].chassis_model_id = 'other_model'
+        self.lookup_objects_mock.return_value.append(
+            models.ChassisByStateAndModel(state=models.ChassisState.READY,
+                                          chassis_model_id='chassis_model',
+                                          chassis_id='gone'))
+
+        def _get(id):
+            for chassis in self.chassis:
+                if chassis.id == id:
+                    return chassis
+            raise models.Chassis.DoesNotExist()
+        self.chassis_objects_mock.get.side_effect = _get
+
+        self.job._execute()
+
+        self.assertEqual(self.executor.agent_client.cache_image.call_count,
+                         0)
+        self.assertEqual(self.chassis_save_mock.call_count, 0)
+
+    def test_precache_chassis_no_longer_ready(self):
+        self._locked(True)
+        building = [_chassis('chassis1'), _chassis('chassis2')]
+        for chassis in building:
+            chassis.state = models.ChassisState.BUILD
+        # READY when listed, BUILD by the time the image is recorded
+        self.chassis_objects_mock.get.side_effect = (
+            self.chassis + building)
+
+        self.job._execute()
+
+        self.assertEqual(self.executor.agent_client.cache_image.call_count,
+                         2)
+        self.assertEqual(self.chassis_save_mock.call_count, 0)
+        self.assertEqual([c.cached_image_id for c in building],
+                         [None, None])
+
+    def test_precache_chassis_locked(self):
+        self._locked(True)
+        self.lock_manager.acquire.side_effect = locks.LockNotAcquired(
+            '/chassis/chassis1')
+
+        self.job._execute()
+
+        self.assertEqual(self.executor.agent_client.cache_image.call_count,
+                         2)
+        self.assertEqual(self.chassis_save_mock.call_count, 0)
+
+    def test_precache_already_running(self):
+        self._locked(False)
+
+        self.job._execute()
+
+        self.assertEqual(self.popular_mock.call_count, 0)
+        self.assertEqual(self.executor.agent_client.cache_image.call_count,
+                         0)
+
+    def test_precache_agent_not_connected(self):
+        self._locked(True)
+        exc = errors.AgentNotConnectedError('chassis1')
+        self.executor.agent_client.get_agent.side_effect = exc
+
+        self.job._execute()
+
+        self.assertEqual(self.executor.agent_client.cache_image.call_count,
+                         0)
+        self.assertEqual(self.chassis_save_mock.call_count, 0)
+
+    def test_precache_agent_error(self):
+        self._locked(True)
+        self.executor.agent_client.cache_image.side_effect = ValueError()
+
+        self.job._execute()
+
+        self.assertEqual(self.executor.agent_client.cache_image.call_count,
+                         2)
+        self.assertEqual(self.chassis_save_mock.call_count, 0)
@@ -30,6 +30,7 @@ class CreateInstanceTestCase(tests.TeethAPITestCase):
 
         self.add_mock(models.Instance, 'batch')
         self.add_mock(models.Chassis, 'batch')
+        self.record_demand_mock = self.add_mock(models.ImageDemand, 'record')
 
         self.instance = models.Instance(id='test_instance',
                                         state=models.InstanceState.INACTIVE,
@@ -87,9 +88,9 @@ class CreateInstanceTestCase(tests.TeethAPITestCase):
         client.run_image.assert_called_once_with(agent, image_info)
 
     def _did_attach_networks(self):
-        self.executor.network_provider.attach.assert_called_once_with(
-            self.mac.hardware_id,
-            list(self.instance.network_ids)[0]
+        self.executor.network_provider.attach_many.assert_called_once_with(
+            [self.mac.hardware_id],
+            self.instance.network_ids
         )
 
     def test_prepare_and_run_image(self):
@@ -127,6 +128,49 @@ class CreateInstanceTestCase(tests.TeethAPITestCase):
         self._did_prepare_and_run_image()
         self._instance_is_marked_active()
         self._did_attach_networks()
+        self.record_demand_mock.assert_called_once_with('flavor_id',
+                                                        'image_id')
+
+    def test_instance_create_job_demand_error(self):
+        self.record_demand_mock.side_effect = ValueError()
+        self.job._execute()
+        self._instance_is_marked_active()
+
+    def test_instance_create_job_records_spans(self):
+        self.job_request.params['trace'] = {'trace_id': 'trace_id',
+                                            'started_at': 1,
+                                            'submitted_at': 2}
+        self.job._execute()
+
+        timing = self.executor.stats_client.timing
+        spans = [args[0] for args, kwargs in timing.call_args_list]
+        self.assertEqual(spans, [
+            'instances.create.spans.queued',
+            'instances.create.spans.reserve_chassis',
+            'instances.create.spans.get_image_info',
+            'instances.create.spans.attach_networks',
+            'instances.create.spans.prepare_and_run_image',
+            'instances.create.spans.mark_active',
+            'instances.create.spans.total',
+        ])
+
+    def test_instance_create_job_retry_records_spans(self):
+        self.job_request.params['trace'] = {'trace_id': 'trace_id',
+                                            'started_at': 1,
+                                            'submitted_at': 2}
+        self.job_request.failed_attempts = 1
+        self.job._execute()
+
+        timing = self.executor.stats_client.timing
+        spans = [args[0] for args, kwargs in timing.call_args_list]
+        self.assertEqual(spans, [
+            'instances.create.spans.reserve_chassis',
+            'instances.create.spans.get_image_info',
+            'instances.create.spans.attach_networks',
+            'instances.create.spans.prepare_and_run_image',
+            'instances.create.spans.mark_active',
+            'instances.create.spans.total.retried',
+        ])
 
 
 class DeleteInstanceTestCase(tests.TeethAPITestCase):
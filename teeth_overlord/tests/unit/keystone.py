@@ -0,0 +1,138 @@
+"""
+Copyright 2013 Rackspace, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+import datetime
+import threading
+import unittest
+
+from keystoneclient.v2_0 import client as keystone_client
+import mock
+
+from teeth_overlord import config
+from teeth_overlord import keystone
+
+# 2014-01-01T01:00:00Z
+EXPIRES = datetime.datetime(2014, 1, 1, 1)
+EXPIRES_AT = 1388538000
+
+
+class TestTokenCache(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(keystone_client, 'Client')
+        self.client_mock = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client_mock.return_value.auth_ref.expires = EXPIRES
+        self.client_mock.return_value.auth_token = 'token1'
+
+        time_patcher = mock.patch('time.time')
+        self.time_mock = time_patcher.start()
+        self.addCleanup(time_patcher.stop)
+        self.time_mock.return_value = EXPIRES_AT - 3600
+
+        self.cache = keystone.TokenCache()
+
+    def _get_token(self, username='user'):
+        return self.cache.get_token(username, 'pass', 'tenant', 'auth_url')
+
+    def test_get_token_cached(self):
+        self.assertEqual(self._get_token(), 'token1')
+        self.assertEqual(self._get_token(), 'token1')
+
+        self.client_mock.assert_called_once_with(username='user',
+                                                 password='pass',
+                                                 tenant_id='tenant',
+                                                 auth_url='auth_url')
+
+    def test_get_token_per_credentials(self):
+        self._get_token('user1')
+        self._get_token('user2')
+        self.assertEqual(self.client_mock.call_count, 2)
+
+    def test_get_token_refreshed_before_expiry(self):
+        self._get_token()
+
+        self.client_mock.return_value.auth_token = 'token2'
+        self.time_mock.return_value = EXPIRES_AT - keystone.REFRESH_MARGIN
+        self.assertEqual(self._get_token(), 'token2')
+        self.assertEqual(self.client_mock.call_count, 2)
+
+    def test_get_token_refresh_in_progress(self):
+        self._get_token()
+        self.time_mock.return_value = EXPIRES_AT - keystone.REFRESH_MARGIN
+        key = ('user', 'pass', 'tenant', 'auth_url')
+        self.cache.refresh_locks[key].acquire()
+
+        # another thread is refreshing, keep using the old token meanwhile
+        self.assertEqual(self._get_token(), 'token1')
+        self.assertEqual(self.client_mock.call_count, 1)
+
+    def test_get_token_expired_waits_for_refresh(self):
+        self._get_token()
+        self.time_mock.return_value = EXPIRES_AT
+        key = ('user', 'pass', 'tenant', 'auth_url')
+        refresh_lock = self.cache.refresh_locks[key]
+        refresh_lock.acquire()
+
+        results = []
+        thread = threading.Thread(
+            target=lambda: results.append(self._get_token()))
+        thread.start()
+
+        # the refresh finishes while the thread waits for it
+        self.cache.tokens[key] = ('token2', EXPIRES_AT + 1, EXPIRES_AT + 2)
+        refresh_lock.release()
+        thread.join()
+
+        self.assertEqual(results, ['token2'])
+        self.assertEqual(self.client_mock.call_count, 1)
+
+    def test_invalidate(self):
+        self._get_token()
+        self.client_mock.return_value.auth_token = 'token2'
+
+        self.cache.invalidate('user', 'pass', 'tenant', 'auth_url', 'token1')
+
+        self.assertEqual(self._get_token(), 'token2')
+        self.assertEqual(self.client_mock.call_count, 2)
+
+    def test_invalidate_replaced_token(self):
+        self._get_token()
+
+        # another caller has already replaced the rejected token
+        self.cache.invalidate('user', 'pass', 'tenant', 'auth_url', 'token0')
+
+        self.assertEqual(self._get_token(), 'token1')
+        self.assertEqual(self.client_mock.call_count, 1)
+
+    def test_get_auth_token(self):
+        conf = config.LazyConfig(config={
+            'KEYSTONE_USER': 'user',
+            'KEYSTONE_PASS': 'pass',
+            'KEYSTONE_TENANT_ID': 'tenant',
+            'KEYSTONE_AUTH_URL': 'auth_url',
+        })
+
+        with mock.patch.object(keystone, 'token_cache', self.cache):
+            self.assertEqual(keystone.get_auth_token(conf), 'token1')
+            self.assertEqual(keystone.get_auth_token(conf), 'token1')
+        self.assertEqual(self.client_mock.call_count, 1)
+
+        self.client_mock.return_value.auth_token = 'token2'
+        with mock.patch.object(keystone, 'token_cache', self.cache):
+            keystone.invalidate_auth_token(conf, 'token1')
+            self.assertEqual(keystone.get_auth_token(conf), 'token2')
+        self.assertEqual(self.client_mock.call_count, 2)
@@ -14,11 +14,13 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import threading
 import time
 import unittest
 
 import etcd
 import mock
+import statsd
 
 from teeth_overlord import config
 from teeth_overlord import locks
@@ -38,6 +40,17 @@ class MockLock(object):
     is_locked = _noop
 
 
+class SynchronousPool(object):
+    """Stands in for the renewal pool, running renewals as they're
+    submitted.
+    """
+    def apply_async(self, func, args=()):
+        func(*args)
+
+    def terminate(self):
+        pass
+
+
 class EtcdLockManagerTestCase(unittest.TestCase):
     def setUp(self):
         self.client = mock.Mock(autospec=etcd.Client)
@@ -48,7 +61,11 @@ class EtcdLockManagerTestCase(unittest.TestCase):
         self.client.get_lock.return_value = self.lock
 
         _config = config.Config()
-        self.lock_manager = locks.EtcdLockManager(_config, client=self.client)
+        self.stats_client = mock.Mock(spec=statsd.StatsClient)
+        self.lock_manager = locks.EtcdLockManager(
+            _config,
+            client=self.client,
+            stats_client=self.stats_client)
         self.get_locks = self.lock_manager._locks.values
 
     def test_context_manager_locks(self):
@@ -56,21 +73,147 @@ class EtcdLockManagerTestCase(unittest.TestCase):
             self.assertEqual(len(self.get_locks()), 1)
         self.assertEqual(len(self.get_locks()), 0)
 
+    def test_context_manager_releases_on_error(self):
+        def _raise():
+            with self.lock_manager.acquire('/test'):
+                raise ValueError()
+        self.assertRaises(ValueError, _raise)
+        self.assertEqual(len(self.get_locks()), 0)
+        self.assertEqual(self.lock.release.call_count, 1)
+
+    @mock.patch('time.time', mock.MagicMock(return_value=1))
+    def test_acquire_timeout(self):
+        self.lock.acquire.side_effect = IOError
+
+        def _acquire():
+            with self.lock_manager.acquire('/instances/foo', timeout=5):
+                pass
+        self.assertRaises(locks.LockNotAcquired, _acquire)
+        self.lock.acquire.assert_called_once_with(timeout=5)
+        self.stats_client.incr.assert_called_once_with(
+            'instances.acquire_timeout')
+        self.assertEqual(len(self.get_locks()), 0)
+
+    def test_acquire_without_timeout_reraises(self):
+        self.lock.acquire.side_effect = IOError
+
+        def _acquire():
+            with self.lock_manager.acquire('/instances/foo'):
+                pass
+        self.assertRaises(IOError, _acquire)
+
+    @mock.patch('time.time', mock.MagicMock(return_value=1))
+    def test_acquire_reports_wait_time(self):
+        def _acquire(timeout=None):
+            time.time.return_value = 1.25
+        self.lock.acquire.side_effect = _acquire
+
+        with self.lock_manager.acquire('/instances/foo'):
+            pass
+        self.stats_client.timing.assert_any_call('instances.acquire_wait', 250)
+
+    @mock.patch('time.time', mock.MagicMock(return_value=1))
+    def test_release_reports_hold_time(self):
+        with self.lock_manager.acquire('/instances/foo'):
+            time.time.return_value = 3.5
+        self.stats_client.timing.assert_called_with('instances.hold', 2500)
+
+    def test_try_acquire(self):
+        self.lock.is_locked.return_value = False
+        with self.lock_manager.try_acquire('/instances/foo') as acquired:
+            self.assertTrue(acquired)
+            self.assertEqual(len(self.get_locks()), 1)
+        self.lock.acquire.assert_called_once_with(
+            timeout=locks.TRY_ACQUIRE_TIMEOUT)
+        self.assertEqual(len(self.get_locks()), 0)
+
+    def test_try_acquire_contended(self):
+        self.lock.is_locked.return_value = True
+        with self.lock_manager.try_acquire('/instances/foo') as acquired:
+            self.assertFalse(acquired)
+            self.assertEqual(len(self.get_locks()), 0)
+        self.assertEqual(self.lock.acquire.call_count, 0)
+        self.assertEqual(self.lock.release.call_count, 0)
+        self.stats_client.incr.assert_called_once_with('instances.contended')
+
+    def test_reentrant_acquire(self):
+        with self.lock_manager.acquire('/instances/foo'):
+            with self.lock_manager.acquire('/instances/foo'):
+                self.assertEqual(len(self.get_locks()), 1)
+            self.assertEqual(len(self.get_locks()), 1)
+            self.assertEqual(self.lock.release.call_count, 0)
+        self.assertEqual(len(self.get_locks()), 0)
+        self.assertEqual(self.client.get_lock.call_count, 1)
+        self.assertEqual(self.lock.acquire.call_count, 1)
+        self.assertEqual(self.lock.release.call_count, 1)
+        self.stats_client.incr.assert_any_call('instances.reentrant')
+
+    def test_local_contention_skips_etcd(self):
+        acquired = threading.Event()
+        release = threading.Event()
+
+        def _hold():
+            with self.lock_manager.acquire('/instances/foo'):
+                acquired.set()
+                release.wait()
+
+        thread = threading.Thread(target=_hold)
+        thread.start()
+        acquired.wait()
+
+        with self.lock_manager.try_acquire('/instances/foo') as got_lock:
+            self.assertFalse(got_lock)
+
+        def _acquire():
+            with self.lock_manager.acquire('/instances/foo', timeout=0.01):
+                pass
+        self.assertRaises(locks.LockNotAcquired, _acquire)
+
+        release.set()
+        thread.join()
+        self.assertEqual(self.client.get_lock.call_count, 1)
+        self.assertEqual(self.lock.is_locked.call_count, 0)
+
+        with self.lock_manager.acquire('/instances/foo', timeout=0.01):
+            self.assertEqual(self.client.get_lock.call_count, 2)
+
+    def test_lost_lock_release(self):
+        self.lock.is_locked.return_value = False
+        with self.lock_manager.acquire('/instances/foo'):
+            self.lock_manager._release_remote('/instances/foo')
+        self.assertEqual(self.lock.release.call_count, 1)
+        with self.lock_manager.try_acquire('/instances/foo') as acquired:
+            self.assertTrue(acquired)
+
+    def test_key_prefix(self):
+        self.assertEqual(locks._key_prefix('/instances/foo'), 'instances')
+        self.assertEqual(locks._key_prefix('chassis/foo/bar'), 'chassis')
+        self.assertEqual(locks._key_prefix('/'), 'root')
+
+    def _stop_renewal_thread(self):
+        """Stop the background renewal thread and run renewals in the
+        calling thread, so tests can drive `_check_locks` themselves.
+        """
+        self.lock_manager.stopping = True
+        self.lock_manager._event.set()
+        self.lock_manager._thread.join()
+        self.lock_manager._pool = SynchronousPool()
+
     @mock.patch('time.time', mock.MagicMock(return_value=1))
     def test_lock_does_not_renew_early(self):
+        self._stop_renewal_thread()
         with self.lock_manager.acquire('/test'):
             time.time.return_value = 1.3
-            # give the thread just enough time to run once
-            time.sleep(0.01)
+            self.lock_manager._check_locks()
             lock = self.get_locks()[0]
             self.assertEqual(lock.renew.call_count, 0)
 
     @mock.patch('time.time', mock.MagicMock(return_value=1))
     def test_lock_does_renew(self):
+        self._stop_renewal_thread()
         with self.lock_manager.acquire('/test'):
             time.time.return_value = 1.4
-            # give the thread just enough time to run once
-            time.sleep(0.01)
+            self.lock_manager._check_locks()
             lock = self.get_locks()[0]
             self.assertEqual(lock.renew.call_count, 1)
 
@@ -112,8 +255,69 @@ class EtcdLockManagerTestCase(unittest.TestCase):
         self.assertEqual(self.lock.expires_at, 5)
         self.assertEqual(next_update, 3)
 
+    def _add_lock(self, lock):
+        self.lock_manager._locks = {lock.key: lock}
+        self.lock_manager._renewals = []
+        self.lock_manager._schedule(lock,
+                                    lock.expires_at - lock.two_thirds_ttl)
+
+    @mock.patch('time.time', mock.MagicMock(return_value=1))
+    def test_check_and_renew_counts_renewals(self):
+        self.lock.ttl = 3
+        self.lock.expires_at = 0
+        self.lock.two_thirds_ttl = 2
+
+        self.lock_manager._check_and_renew(self.lock)
+        self.stats_client.incr.assert_called_once_with('test.renewed')
+
+    @mock.patch('time.time', mock.MagicMock(return_value=1))
+    def test_check_and_renew_lost_lock(self):
+        self.lock.ttl = 3
+        self.lock.expires_at = 0
+        self.lock.two_thirds_ttl = 2
+        self.lock.acquired_at = 0
+        self.lock.renew.side_effect = etcd.EtcdException
+        self.lock_manager._locks = {self.lock.key: self.lock}
+
+        self.lock_manager._check_and_renew(self.lock)
+        self.stats_client.incr.assert_called_once_with('test.lost')
+        self.assertEqual(len(self.get_locks()), 0)
+
+    @mock.patch('time.time', mock.MagicMock(return_value=1))
+    def test_check_and_renew_released_lock(self):
+        self.lock.ttl = 3
+        self.lock.expires_at = 0
+        self.lock.two_thirds_ttl = 2
+        self.lock.renew.side_effect = etcd.EtcdException
+        self.lock_manager._locks = {}
+
+        self.lock_manager._check_and_renew(self.lock)
+        self.assertEqual(self.stats_client.incr.call_count, 0)
+
+    def test_release_remote_skips_reacquired_lock(self):
+        newer_lock = mock.Mock(autospec=MockLock)
+        newer_lock.key = self.lock.key
+        newer_lock.acquired_at = 0
+        self.lock_manager._locks = {self.lock.key: newer_lock}
+
+        released = self.lock_manager._release_remote(self.lock.key, self.lock)
+        self.assertFalse(released)
+        self.assertEqual(self.lock_manager._locks,
+                         {self.lock.key: newer_lock})
+        self.assertEqual(newer_lock.release.call_count, 0)
+        self.assertEqual(self.lock.release.call_count, 0)
+
+        released = self.lock_manager._release_remote(newer_lock.key,
+                                                     newer_lock)
+        self.assertTrue(released)
+        self.assertEqual(self.lock_manager._locks, {})
+        self.assertEqual(newer_lock.release.call_count, 1)
+
     @mock.patch('time.time', mock.MagicMock(return_value=1))
     def test_check_locks(self):
+        self.lock_manager._pool = mock.Mock()
+        apply_async = self.lock_manager._pool.apply_async
+
         self.lock_manager._locks = {}
         next_update = self.lock_manager._check_locks()
         self.assertEqual(next_update, 61)
@@ -121,20 +325,162 @@ class EtcdLockManagerTestCase(unittest.TestCase):
         self.lock.ttl = 3
         self.lock.expires_at = 4
         self.lock.two_thirds_ttl = 2
-        self.lock_manager._locks = {self.lock.key: self.lock}
+        self._add_lock(self.lock)
         next_update = self.lock_manager._check_locks()
         self.assertEqual(next_update, 2)
 
         self.lock.ttl = 3
         self.lock.expires_at = 5
         self.lock.two_thirds_ttl = 2
-        self.lock_manager._locks = {self.lock.key: self.lock}
+        self._add_lock(self.lock)
         next_update = self.lock_manager._check_locks()
         self.assertEqual(next_update, 3)
+        self.assertEqual(apply_async.call_count, 0)
 
         self.lock.ttl = 300
         self.lock.expires_at = 0
         self.lock.two_thirds_ttl = 200
-        self.lock_manager._locks = {self.lock.key: self.lock}
+        self._add_lock(self.lock)
+        next_update = self.lock_manager._check_locks()
+        self.assertEqual(next_update, 61)
+        apply_async.assert_called_once_with(self.lock_manager._renew,
+                                            (self.lock, -200))
+        self.assertEqual(self.lock_manager._renewals, [])
+
+    @mock.patch('time.time', mock.MagicMock(return_value=1))
+    def test_check_locks_skips_released_locks(self):
+        self.lock_manager._pool = mock.Mock()
+        self.lock.expires_at = 0
+        self.lock.two_thirds_ttl = 200
+        self._add_lock(self.lock)
+        self.lock_manager._locks = {}
+
         next_update = self.lock_manager._check_locks()
         self.assertEqual(next_update, 61)
+        self.assertEqual(self.lock_manager._pool.apply_async.call_count, 0)
+
+    @mock.patch('time.time', mock.MagicMock(return_value=3))
+    def test_renew_reschedules_and_reports_lag(self):
+        self.lock.ttl = 3
+        self.lock.expires_at = 2
+        self.lock.two_thirds_ttl = 2
+        self.lock_manager._locks = {self.lock.key: self.lock}
+
+        self.lock_manager._renew(self.lock, 1)
+
+        self.assertEqual(self.lock.renew.call_count, 1)
+        self.stats_client.timing.assert_called_once_with('test.renewal_lag',
+                                                         2000)
+        self.assertEqual(self.lock_manager._renewals[0][0], 4)
+        self.assertEqual(self.lock_manager._renewals[0][2], self.lock)
+
+    @mock.patch('time.time', mock.MagicMock(return_value=3))
+    def test_renew_retries_on_unexpected_error(self):
+        self.lock.ttl = 3
+        self.lock.expires_at = 2
+        self.lock.two_thirds_ttl = 2
+        self.lock.renew.side_effect = IOError
+        self.lock_manager._locks = {self.lock.key: self.lock}
+
+        self.lock_manager._renew(self.lock, 3)
+
+        renew_at = 3 + locks.RENEWAL_RETRY_DELAY
+        self.assertEqual(self.lock_manager._renewals[0][0], renew_at)
+
+
+class MemoryLockTestCase(unittest.TestCase):
+    def setUp(self):
+        self.client = locks.MemoryLockClient()
+
+    def test_acquire_and_release(self):
+        lock = self.client.get_lock('/test', ttl=10)
+        other = self.client.get_lock('/test', ttl=10)
+        self.assertFalse(other.is_locked())
+
+        lock.acquire()
+        self.assertTrue(other.is_locked())
+        self.assertRaises(etcd.EtcdException, other.acquire, timeout=0.01)
+        self.assertRaises(etcd.EtcdException, other.release)
+
+        lock.release()
+        self.assertFalse(other.is_locked())
+        other.acquire(timeout=0.01)
+        self.assertTrue(lock.is_locked())
+
+    def test_keys_are_independent(self):
+        self.client.get_lock('/test', ttl=10).acquire()
+        self.client.get_lock('/other', ttl=10).acquire(timeout=0.01)
+
+    def test_lock_expires(self):
+        lock = self.client.get_lock('/test', ttl=0.05)
+        lock.acquire()
+        # waits for the first holder's TTL to run out
+        self.client.get_lock('/test', ttl=10).acquire(timeout=1)
+        self.assertRaises(etcd.EtcdException, lock.renew, 10)
+        self.assertRaises(etcd.EtcdException, lock.release)
+
+    def test_renew(self):
+        lock = self.client.get_lock('/test', ttl=0.05)
+        lock.acquire()
+        lock.renew(10)
+        time.sleep(0.06)
+        self.assertTrue(lock.is_locked())
+        lock.release()
+
+    def test_zero_ttl_never_expires(self):
+        lock = self.client.get_lock('/test', ttl=0)
+        lock.acquire()
+        self.assertEqual(self.client._holders['/test'][1], None)
+
+    def test_release_wakes_waiters(self):
+        lock = self.client.get_lock('/test', ttl=10)
+        lock.acquire()
+        timer = threading.Timer(0.05, lock.release)
+        timer.start()
+        self.client.get_lock('/test', ttl=10).acquire(timeout=1)
+        timer.join()
+
+
+class MemoryLockManagerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.client = locks.MemoryLockClient()
+        self.stats_client = mock.Mock(spec=statsd.StatsClient)
+        self.lock_managers = [
+            locks.MemoryLockManager(config.Config(),
+                                    client=self.client,
+                                    stats_client=self.stats_client)
+            for i in range(2)]
+
+    def test_acquire_excludes_other_managers(self):
+        first, second = self.lock_managers
+        with first.acquire('/instances/foo'):
+            with second.try_acquire('/instances/foo') as acquired:
+                self.assertFalse(acquired)
+
+            def _acquire():
+                with second.acquire('/instances/foo', timeout=0.01):
+                    pass
+            self.assertRaises(locks.LockNotAcquired, _acquire)
+
+        with second.try_acquire('/instances/foo') as acquired:
+            self.assertTrue(acquired)
+
+    def test_held_lock_is_renewed(self):
+        first, second = self.lock_managers
+        with first.acquire('/instances/foo', ttl=0.06):
+            time.sleep(0.15)
+            with second.try_acquire('/instances/foo') as acquired:
+                self.assertFalse(acquired)
+        self.stats_client.timing.assert_any_call('instances.renewal_lag',
+                                                 mock.ANY)
+
+    def test_get_lock_manager(self):
+        _config = config.Config(LOCK_MANAGER='memory')
+        with mock.patch.object(locks, 'driver') as driver_mock:
+            lock_manager = locks.get_lock_manager(_config)
+            self.assertIs(locks.get_lock_manager(_config), lock_manager)
+        driver_mock.DriverManager.assert_called_once_with(
+            namespace='teeth_overlord.lock.managers',
+            name='memory',
+            invoke_on_load=True,
+            invoke_args=[_config])
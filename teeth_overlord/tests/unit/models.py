@@ -0,0 +1,205 @@
+"""
+Copyright 2013 Rackspace, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+import datetime
+import mock
+import unittest
+
+from cqlengine import models as cqlengine_models
+
+from teeth_overlord import models
+
+
+class LookupTestCase(unittest.TestCase):
+    def setUp(self):
+        save_patcher = mock.patch.object(cqlengine_models.BaseModel, 'save',
+                                         autospec=True)
+        self.save_mock = save_patcher.start()
+        self.addCleanup(save_patcher.stop)
+        delete_patcher = mock.patch.object(cqlengine_models.BaseModel,
+                                           'delete',
+                                           autospec=True)
+        self.delete_mock = delete_patcher.start()
+        self.addCleanup(delete_patcher.stop)
+
+    def _saved(self, cls):
+        return [args[0] for args, kwargs in self.save_mock.call_args_list
+                if isinstance(args[0], cls)]
+
+    def _deleted(self, cls):
+        return [args[0] for args, kwargs in self.delete_mock.call_args_list
+                if isinstance(args[0], cls)]
+
+    def _persist(self, instance):
+        """Mark `instance` as loaded from the database."""
+        instance._is_persisted = True
+        for value in instance._values.values():
+            value.reset_previous_value()
+
+    def test_new_row_is_added(self):
+        models.Instance(id='instance',
+                        state=models.InstanceState.INACTIVE).save()
+
+        lookups = self._saved(models.InstanceByState)
+        self.assertEqual(len(lookups), 1)
+        self.assertEqual(lookups[0].instance_id, 'instance')
+        self.assertEqual(lookups[0].state, models.InstanceState.INACTIVE)
+
+    def test_changed_row_is_moved(self):
+        chassis = models.Chassis(id='chassis',
+                                 state=models.ChassisState.READY,
+                                 chassis_model_id='model')
+        self._persist(chassis)
+
+        chassis.state = models.ChassisState.BUILD
+        chassis.save()
+
+        for lookup in (models.ChassisByState, models.ChassisByStateAndModel):
+            deleted = self._deleted(lookup)
+            self.assertEqual(len(deleted), 1)
+            self.assertEqual(deleted[0].state, models.ChassisState.READY)
+            saved = self._saved(lookup)
+            self.assertEqual(len(saved), 1)
+            self.assertEqual(saved[0].state, models.ChassisState.BUILD)
+
+    def test_unchanged_row_is_untouched(self):
+        chassis = models.Chassis(id='chassis',
+                                 state=models.ChassisState.READY,
+                                 chassis_model_id='model')
+        self._persist(chassis)
+
+        chassis.agent_id = 'agent'
+        chassis.save()
+
+        self.assertEqual(self._saved(models.ChassisByState), [])
+        self.assertEqual(self.delete_mock.call_count, 0)
+
+    def test_incomplete_key_is_skipped(self):
+        # no chassis_model_id
+        models.Chassis(id='chassis', state=models.ChassisState.READY).save()
+
+        self.assertEqual(len(self._saved(models.ChassisByState)), 1)
+        self.assertEqual(self._saved(models.ChassisByStateAndModel), [])
+
+    def test_cached_image_is_indexed(self):
+        chassis = models.Chassis(id='chassis',
+                                 state=models.ChassisState.READY,
+                                 chassis_model_id='model')
+        self._persist(chassis)
+
+        chassis.cached_image_id = 'image'
+        chassis.save()
+
+        self.assertEqual(self._deleted(models.ChassisByCachedImage), [])
+        saved = self._saved(models.ChassisByCachedImage)
+        self.assertEqual(len(saved), 1)
+        self.assertEqual(saved[0].cached_image_id, 'image')
+        self.assertEqual(saved[0].chassis_id, 'chassis')
+
+    @mock.patch.object(models.Chassis, 'objects')
+    def test_changed_row_is_moved_from_loaded_key(self, objects_mock):
+        chassis = models.Chassis(id='chassis',
+                                 state=models.ChassisState.READY,
+                                 chassis_model_id='model',
+                                 cached_image_id='old_image')
+        self._persist(chassis)
+
+        chassis.cached_image_id = 'image'
+        chassis.save()
+
+        # the stored row isn't read back
+        self.assertEqual(objects_mock.mock_calls, [])
+        deleted = self._deleted(models.ChassisByCachedImage)
+        self.assertEqual(len(deleted), 1)
+        self.assertEqual(deleted[0].state, models.ChassisState.READY)
+        self.assertEqual(deleted[0].cached_image_id, 'old_image')
+        saved = self._saved(models.ChassisByCachedImage)
+        self.assertEqual(len(saved), 1)
+        self.assertEqual(saved[0].state, models.ChassisState.READY)
+        self.assertEqual(saved[0].cached_image_id, 'image')
+        for lookup in (models.ChassisByState, models.ChassisByStateAndModel):
+            self.assertEqual(self._saved(lookup), [])
+            self.assertEqual(self._deleted(lookup), [])
+
+    def test_delete(self):
+        models.Instance(id='instance',
+                        state=models.InstanceState.INACTIVE).delete()
+
+        deleted = self._deleted(models.InstanceByState)
+        self.assertEqual(len(deleted), 1)
+        self.assertEqual(deleted[0].instance_id, 'instance')
+
+
+class VersionTestCase(unittest.TestCase):
+    def test_version_changes_with_columns(self):
+        instance = models.Instance(id='instance',
+                                   state=models.InstanceState.ACTIVE,
+                                   network_ids=set(['a', 'b']))
+        version = instance.get_version()
+
+        self.assertEqual(instance.get_version(), version)
+        instance.state = models.InstanceState.DELETED
+        self.assertNotEqual(instance.get_version(), version)
+
+    def test_version_ignores_ordering(self):
+        metadata = dict(('key{}'.format(i), str(i)) for i in xrange(32))
+        first = models.Chassis(id='chassis', metadata=metadata)
+        second = models.Chassis(id='chassis',
+                                metadata=dict(reversed(metadata.items())))
+
+        self.assertEqual(first.get_version(), second.get_version())
+
+
+class ImageDemandTestCase(unittest.TestCase):
+    def setUp(self):
+        save_patcher = mock.patch.object(cqlengine_models.BaseModel, 'save',
+                                         autospec=True)
+        self.save_mock = save_patcher.start()
+        self.addCleanup(save_patcher.stop)
+        objects_patcher = mock.patch.object(models.ImageDemand, 'objects')
+        self.objects_mock = objects_patcher.start()
+        self.addCleanup(objects_patcher.stop)
+
+    @mock.patch('datetime.datetime', mock.Mock(**{
+        'utcnow.return_value': datetime.datetime(2014, 2, 1, 12)}))
+    def test_record(self):
+        models.ImageDemand.record('flavor', 'image')
+
+        demand = self.save_mock.call_args[0][0]
+        self.assertEqual(demand.flavor_id, 'flavor')
+        self.assertEqual(demand.day, '2014-02-01')
+        self.assertEqual(demand.image_id, 'image')
+        self.assertEqual(demand.builds, 1)
+
+    @mock.patch('datetime.datetime', mock.Mock(**{
+        'utcnow.return_value': datetime.datetime(2014, 2, 1, 12)}))
+    def test_get_popular(self):
+        days = {
+            '2014-02-01': [models.ImageDemand(image_id='a', builds=1),
+                           models.ImageDemand(image_id='b', builds=2)],
+            '2014-01-31': [models.ImageDemand(image_id='a', builds=3)],
+        }
+        self.objects_mock.filter.side_effect = (
+            lambda flavor_id, day: days.get(day, []))
+
+        popular = models.ImageDemand.get_popular('flavor', 3)
+
+        self.assertEqual(popular, [('a', 4), ('b', 2)])
+        self.assertEqual(
+            [kwargs['day'] for args, kwargs
+             in self.objects_mock.filter.call_args_list],
+            ['2014-02-01', '2014-01-31', '2014-01-30'])
@@ -0,0 +1,120 @@
+"""
+Copyright 2013 Rackspace, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+import mock
+import unittest
+
+from teeth_overlord import config
+from teeth_overlord.networks import base
+
+
+class PortNetworkProvider(base.BaseNetworkProvider):
+    """Provider with only per-port operations, which are mocked."""
+    attach = None
+    detach = None
+    delete_port = None
+
+    def __init__(self, config):
+        super(PortNetworkProvider, self).__init__(config)
+        self.attach = mock.Mock()
+        self.detach = mock.Mock()
+        self.delete_port = mock.Mock()
+
+    def list_networks(self):
+        pass
+
+    def get_network_info(self, network_id):
+        pass
+
+    def list_ports(self, mac_address):
+        pass
+
+    def get_default_networks(self):
+        pass
+
+    def get_service_network(self):
+        pass
+
+
+class TestBaseNetworkProvider(unittest.TestCase):
+    def setUp(self):
+        self.provider = PortNetworkProvider(config.LazyConfig(config={
+            'NETWORK_PORT_THREADS': 4,
+        }))
+
+    def test_attach_many(self):
+        self.provider.attach.side_effect = lambda mac, network: (mac, network)
+
+        ports = self.provider.attach_many(['mac1', 'mac2'], ['net1', 'net2'])
+
+        self.assertEqual(ports, [('mac1', 'net1'), ('mac2', 'net1'),
+                                 ('mac1', 'net2'), ('mac2', 'net2')])
+        self.assertEqual(self.provider.detach.call_count, 0)
+
+    def test_attach_many_rolls_back(self):
+        def _attach(mac, network):
+            if network == 'net2':
+                raise self.provider.NetworkDoesNotExist(network)
+            return base.PortInfo(id='{}-{}'.format(mac, network))
+
+        self.provider.attach.side_effect = _attach
+
+        try:
+            self.provider.attach_many(['mac1', 'mac2'], ['net1', 'net2'])
+        except self.provider.PortOperationsFailed as e:
+            self.assertEqual(len(e.errors), 2)
+        else:
+            self.fail('PortOperationsFailed not raised')
+
+        # only the ports created by this call are removed
+        self.assertEqual(self.provider.detach.call_count, 0)
+        self.assertEqual(sorted(self.provider.delete_port.call_args_list),
+                         [mock.call('mac1-net1'),
+                          mock.call('mac2-net1')])
+
+    def test_attach_many_rollback_errors(self):
+        def _attach(mac, network):
+            if mac == 'mac2':
+                raise self.provider.NetworkProviderException('attach')
+            return base.PortInfo(id='port')
+
+        self.provider.attach.side_effect = _attach
+        exc = self.provider.NetworkProviderException('delete')
+        self.provider.delete_port.side_effect = exc
+
+        try:
+            self.provider.attach_many(['mac1', 'mac2'], ['net1'])
+        except self.provider.PortOperationsFailed as e:
+            self.assertEqual([str(error) for error in e.errors],
+                             ['attach', 'delete'])
+        else:
+            self.fail('PortOperationsFailed not raised')
+
+    def test_detach_many(self):
+        self.provider.detach_many(['mac1', 'mac2'], 'net1')
+
+        self.assertEqual(sorted(self.provider.detach.call_args_list),
+                         [mock.call('mac1', 'net1'),
+                          mock.call('mac2', 'net1')])
+
+    def test_detach_many_errors(self):
+        exc = self.provider.NetworkProviderException('detach')
+        self.provider.detach.side_effect = exc
+
+        self.assertRaises(self.provider.PortOperationsFailed,
+                          self.provider.detach_many,
+                          ['mac1', 'mac2'])
@@ -15,8 +15,11 @@ limitations under the License.
 """
 
 import collections
+import datetime
+import mock
 
 from teeth_overlord import config
+from teeth_overlord import keystone
 from teeth_overlord.networks import neutron
 from teeth_overlord import tests
 
@@ -207,6 +210,11 @@ class TestNeutronProvider(tests.TeethMockTestUtilities):
             'NEUTRON_PUBLIC_NETWORK': 'd6b32008-1432-4299-81c7-cbe3128ba13f',
             'NEUTRON_PRIVATE_NETWORK': '2afa16d6-7b84-484f-a642-af243b0e5b10',
             'NEUTRON_SERVICE_NETWORK': '2afa16d6-7b84-484f-a642-af243b0e5b10',
+            'PROVIDER_CACHE_TTL': 60,
+            'PROVIDER_CACHE_NEGATIVE_TTL': 5,
+            'PROVIDER_CACHE_SIZE': 1000,
+            'JOB_EXECUTION_THREADS': 16,
+            'NETWORK_PORT_THREADS': 8,
         })
 
         self.neutron_client_mock = self.add_mock(neutron_client, 'Client')
@@ -214,6 +222,14 @@ class TestNeutronProvider(tests.TeethMockTestUtilities):
 
         self.keystone_client_mock = self.add_mock(keystone_client, 'Client')
         self.keystone_client_mock.return_value.auth_token = 'auth_token'
+        self.keystone_client_mock.return_value.auth_ref.expires = (
+            datetime.datetime(2100, 1, 1))
+        # don't share tokens between tests
+        token_cache_patcher = mock.patch.object(keystone,
+                                                'token_cache',
+                                                keystone.TokenCache())
+        token_cache_patcher.start()
+        self.addCleanup(token_cache_patcher.stop)
 
         self.provider = neutron.NeutronProvider(self.config)
 
@@ -252,14 +268,23 @@ class TestNeutronProvider(tests.TeethMockTestUtilities):
         self.assertRaises(self.provider.NetworkProviderException,
                           self.provider._get_neutron_client)
 
+    def test_get_neutron_client_reauthenticates(self):
+        client = self.provider._get_neutron_client()
+        client.httpclient.auth_token = 'auth_token'
+        self.keystone_client_mock.return_value.auth_token = 'new_token'
+
+        client.httpclient.authenticate()
+
+        self.assertEqual(client.httpclient.auth_token, 'new_token')
+        self.assertEqual(self.keystone_client_mock.call_count, 2)
+        self.assertEqual(self.provider._get_auth_token(), 'new_token')
+
     def test_list_networks(self):
         networks = {'networks': [NETWORK1_RESPONSE,
                                  NETWORK2_RESPONSE]}
         self.neutron_mock.list_networks.return_value = networks
-        self.neutron_mock.show_subnet.side_effect = [
-            {'subnet': SUBNET1_RESPONSE},
-            {'subnet': SUBNET2_RESPONSE}
-        ]
+        subnets = {'subnets': [SUBNET1_RESPONSE, SUBNET2_RESPONSE]}
+        self.neutron_mock.list_subnets.return_value = subnets
 
         networks = self.provider.list_networks()
 
@@ -269,6 +294,85 @@ class TestNeutronProvider(tests.TeethMockTestUtilities):
         ]
 
         self.assertEqual([n.serialize() for n in networks], results)
+        self.assertEqual(self.neutron_mock.list_subnets.call_count, 1)
+        ids = self.neutron_mock.list_subnets.call_args[1]['id']
+        self.assertEqual(sorted(ids), ['SUBNET1', 'SUBNET2'])
+
+    def test_list_networks_batches_subnets(self):
+        count = neutron.MAX_IDS_PER_REQUEST + 1
+        subnets = [dict(SUBNET1_RESPONSE, id='SUBNET{}'.format(i))
+                   for i in range(count)]
+        network = dict(NETWORK1_RESPONSE, subnets=[s['id'] for s in subnets])
+        self.neutron_mock.list_networks.return_value = {'networks': [network]}
+        self.neutron_mock.list_subnets.side_effect = lambda id: {
+            'subnets': [s for s in subnets if s['id'] in id]
+        }
+
+        networks = self.provider.list_networks()
+
+        self.assertEqual(len(networks[0].subnets), count)
+        self.assertEqual(self.neutron_mock.list_subnets.call_count, 2)
+
+    def test_list_networks_missing_subnet(self):
+        networks = {'networks': [NETWORK1_RESPONSE]}
+        self.neutron_mock.list_networks.return_value = networks
+        self.neutron_mock.list_subnets.return_value = {'subnets': []}
+
+        self.assertRaises(self.provider.SubnetDoesNotExist,
+                          self.provider.list_networks)
+
+    def test_neutron_client_reused(self):
+        self.neutron_mock.list_networks.return_value = {'networks': []}
+
+        self.provider.list_networks()
+        self.provider.list_networks()
+
+        self.assertEqual(self.neutron_client_mock.call_count, 1)
+
+    def test_neutron_client_discarded_after_error(self):
+        exc = neutron_exceptions.NeutronException()
+        self.neutron_mock.list_networks.side_effect = [exc, {'networks': []}]
+
+        self.assertRaises(self.provider.NetworkProviderException,
+                          self.provider.list_networks)
+        self.provider.list_networks()
+
+        self.assertEqual(self.neutron_client_mock.call_count, 2)
+
+    def test_list_networks_paged(self):
+        networks = {'networks': [NETWORK2_RESPONSE]}
+        self.neutron_mock.list_networks.return_value = iter([networks])
+        subnets = {'subnets': [SUBNET2_RESPONSE]}
+        self.neutron_mock.list_subnets.return_value = subnets
+
+        networks = self.provider.list_networks(marker='NETWORK1', limit=1)
+
+        self.neutron_mock.list_networks.assert_called_once_with(
+            retrieve_all=False, marker='NETWORK1', limit=1)
+        self.assertEqual([n.serialize() for n in networks],
+                         [SERIALIZED_NETWORK2])
+
+    def test_list_networks_paged_without_neutron_pagination(self):
+        networks = {'networks': [NETWORK1_RESPONSE, NETWORK2_RESPONSE]}
+        self.neutron_mock.list_networks.return_value = iter([networks])
+        subnets = {'subnets': [SUBNET1_RESPONSE, SUBNET2_RESPONSE]}
+        self.neutron_mock.list_subnets.return_value = subnets
+
+        first = self.provider.list_networks(limit=1)
+        self.neutron_mock.list_networks.return_value = iter([networks])
+        second = self.provider.list_networks(marker='NETWORK1', limit=1)
+
+        self.assertEqual([n.id for n in first], ['NETWORK1'])
+        self.assertEqual([n.id for n in second], ['NETWORK2'])
+
+    def test_list_networks_unknown_marker(self):
+        exc = neutron_exceptions.NeutronException()
+        exc.message = '404 Not Found'
+        self.neutron_mock.list_networks.side_effect = exc
+
+        self.assertRaises(self.provider.NetworkDoesNotExist,
+                          self.provider.list_networks,
+                          'foo', 1)
 
     def test_list_networks_empty(self):
         self.neutron_mock.list_networks.return_value = {'networks': []}
@@ -288,9 +392,8 @@ class TestNeutronProvider(tests.TeethMockTestUtilities):
     def test_get_network_info(self):
         network = {'network': NETWORK1_RESPONSE}
         self.neutron_mock.show_network.return_value = network
-        self.neutron_mock.show_subnet.side_effect = [
-            {'subnet': SUBNET1_RESPONSE}
-        ]
+        subnets = {'subnets': [SUBNET1_RESPONSE]}
+        self.neutron_mock.list_subnets.return_value = subnets
 
         network = self.provider.get_network_info('NETWORK1')
 
@@ -306,6 +409,31 @@ class TestNeutronProvider(tests.TeethMockTestUtilities):
                           self.provider.get_network_info,
                           'NETWORK1')
 
+    def test_get_network_info_cached(self):
+        network = {'network': NETWORK1_RESPONSE}
+        self.neutron_mock.show_network.return_value = network
+        self.neutron_mock.list_subnets.return_value = {
+            'subnets': [SUBNET1_RESPONSE]
+        }
+
+        self.provider.get_network_info('NETWORK1')
+        network = self.provider.get_network_info('NETWORK1')
+
+        self.assertEqual(network.serialize(), SERIALIZED_NETWORK1)
+        self.neutron_mock.show_network.assert_called_once_with('NETWORK1')
+        self.assertEqual(self.keystone_client_mock.call_count, 1)
+
+    def test_get_network_info_does_not_exist_cached(self):
+        exc = neutron_exceptions.NeutronException()
+        exc.message = '404 Not Found'
+        self.neutron_mock.show_network.side_effect = exc
+
+        for i in range(2):
+            self.assertRaises(self.provider.NetworkDoesNotExist,
+                              self.provider.get_network_info,
+                              'NETWORK1')
+        self.assertEqual(self.neutron_mock.show_network.call_count, 1)
+
     def test_get_network_info_client_exception(self):
         exc = neutron_exceptions.NeutronException()
         self.neutron_mock.show_network.side_effect = exc
@@ -315,25 +443,39 @@ class TestNeutronProvider(tests.TeethMockTestUtilities):
                           'NETWORK1')
 
     def test_list_ports(self):
-        ports = {'ports': [PORT1_RESPONSE]}
+        ports = {'ports': [PORT1_RESPONSE, PORT1_RESPONSE]}
         self.neutron_mock.list_ports.return_value = ports
-        network = {'network': NETWORK1_RESPONSE}
-        self.neutron_mock.show_network.return_value = network
-        subnet = {'subnet': SUBNET1_RESPONSE}
-        self.neutron_mock.show_subnet.return_value = subnet
+        networks = {'networks': [NETWORK1_RESPONSE]}
+        self.neutron_mock.list_networks.return_value = networks
+        subnets = {'subnets': [SUBNET1_RESPONSE]}
+        self.neutron_mock.list_subnets.return_value = subnets
 
         ports = self.provider.list_ports('a:b:c:d')
 
-        self.assertEqual([p.serialize() for p in ports], [SERIALIZED_PORT1])
+        self.assertEqual([p.serialize() for p in ports],
+                         [SERIALIZED_PORT1, SERIALIZED_PORT1])
         self.neutron_mock.list_ports.assert_called_with(mac_address='a:b:c:d')
+        self.neutron_mock.list_networks.assert_called_once_with(
+            id=['NETWORK1'])
+        self.neutron_mock.list_subnets.assert_called_once_with(id=['SUBNET1'])
+        self.assertEqual(self.neutron_mock.show_network.call_count, 0)
+
+    def test_list_ports_missing_network(self):
+        ports = {'ports': [PORT1_RESPONSE]}
+        self.neutron_mock.list_ports.return_value = ports
+        self.neutron_mock.list_networks.return_value = {'networks': []}
+
+        self.assertRaises(self.provider.NetworkDoesNotExist,
+                          self.provider.list_ports,
+                          'a:b:c:d')
 
     def test_attach(self):
         port = {'port': PORT1_RESPONSE}
         self.neutron_mock.create_port.return_value = port
         network = {'network': NETWORK1_RESPONSE}
         self.neutron_mock.show_network.return_value = network
-        subnet = {'subnet': SUBNET1_RESPONSE}
-        self.neutron_mock.show_subnet.return_value = subnet
+        subnets = {'subnets': [SUBNET1_RESPONSE]}
+        self.neutron_mock.list_subnets.return_value = subnets
 
         port = self.provider.attach('a:b:c:d', 'network_id')
 
@@ -359,8 +501,8 @@ class TestNeutronProvider(tests.TeethMockTestUtilities):
         self.neutron_mock.list_ports.return_value = ports
         network = {'network': NETWORK1_RESPONSE}
         self.neutron_mock.show_network.return_value = network
-        subnet = {'subnet': SUBNET1_RESPONSE}
-        self.neutron_mock.show_subnet.return_value = subnet
+        subnets = {'subnets': [SUBNET1_RESPONSE]}
+        self.neutron_mock.list_subnets.return_value = subnets
 
         self.provider.detach('a:b:c:d')
 
@@ -372,8 +514,8 @@ class TestNeutronProvider(tests.TeethMockTestUtilities):
         self.neutron_mock.list_ports.return_value = ports
         network = {'network': NETWORK1_RESPONSE}
         self.neutron_mock.show_network.return_value = network
-        subnet = {'subnet': SUBNET1_RESPONSE}
-        self.neutron_mock.show_subnet.return_value = subnet
+        subnets = {'subnets': [SUBNET1_RESPONSE]}
+        self.neutron_mock.list_subnets.return_value = subnets
 
         self.provider.detach('a:b:c:d', 'network_id')
 
@@ -386,8 +528,8 @@ class TestNeutronProvider(tests.TeethMockTestUtilities):
         self.neutron_mock.list_ports.return_value = ports
         network = {'network': NETWORK1_RESPONSE}
         self.neutron_mock.show_network.return_value = network
-        subnet = {'subnet': SUBNET1_RESPONSE}
-        self.neutron_mock.show_subnet.return_value = subnet
+        subnets = {'subnets': [SUBNET1_RESPONSE]}
+        self.neutron_mock.list_subnets.return_value = subnets
         exc = neutron_exceptions.NeutronException()
         self.neutron_mock.delete_port.side_effect = exc
 
@@ -395,6 +537,133 @@ class TestNeutronProvider(tests.TeethMockTestUtilities):
                           self.provider.detach,
                           'a:b:c:d')
 
+    def test_delete_port(self):
+        self.provider.delete_port('port_id')
+
+        self.neutron_mock.delete_port.assert_called_once_with('port_id')
+
+    def test_delete_port_client_exception(self):
+        exc = neutron_exceptions.NeutronException()
+        self.neutron_mock.delete_port.side_effect = exc
+
+        self.assertRaises(self.provider.NetworkProviderException,
+                          self.provider.delete_port,
+                          'port_id')
+
+    def test_attach_many(self):
+        ports = {'ports': [PORT1_RESPONSE, PORT2_RESPONSE]}
+        self.neutron_mock.create_port.return_value = ports
+        networks = {'networks': [NETWORK1_RESPONSE, NETWORK2_RESPONSE]}
+        self.neutron_mock.list_networks.return_value = networks
+        subnets = {'subnets': [SUBNET1_RESPONSE, SUBNET2_RESPONSE]}
+        self.neutron_mock.list_subnets.return_value = subnets
+
+        ports = self.provider.attach_many(['a:b:c:d', 'e:f:g:h'],
+                                          ['network_id'])
+
+        self.neutron_mock.create_port.assert_called_once_with({
+            'ports': [
+                {
+                    'network_id': 'network_id',
+                    'admin_state_up': True,
+                    'mac_address': 'a:b:c:d'
+                },
+                {
+                    'network_id': 'network_id',
+                    'admin_state_up': True,
+                    'mac_address': 'e:f:g:h'
+                }
+            ]
+        })
+        self.assertEqual(self.neutron_mock.list_networks.call_count, 1)
+        self.assertEqual(self.neutron_mock.show_network.call_count, 0)
+        self.assertEqual(ports[0].serialize(), SERIALIZED_PORT1)
+        self.assertEqual(ports[1].id, PORT2_RESPONSE['id'])
+
+    def test_attach_many_nothing(self):
+        self.assertEqual(self.provider.attach_many(['a:b:c:d'], []), [])
+        self.assertEqual(self.neutron_mock.create_port.call_count, 0)
+
+    def test_attach_many_client_exception(self):
+        exc = neutron_exceptions.NeutronException()
+        self.neutron_mock.create_port.side_effect = exc
+
+        self.assertRaises(self.provider.NetworkProviderException,
+                          self.provider.attach_many,
+                          ['a:b:c:d'], ['network_id'])
+
+    def test_attach_many_missing_network_deletes_ports(self):
+        ports = {'ports': [PORT1_RESPONSE, PORT2_RESPONSE]}
+        self.neutron_mock.create_port.return_value = ports
+        self.neutron_mock.list_networks.return_value = {'networks': []}
+
+        self.assertRaises(self.provider.NetworkDoesNotExist,
+                          self.provider.attach_many,
+                          ['a:b:c:d', 'e:f:g:h'], ['network_id'])
+
+        self.assertEqual(self.neutron_mock.delete_port.call_args_list,
+                         [mock.call(PORT1_RESPONSE['id']),
+                          mock.call(PORT2_RESPONSE['id'])])
+
+    def test_attach_many_describe_exception_deletes_ports(self):
+        ports = {'ports': [PORT1_RESPONSE, PORT2_RESPONSE]}
+        self.neutron_mock.create_port.return_value = ports
+        exc = neutron_exceptions.NeutronException()
+        self.neutron_mock.list_networks.side_effect = exc
+        self.neutron_mock.delete_port.side_effect = [exc, None]
+
+        self.assertRaises(self.provider.NetworkProviderException,
+                          self.provider.attach_many,
+                          ['a:b:c:d', 'e:f:g:h'], ['network_id'])
+
+        # a failed delete doesn't stop the others
+        self.assertEqual(self.neutron_mock.delete_port.call_args_list,
+                         [mock.call(PORT1_RESPONSE['id']),
+                          mock.call(PORT2_RESPONSE['id'])])
+
+    def test_detach_many(self):
+        ports = {'ports': [PORT1_RESPONSE, PORT2_RESPONSE]}
+        self.neutron_mock.list_ports.return_value = ports
+        # created up front, so the deleting threads don't race to create it
+        self.neutron_mock.delete_port = mock.Mock()
+
+        self.provider.detach_many(['a:b:c:d', 'e:f:g:h'])
+
+        self.neutron_mock.list_ports.assert_called_once_with(
+            mac_address=['a:b:c:d', 'e:f:g:h'])
+        self.neutron_mock.delete_port.assert_has_calls(
+            [mock.call(PORT1_RESPONSE['id']),
+             mock.call(PORT2_RESPONSE['id'])],
+            any_order=True)
+
+    def test_detach_many_specific_network(self):
+        self.neutron_mock.list_ports.return_value = {'ports': []}
+
+        self.provider.detach_many(['a:b:c:d'], 'network_id')
+
+        self.neutron_mock.list_ports.assert_called_once_with(
+            mac_address=['a:b:c:d'], network_id='network_id')
+        self.assertEqual(self.neutron_mock.delete_port.call_count, 0)
+
+    def test_detach_many_client_exception(self):
+        ports = {'ports': [PORT1_RESPONSE, PORT2_RESPONSE]}
+        self.neutron_mock.list_ports.return_value = ports
+        exc = neutron_exceptions.NeutronException()
+        self.neutron_mock.delete_port = mock.Mock(side_effect=exc)
+
+        try:
+            self.provider.detach_many(['a:b:c:d', 'e:f:g:h'])
+        except self.provider.PortOperationsFailed as e:
+            self.assertEqual(len(e.errors), 2)
+        else:
+            self.fail('PortOperationsFailed not raised')
+
+        # every port was attempted
+        self.neutron_mock.delete_port.assert_has_calls(
+            [mock.call(PORT1_RESPONSE['id']),
+             mock.call(PORT2_RESPONSE['id'])],
+            any_order=True)
+
     def test_get_default_networks(self):
 
         network_ids = self.provider.get_default_networks()
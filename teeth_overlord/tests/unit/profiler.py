@@ -0,0 +1,80 @@
+"""
+Copyright 2013 Rackspace, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from teeth_overlord import profiler
+
+
+class SamplingProfilerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.output_dir)
+        self.profiler = profiler.SamplingProfiler('test', 0.01,
+                                                  self.output_dir)
+
+    def _read(self, path):
+        with open(path) as f:
+            return dict(line.rsplit(' ', 1) for line in f.read().splitlines())
+
+    def test_sample(self):
+        self.profiler.started_at = 0
+        for i in range(2):
+            self.profiler.sample()
+
+        path = self.profiler.write()
+        self.assertEqual(path, os.path.join(
+            self.output_dir, 'test-{}-0.folded'.format(os.getpid())))
+
+        stacks = self._read(path)
+        sampled = [stack for stack in stacks if 'test_sample' in stack]
+        self.assertEqual(len(sampled), 1)
+        self.assertEqual(stacks[sampled[0]], '2')
+        # root first, leaf last
+        frames = sampled[0].split(';')
+        self.assertTrue(frames[-2].startswith('test_sample '))
+        self.assertTrue(frames[-1].startswith('sample '))
+
+    def test_sample_truncates_deep_stacks(self):
+        self.profiler.started_at = 0
+        with mock.patch.object(profiler, 'MAX_STACK_DEPTH', 2):
+            self.profiler.sample()
+
+        stacks = self._read(self.profiler.write())
+        sampled = [stack for stack in stacks if 'test_sample' in stack]
+        self.assertEqual(len(sampled), 1)
+        frames = sampled[0].split(';')
+        self.assertEqual(len(frames), 2)
+        self.assertTrue(frames[0].startswith(
+            'test_sample_truncates_deep_stacks '))
+        self.assertTrue(frames[1].startswith('sample '))
+
+    def test_start_stop(self):
+        self.assertFalse(self.profiler.running)
+        self.assertEqual(self.profiler.stop(), None)
+
+        self.profiler.toggle()
+        self.assertTrue(self.profiler.running)
+
+        path = self.profiler.stop()
+        self.assertFalse(self.profiler.running)
+        self.assertTrue(os.path.exists(path))
@@ -14,7 +14,10 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import mock
+
 from teeth_overlord import errors
+from teeth_overlord import locks
 from teeth_overlord import models
 from teeth_overlord import scheduler
 from teeth_overlord import tests
@@ -27,8 +30,9 @@ class TestInstanceScheduler(tests.TeethMockTestUtilities):
 
         self.add_mock(models.Instance, 'batch')
         self.add_mock(models.Chassis, 'batch')
+        self.warm_mock = self.add_mock(models.ChassisByCachedImage)
 
-        self.scheduler = scheduler.TeethInstanceScheduler()
+        self.scheduler = scheduler.TeethInstanceScheduler(self.config)
 
         self.instance1 = models.Instance(id='instance1',
                                          name='instance1_name',
@@ -75,6 +79,80 @@ class TestInstanceScheduler(tests.TeethMockTestUtilities):
         chassis_batch_mock = self.get_mock(models.Chassis, 'batch')
         self.assertEqual(chassis_batch_mock().save.call_count, 1)
 
+    def test_reserve_chassis_prefers_cached_image(self):
+        self.add_mock(models.Instance)
+        self.warm_mock.return_value = [
+            models.ChassisByCachedImage(state=models.ChassisState.READY,
+                                        chassis_model_id='chassismodel1',
+                                        cached_image_id='image1',
+                                        chassis_id='chassis1'),
+        ]
+        self.chassis1.chassis_model_id = 'chassismodel1'
+        self.chassis1.cached_image_id = 'image1'
+        chassis_mock = self.add_mock(models.Chassis,
+                                     return_value=[self.chassis1])
+        self.add_mock(models.FlavorProvider,
+                      return_value=[self.flavorprovider1])
+
+        chassis = self.scheduler.reserve_chassis(self.instance1, retry=False)
+
+        self.assertEqual(chassis.id, self.chassis1.id)
+        self.warm_mock.assert_called_once_with(
+            'filter',
+            state=models.ChassisState.READY,
+            chassis_model_id=self.flavorprovider1.chassis_model_id,
+            cached_image_id=self.instance1.image_id)
+        chassis_mock.assert_called_once_with('get', id='chassis1')
+
+    def test_reserve_chassis_skips_stale_cached_image(self):
+        self.add_mock(models.Instance)
+        delete_mock = self.add_mock(models.ChassisByCachedImage, 'delete')
+        self.warm_mock.return_value = [
+            models.ChassisByCachedImage(state=models.ChassisState.READY,
+                                        chassis_model_id='chassismodel1',
+                                        cached_image_id='image1',
+                                        chassis_id='chassis2'),
+        ]
+        building = models.Chassis(id='chassis2',
+                                  state=models.ChassisState.BUILD,
+                                  chassis_model_id='chassismodel1',
+                                  cached_image_id='image1')
+        chassis_mock = self.add_mock(models.Chassis,
+                                     return_value=[self.chassis1])
+        chassis_mock.get = mock.Mock(side_effect=[building, self.chassis1])
+        self.add_mock(models.FlavorProvider,
+                      return_value=[self.flavorprovider1])
+
+        chassis = self.scheduler.reserve_chassis(self.instance1, retry=False)
+
+        # the lookup row is out of date, so a cold chassis is used instead
+        self.assertEqual(chassis.id, self.chassis1.id)
+        self.assertEqual(building.state, models.ChassisState.BUILD)
+        self.assertEqual(chassis_mock.get.call_args_list[0],
+                         mock.call(id='chassis2'))
+        self.assertEqual(delete_mock.call_count, 1)
+
+    def test_reserve_chassis_skips_deleted_cached_image(self):
+        self.add_mock(models.Instance)
+        delete_mock = self.add_mock(models.ChassisByCachedImage, 'delete')
+        self.warm_mock.return_value = [
+            models.ChassisByCachedImage(state=models.ChassisState.READY,
+                                        chassis_model_id='chassismodel1',
+                                        cached_image_id='image1',
+                                        chassis_id='chassis2'),
+        ]
+        chassis_mock = self.add_mock(models.Chassis,
+                                     return_value=[self.chassis1])
+        chassis_mock.get = mock.Mock(
+            side_effect=[models.Chassis.DoesNotExist, self.chassis1])
+        self.add_mock(models.FlavorProvider,
+                      return_value=[self.flavorprovider1])
+
+        chassis = self.scheduler.reserve_chassis(self.instance1, retry=False)
+
+        self.assertEqual(chassis.id, self.chassis1.id)
+        self.assertEqual(delete_mock.call_count, 1)
+
     def test_reserve_chassis_already_reserved(self):
         self.chassis1.state = models.ChassisState.ACTIVE
         chassis_mock = self.add_mock(models.Chassis,
@@ -98,6 +176,25 @@ class TestInstanceScheduler(tests.TeethMockTestUtilities):
             'filter',
             chassis_model_id=self.flavorprovider1.chassis_model_id)
 
+    def test_reserve_chassis_locked(self):
+        self.add_mock(models.Chassis, return_value=[self.chassis1])
+        self.add_mock(models.FlavorProvider,
+                      return_value=[self.flavorprovider1])
+        self.scheduler.lock_manager = mock.Mock(spec=locks.LockManager)
+        self.scheduler.lock_manager.acquire.side_effect = (
+            locks.LockNotAcquired('/chassis/chassis1'))
+
+        self.assertRaises(errors.ChassisAlreadyReservedError,
+                          self.scheduler.reserve_chassis,
+                          self.instance1,
+                          retry=False)
+        self.scheduler.lock_manager.acquire.assert_called_once_with(
+            '/chassis/chassis1',
+            timeout=scheduler.CHASSIS_LOCK_TIMEOUT)
+        self.assertEqual(self.chassis1.state, models.ChassisState.READY)
+        instance_batch_mock = self.get_mock(models.Instance, 'batch')
+        self.assertEqual(instance_batch_mock().save.call_count, 0)
+
     def test_reserve_chassis_no_capacity(self):
         flavor_provider_mock = self.add_mock(models.FlavorProvider,
                                              return_value=[])
@@ -14,6 +14,11 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import mock
+import StringIO
+import threading
+
+import statsd
 import structlog
 import unittest
 
@@ -42,3 +47,144 @@ class EventLogger(unittest.TestCase):
         structlog.configure(processors=processors)
         log = structlog.wrap_logger(structlog.ReturnLogger())
         self.assertRaises(KeyError, log.msg, "hello {word}")
+
+    def test_format_event_cached(self):
+        teeth_overlord.service._format_cache.clear()
+        processors = [teeth_overlord.service._format_event,
+                      _return_event_processor]
+        structlog.configure(processors=processors)
+        log = structlog.wrap_logger(structlog.ReturnLogger())
+        self.assertEqual(log.msg("hello {word}", word='world'), "hello world")
+        self.assertEqual(log.msg("hello {word}", word='you'), "hello you")
+        self.assertEqual(teeth_overlord.service._format_cache,
+                         {"hello {word}": [("hello ", "word")]})
+
+    def test_format_event_nothing_to_format(self):
+        processors = [teeth_overlord.service._format_event,
+                      _return_event_processor]
+        structlog.configure(processors=processors)
+        log = structlog.wrap_logger(structlog.ReturnLogger())
+        self.assertEqual(log.msg("hello world"), "hello world")
+        self.assertEqual(log.msg("hello {{world}}"), "hello {world}")
+
+    def test_format_event_complex(self):
+        processors = [teeth_overlord.service._format_event,
+                      _return_event_processor]
+        structlog.configure(processors=processors)
+        log = structlog.wrap_logger(structlog.ReturnLogger())
+        self.assertEqual(log.msg("took {secs:.1f}s", secs=1.25), "took 1.2s")
+        self.assertRaises(KeyError, log.msg, "took {secs:.1f}s")
+
+
+class LevelFilterTestCase(unittest.TestCase):
+    def setUp(self):
+        processors = [teeth_overlord.service._get_level_filter('info'),
+                      _return_event_processor]
+        structlog.configure(processors=processors)
+        self.log = structlog.wrap_logger(structlog.ReturnLogger())
+
+    def test_drops_lower_levels(self):
+        self.assertEqual(self.log.debug("hello"), None)
+
+    def test_keeps_higher_levels(self):
+        self.assertEqual(self.log.info("hello"), "hello")
+        self.assertEqual(self.log.error("hello"), "hello")
+        self.assertEqual(self.log.msg("hello"), "hello")
+
+
+class AsyncLogWriterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.file = StringIO.StringIO()
+
+    def test_writes_rendered_events(self):
+        writer = teeth_overlord.service.AsyncLogWriter(
+            structlog.processors.KeyValueRenderer(sort_keys=True),
+            queue_size=10,
+            file=self.file)
+        log = structlog.wrap_logger(
+            teeth_overlord.service.AsyncLogger(writer),
+            processors=[teeth_overlord.service._defer_rendering])
+
+        log.info('hello', word='world')
+        writer.stop()
+
+        self.assertEqual(self.file.getvalue(), "event='hello' word='world'\n")
+
+    def test_counts_dropped_events(self):
+        rendering = threading.Event()
+        release = threading.Event()
+        render = structlog.processors.KeyValueRenderer(sort_keys=True)
+
+        def _blocking_render(logger, method, event):
+            if event['event'] == 'blocking':
+                rendering.set()
+                release.wait()
+            return render(logger, method, event)
+
+        writer = teeth_overlord.service.AsyncLogWriter(_blocking_render,
+                                                       queue_size=1,
+                                                       file=self.file)
+        writer.log('info', {'event': 'blocking'})
+        # the writer thread is now stuck rendering, with the queue empty
+        rendering.wait()
+        writer.log('info', {'event': 'queued'})
+        for i in range(3):
+            writer.log('info', {'event': 'hello'})
+        self.assertEqual(writer.dropped, 3)
+
+        release.set()
+        writer.stop()
+        self.assertEqual(self.file.getvalue(), '\n'.join([
+            "event='blocking'",
+            "event='queued'",
+            "dropped=3 event='log queue full, dropped events'",
+            '']))
+
+
+class LogThrottleTestCase(unittest.TestCase):
+    def setUp(self):
+        self.stats_client = mock.Mock(spec=statsd.StatsClient)
+        self.throttle = teeth_overlord.service.LogThrottle(
+            {'sampled event': 0.5},
+            {'limited event': [1, 2]},
+            self.stats_client)
+        structlog.configure(processors=[
+            self.throttle,
+            teeth_overlord.service._defer_rendering])
+        self.addCleanup(structlog.reset_defaults)
+        self.log = structlog.wrap_logger(structlog.ReturnLogger())
+
+    def test_other_events_pass(self):
+        self.assertEqual(self.log.info('other event'),
+                         {'event': 'other event'})
+        self.assertEqual(self.stats_client.incr.call_count, 0)
+
+    @mock.patch('random.random')
+    def test_sampling(self, mocked_random):
+        mocked_random.return_value = 0.7
+        self.assertEqual(self.log.info('sampled event'), None)
+        self.stats_client.incr.assert_called_once_with('sampled.sampled_event')
+
+        mocked_random.return_value = 0.2
+        self.assertEqual(self.log.info('sampled event'),
+                         {'event': 'sampled event', 'suppressed': 1})
+        self.assertEqual(self.log.info('sampled event'),
+                         {'event': 'sampled event'})
+
+    @mock.patch('time.time')
+    def test_rate_limiting(self, mocked_time):
+        mocked_time.return_value = 0
+        self.throttle.buckets['limited event'].updated_at = 0
+
+        self.assertEqual(self.log.info('limited event'),
+                         {'event': 'limited event'})
+        self.assertEqual(self.log.info('limited event'),
+                         {'event': 'limited event'})
+        self.assertEqual(self.log.info('limited event'), None)
+        self.assertEqual(self.log.info('limited event'), None)
+        self.stats_client.incr.assert_called_with(
+            'rate_limited.limited_event')
+
+        mocked_time.return_value = 1
+        self.assertEqual(self.log.info('limited event'),
+                         {'event': 'limited event', 'suppressed': 2})
@@ -15,6 +15,7 @@ limitations under the License.
 """
 
 import mock
+import threading
 import unittest
 
 import statsd
@@ -64,6 +65,25 @@ class StatsClientTestCase(unittest.TestCase):
         self.assertRaises(SpecificException, self.some_object.error_func)
         self.mock_stats_client.incr.assert_called_once_with('somestat.error')
 
+    @mock.patch('time.time', mock.Mock(side_effect=[1, 1.25]))
+    def test_success_times_call(self):
+        self.some_object.success_func()
+        self.mock_stats_client.timing.assert_called_once_with('somestat.time',
+                                                              250)
+
+    @mock.patch('time.time', mock.Mock(side_effect=[1, 1.5]))
+    def test_error_times_call(self):
+        self.assertRaises(SpecificException, self.some_object.error_func)
+        self.mock_stats_client.timing.assert_called_once_with('somestat.time',
+                                                              500)
+
+    def test_timed_stat(self):
+        with stats.timed_stat(self.mock_stats_client, 'somestat'):
+            pass
+        self.mock_stats_client.incr.assert_called_once_with('somestat.success')
+        self.mock_stats_client.timing.assert_called_once_with('somestat.time',
+                                                              mock.ANY)
+
 
 class ConcurrencyGaugeTestCase(unittest.TestCase):
     def test_concurrency_guage(self):
@@ -82,3 +102,181 @@ class ConcurrencyGaugeTestCase(unittest.TestCase):
             mock_stats_client.gauge.reset_mock()
 
         mock_stats_client.gauge.assertCalledOnceWith('foo', 0)
+
+
+class NoopStatsClientTestCase(unittest.TestCase):
+    def setUp(self):
+        self.client = stats.NoopStatsClient()
+
+    def test_timer(self):
+        with self.client.timer('foo') as timer:
+            pass
+        self.assertIsNotNone(timer.ms)
+
+        @self.client.timer('foo')
+        def timed():
+            return 'bar'
+        self.assertEqual(timed(), 'bar')
+
+    def test_pipeline(self):
+        with self.client.pipeline() as pipe:
+            pipe.incr('foo')
+            pipe.timing('bar', 10)
+
+        pipe = self.client.pipeline()
+        pipe.gauge('baz', 1)
+        pipe.send()
+
+
+class BufferedStatsClientTestCase(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch('statsd.StatsClient._send')
+        self.send_mock = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.buffer = stats.StatsBuffer('localhost', 8125,
+                                        flush_interval=60,
+                                        max_buffered=3)
+        self.addCleanup(self.buffer.stop)
+        self.client = stats.BufferedStatsClient(self.buffer, prefix='teeth')
+
+    def test_counters_are_aggregated(self):
+        self.client.incr('foo')
+        self.client.incr('foo', 2)
+        self.client.decr('bar')
+        self.assertEqual(self.send_mock.call_count, 0)
+
+        self.buffer.flush()
+        self.send_mock.assert_called_once_with(
+            'teeth.foo:3|c\nteeth.bar:-1|c')
+
+    def test_gauges_keep_latest_value(self):
+        self.client.gauge('foo', 1)
+        self.client.gauge('foo', 2)
+        self.buffer.flush()
+        self.send_mock.assert_called_once_with('teeth.foo:2|g')
+
+    def test_other_metrics_are_batched(self):
+        self.client.timing('foo', 10)
+        self.client.gauge('bar', 1, delta=True)
+        self.client.incr('baz')
+        self.buffer.flush()
+        self.send_mock.assert_called_once_with(
+            'teeth.foo:10|ms\nteeth.bar:+1|g\nteeth.baz:1|c')
+
+    def test_flushes_when_full(self):
+        self.client.incr('foo')
+        self.client.incr('bar')
+        self.assertEqual(self.send_mock.call_count, 0)
+        self.client.incr('baz')
+        self.send_mock.assert_called_once_with(
+            'teeth.foo:1|c\nteeth.bar:1|c\nteeth.baz:1|c')
+
+    def test_flush_nothing_pending(self):
+        self.buffer.flush()
+        self.assertEqual(self.send_mock.call_count, 0)
+
+    def test_pack_respects_max_size(self):
+        lines = ['a' * 6, 'b' * 3, 'c' * 6]
+        self.assertEqual(list(stats._pack(lines, 10)),
+                         ['aaaaaa\nbbb', 'cccccc'])
+
+    def test_get_stats_client_is_buffered(self):
+        _config = config.LazyConfig(config=tests.TEST_CONFIG)
+        client = stats.get_stats_client(_config, prefix='api')._client
+        self.assertIsInstance(client, stats.BufferedStatsClient)
+        self.assertIs(client._buffer,
+                      stats.get_stats_client(_config)._client._buffer)
+
+
+class MetricsRegistryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.registry = stats.MetricsRegistry(buckets=(10, 100))
+
+    def test_counters_merge_threads(self):
+        self.registry.incr('foo')
+        thread = threading.Thread(target=self.registry.incr,
+                                  args=('foo', 2))
+        thread.start()
+        thread.join()
+
+        counters, gauges, histograms = self.registry.snapshot()
+        self.assertEqual(counters, {'foo': 3})
+
+    def test_exited_threads_shards_are_retired(self):
+        self.registry.incr('foo')
+        for i in range(3):
+            thread = threading.Thread(target=self.registry.timing,
+                                      args=('bar', 50))
+            thread.start()
+            thread.join()
+
+        counters, gauges, histograms = self.registry.snapshot()
+        self.assertEqual(counters, {'foo': 1})
+        self.assertEqual(histograms, {'bar': ([0, 3, 3], 150, 3)})
+        # only this thread's shard is still live
+        self.assertEqual(len(self.registry._shards), 1)
+
+        self.registry.incr('foo')
+        counters, gauges, histograms = self.registry.snapshot()
+        self.assertEqual(counters, {'foo': 2})
+
+    def test_gauges(self):
+        self.registry.gauge('foo', 5)
+        self.registry.gauge('foo', 2, delta=True)
+        self.registry.gauge('bar', 1)
+        self.registry.gauge('bar', 3)
+
+        counters, gauges, histograms = self.registry.snapshot()
+        self.assertEqual(gauges, {'foo': 7, 'bar': 3})
+
+    def test_histograms(self):
+        for ms in (1, 10, 50, 1000):
+            self.registry.timing('foo', ms)
+
+        counters, gauges, histograms = self.registry.snapshot()
+        self.assertEqual(histograms, {'foo': ([2, 3, 4], 1061, 4)})
+
+    def test_render(self):
+        self.registry.incr('teeth.api.foo.success')
+        self.registry.gauge('teeth.jobs.concurrent_jobs', 2)
+        self.registry.timing('teeth.api.foo.time', 20)
+
+        self.assertEqual(self.registry.render(), '\n'.join([
+            '# TYPE teeth_api_foo_success counter',
+            'teeth_api_foo_success 1',
+            '# TYPE teeth_jobs_concurrent_jobs gauge',
+            'teeth_jobs_concurrent_jobs 2',
+            '# TYPE teeth_api_foo_time histogram',
+            'teeth_api_foo_time_bucket{le="10"} 0',
+            'teeth_api_foo_time_bucket{le="100"} 1',
+            'teeth_api_foo_time_bucket{le="+Inf"} 1',
+            'teeth_api_foo_time_sum 20',
+            'teeth_api_foo_time_count 1',
+            '',
+        ]))
+
+    def test_stats_client_records(self):
+        client = stats.RecordingStatsClient(stats.NoopStatsClient(),
+                                            self.registry,
+                                            prefix='teeth')
+        client.incr('foo')
+        client.decr('foo', 3)
+        client.gauge('bar', 4)
+        with client.timer('baz'):
+            pass
+
+        counters, gauges, histograms = self.registry.snapshot()
+        self.assertEqual(counters, {'teeth.foo': -2})
+        self.assertEqual(gauges, {'teeth.bar': 4})
+        self.assertEqual(histograms['teeth.baz'][2], 1)
+
+    def test_stats_client_records_sampled_calls(self):
+        client = stats.RecordingStatsClient(stats.NoopStatsClient(),
+                                            self.registry)
+        for i in range(10):
+            client.incr('foo', rate=0.1)
+
+        # statsd scales what it's sent, the registry counts every call
+        counters, gauges, histograms = self.registry.snapshot()
+        self.assertEqual(counters, {'foo': 10})
@@ -0,0 +1,74 @@
+"""
+Copyright 2013 Rackspace, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+import mock
+import unittest
+
+import statsd
+
+from teeth_overlord import tracing
+
+
+class TraceTestCase(unittest.TestCase):
+    def setUp(self):
+        self.stats_client = mock.Mock(spec=statsd.StatsClient)
+
+    @mock.patch('time.time', mock.Mock(return_value=10))
+    def test_serialize(self):
+        trace = tracing.Trace('foo', self.stats_client, started_at=5)
+        data = trace.serialize()
+        self.assertEqual(data, {'trace_id': trace.trace_id,
+                                'started_at': 5,
+                                'submitted_at': 10})
+
+        resumed = tracing.Trace.deserialize('foo', self.stats_client, data)
+        self.assertEqual(resumed.trace_id, trace.trace_id)
+        self.assertEqual(resumed.started_at, 5)
+        self.assertEqual(resumed.submitted_at, 10)
+
+    def test_deserialize_missing(self):
+        trace = tracing.Trace.deserialize('foo', self.stats_client, None)
+        self.assertIsNotNone(trace.trace_id)
+        self.assertIsNone(trace.submitted_at)
+
+        trace.record_queued()
+        self.assertEqual(self.stats_client.timing.call_count, 0)
+
+    @mock.patch('time.time', mock.Mock(return_value=12.5))
+    def test_record_queued(self):
+        trace = tracing.Trace('foo', self.stats_client, submitted_at=10)
+        trace.record_queued()
+        self.stats_client.timing.assert_called_once_with('foo.spans.queued',
+                                                         2500)
+
+    @mock.patch('time.time', mock.Mock(side_effect=[0, 1, 1.5]))
+    def test_span(self):
+        trace = tracing.Trace('foo', self.stats_client)
+        with trace.span('bar'):
+            pass
+        self.stats_client.timing.assert_called_once_with('foo.spans.bar', 500)
+
+    def test_span_error(self):
+        trace = tracing.Trace('foo', self.stats_client)
+
+        def _fail():
+            with trace.span('bar'):
+                raise ValueError()
+
+        self.assertRaises(ValueError, _fail)
+        self.stats_client.timing.assert_called_once_with(
+            'foo.spans.bar.error', mock.ANY)
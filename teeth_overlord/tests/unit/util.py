@@ -65,3 +65,203 @@ class TestIntervalTimer(unittest.TestCase):
         t.wait(event=event)
         self.assertEqual(t.next_interval, 1)
         event.wait.assert_called_once_with(1)
+
+
+class TestTokenBucket(unittest.TestCase):
+    @mock.patch('time.time')
+    def test_consume(self, mocked_time):
+        mocked_time.return_value = 0
+        bucket = util.TokenBucket(2, 3)
+
+        for i in range(3):
+            self.assertTrue(bucket.consume())
+        self.assertFalse(bucket.consume())
+
+        # refills at `rate`, up to `capacity`
+        mocked_time.return_value = 1
+        self.assertTrue(bucket.consume(2))
+        self.assertFalse(bucket.consume())
+
+        mocked_time.return_value = 100
+        self.assertTrue(bucket.consume(3))
+        self.assertFalse(bucket.consume())
+
+
+class TestTTLCache(unittest.TestCase):
+    @mock.patch('time.time')
+    def test_get_or_load(self, mocked_time):
+        mocked_time.return_value = 0
+        cache = util.TTLCache(10, 1, 100)
+        load = mock.Mock(side_effect=['first', 'second'])
+
+        self.assertEqual(cache.get_or_load('key', load), 'first')
+        self.assertEqual(cache.get_or_load('key', load), 'first')
+        self.assertEqual(load.call_count, 1)
+
+        mocked_time.return_value = 10
+        self.assertEqual(cache.get_or_load('key', load), 'second')
+        self.assertEqual(load.call_count, 2)
+
+    @mock.patch('time.time')
+    def test_missing(self, mocked_time):
+        mocked_time.return_value = 0
+        cache = util.TTLCache(10, 1, 100)
+        load = mock.Mock(side_effect=[KeyError('key'), 'found'])
+
+        for i in range(2):
+            self.assertRaises(KeyError,
+                              cache.get_or_load,
+                              'key',
+                              load,
+                              missing=KeyError)
+        self.assertEqual(load.call_count, 1)
+
+        mocked_time.return_value = 1
+        self.assertEqual(cache.get_or_load('key', load), 'found')
+
+    def test_errors_not_cached(self):
+        cache = util.TTLCache(10, 1, 100)
+        load = mock.Mock(side_effect=[ValueError(), 'found'])
+
+        self.assertRaises(ValueError,
+                          cache.get_or_load,
+                          'key',
+                          load,
+                          missing=KeyError)
+        self.assertEqual(cache.get_or_load('key', load), 'found')
+
+    def test_disabled(self):
+        cache = util.TTLCache(0, 0, 100)
+        load = mock.Mock(return_value='value')
+
+        cache.get_or_load('key', load)
+        cache.get_or_load('key', load)
+        self.assertEqual(load.call_count, 2)
+
+    @mock.patch('time.time')
+    def test_max_size(self, mocked_time):
+        mocked_time.return_value = 0
+        cache = util.TTLCache(10, 1, 2)
+        cache.get_or_load('a', lambda: 'a')
+        mocked_time.return_value = 1
+        cache.get_or_load('b', lambda: 'b')
+        cache.get_or_load('c', lambda: 'c')
+
+        # the entry expiring soonest was evicted
+        self.assertEqual(sorted(cache.entries), ['b', 'c'])
+
+    def test_invalidate(self):
+        cache = util.TTLCache(10, 1, 100)
+        load = mock.Mock(return_value='value')
+
+        cache.get_or_load('key', load)
+        cache.invalidate('key')
+        cache.get_or_load('key', load)
+        self.assertEqual(load.call_count, 2)
+
+
+class TestClientPool(unittest.TestCase):
+    def setUp(self):
+        self.create = mock.Mock(side_effect=lambda token: mock.Mock())
+        self.pool = util.ClientPool(self.create, 1,
+                                    expected_errors=KeyError)
+
+    def test_reuse(self):
+        with self.pool.get('token') as first:
+            pass
+        with self.pool.get('token') as second:
+            pass
+
+        self.assertIs(first, second)
+        self.create.assert_called_once_with('token')
+
+    def test_concurrent(self):
+        with self.pool.get('token') as first:
+            with self.pool.get('token') as second:
+                self.assertIsNot(first, second)
+        self.assertEqual(self.create.call_count, 2)
+
+        # only `size` clients are kept
+        self.assertEqual(len(self.pool.idle), 1)
+
+    def test_token_rotated(self):
+        with self.pool.get('token1') as first:
+            pass
+        with self.pool.get('token2') as second:
+            pass
+
+        self.assertIsNot(first, second)
+        self.create.assert_called_with('token2')
+        self.assertEqual(list(self.pool.idle), [('token2', second)])
+
+    def test_error_discards_client(self):
+        try:
+            with self.pool.get('token'):
+                raise ValueError()
+        except ValueError:
+            pass
+
+        self.assertEqual(len(self.pool.idle), 0)
+
+    def test_expected_error_keeps_client(self):
+        try:
+            with self.pool.get('token') as client:
+                raise KeyError()
+        except KeyError:
+            pass
+
+        self.assertEqual(list(self.pool.idle), [('token', client)])
+
+
+class TestMapConcurrently(unittest.TestCase):
+    def _square(self, n):
+        if n < 0:
+            raise ValueError(n)
+        return n * n
+
+    def test_results_in_order(self):
+        self.assertEqual(util.map_concurrently(self._square, range(5), 3),
+                         [(0, None), (1, None), (4, None), (9, None),
+                          (16, None)])
+
+    def test_errors(self):
+        outcomes = util.map_concurrently(self._square, [2, -1, 3], 3)
+
+        self.assertEqual([result for result, error in outcomes],
+                         [4, None, 9])
+        self.assertIsInstance(outcomes[1][1], ValueError)
+
+    def test_single_thread(self):
+        self.assertEqual(util.map_concurrently(self._square, [2, 3], 1),
+                         [(4, None), (9, None)])
+
+    def test_empty(self):
+        self.assertEqual(util.map_concurrently(self._square, [], 4), [])
+
+
+class TestGetPage(unittest.TestCase):
+    def setUp(self):
+        self.items = [mock.Mock(id=i) for i in 'abcde']
+
+    def _ids(self, items):
+        return ''.join(item.id for item in items)
+
+    def test_first_page(self):
+        self.assertEqual(self._ids(util.get_page(self.items, None, 2)), 'ab')
+
+    def test_marker(self):
+        self.assertEqual(self._ids(util.get_page(self.items, 'b', 2)), 'cd')
+        self.assertEqual(self._ids(util.get_page(self.items, 'd', 2)), 'e')
+        self.assertEqual(self._ids(util.get_page(self.items, 'e', 2)), '')
+
+    def test_no_limit(self):
+        self.assertEqual(self._ids(util.get_page(self.items, 'b', None)),
+                         'cde')
+
+    def test_unknown_marker(self):
+        self.assertRaises(ValueError, util.get_page, self.items, 'z', 2)
+
+    def test_get_id(self):
+        items = [{'id': 'a'}, {'id': 'b'}]
+        self.assertEqual(util.get_page(items, 'a', 1, lambda i: i['id']),
+                         [{'id': 'b'}])
@@ -0,0 +1,112 @@
+"""
+Copyright 2013 Rackspace, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+import threading
+import time
+import unittest
+
+import mock
+import statsd
+
+from teeth_overlord import errors
+from teeth_overlord import watch
+
+
+class FakeItem(object):
+    def __init__(self, id, version):
+        self.id = id
+        self.version = version
+
+    def get_version(self):
+        return self.version
+
+
+class ChangeHubTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cls = mock.Mock()
+        self.cls.__name__ = 'FakeModel'
+        self.stats_client = mock.Mock(spec=statsd.StatsClient)
+        self.hub = watch.ChangeHub(self.cls, 0.01, 2, self.stats_client)
+
+    def _wait_in_thread(self, id, version, timeout=5):
+        results = []
+        thread = threading.Thread(
+            target=lambda: results.append(self.hub.wait(id, version, timeout)))
+        thread.start()
+        return thread, results
+
+    def test_wait_changed(self):
+        changed = FakeItem('item', 'v2')
+        self.cls.objects.filter.return_value = [changed]
+
+        self.assertEqual(self.hub.wait('item', 'v1', 5), changed)
+        self.cls.objects.filter.assert_called_with(id__in=['item'])
+        self.stats_client.incr.assert_called_once_with('watch.changed')
+        self.assertEqual(self.hub.waiters, {})
+
+    def test_wait_timed_out(self):
+        self.cls.objects.filter.return_value = [FakeItem('item', 'v1')]
+
+        self.assertIsNone(self.hub.wait('item', 'v1', 0.05))
+        self.stats_client.incr.assert_called_once_with('watch.timed_out')
+        self.assertEqual(self.hub.waiter_count, 0)
+
+    def test_notify(self):
+        # pretend the poller is running, so that it doesn't interfere
+        self.hub.thread = mock.Mock()
+        thread, results = self._wait_in_thread('item', 'v1')
+        other_thread, other_results = self._wait_in_thread('other', 'v1')
+        while self.hub.waiter_count < 2:
+            time.sleep(0.001)
+
+        changed = FakeItem('item', 'v2')
+        self.hub.notify(changed)
+        thread.join()
+
+        self.assertEqual(results, [changed])
+        self.assertTrue(other_thread.is_alive())
+        self.hub.notify(FakeItem('other', 'v3'))
+        other_thread.join()
+
+    def test_notify_unchanged(self):
+        waiter = watch._Waiter('v1')
+        self.hub.waiters['item'].append(waiter)
+
+        self.hub.notify(FakeItem('item', 'v1'))
+
+        self.assertFalse(waiter.changed.is_set())
+
+    def test_too_many_waiters(self):
+        self.hub.waiter_count = 2
+
+        self.assertRaises(errors.TooManyWatchersError,
+                          self.hub.wait,
+                          'item',
+                          'v1',
+                          5)
+        self.stats_client.incr.assert_called_once_with('watch.rejected')
+
+    def test_poll_batches_ids(self):
+        self.cls.objects.filter.return_value = []
+        ids = ['item{}'.format(i) for i in xrange(watch.MAX_IDS_PER_QUERY + 1)]
+
+        self.hub.poll(ids)
+
+        self.assertEqual(self.cls.objects.filter.call_args_list, [
+            mock.call(id__in=ids[:watch.MAX_IDS_PER_QUERY]),
+            mock.call(id__in=ids[watch.MAX_IDS_PER_QUERY:]),
+        ])
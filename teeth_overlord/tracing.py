@@ -0,0 +1,104 @@
+"""
+Copyright 2013 Rackspace, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+import contextlib
+import time
+import uuid
+
+import structlog
+
+
+# The JobRequest parameter a serialized Trace is carried in.
+TRACE_PARAM = 'trace'
+
+
+class Trace(object):
+    """Follows a single request, such as an instance build, across the API,
+    the job queue and the job executing it. Each stage is timed as a span,
+    which is logged along with the trace id and recorded as the
+    `{name}.spans.{span}` timing.
+
+    Traces started in one process are handed to the next with `serialize`
+    and `deserialize`, typically as the `TRACE_PARAM` of a JobRequest. Note
+    that spans measured across processes, such as the time spent queued,
+    are subject to clock skew between hosts.
+    """
+    def __init__(self, name, stats_client, trace_id=None, started_at=None,
+                 submitted_at=None):
+        self.name = name
+        self.stats_client = stats_client
+        self.trace_id = trace_id or str(uuid.uuid4())
+        self.started_at = started_at or time.time()
+        self.submitted_at = submitted_at
+        self.log = structlog.get_logger(trace_id=self.trace_id,
+                                        trace_name=name)
+
+    def serialize(self):
+        """Returns the trace context to hand over to another process. The
+        handover time is recorded, to measure how long it takes until the
+        trace is resumed.
+        """
+        self.submitted_at = time.time()
+        return {
+            'trace_id': self.trace_id,
+            'started_at': self.started_at,
+            'submitted_at': self.submitted_at,
+        }
+
+    @classmethod
+    def deserialize(cls, name, stats_client, data):
+        """Resumes a trace from `serialize`d data, or starts a new trace if
+        there is none (e.g. for jobs submitted before tracing existed).
+        """
+        data = data or {}
+        return cls(name,
+                   stats_client,
+                   trace_id=data.get('trace_id'),
+                   started_at=data.get('started_at'),
+                   submitted_at=data.get('submitted_at'))
+
+    def record(self, span, start, end=None):
+        """Record a span that started at `start` and ended at `end`, or
+        now.
+        """
+        if end is None:
+            end = time.time()
+        duration = int(round((end - start) * 1000))
+        self.stats_client.timing('{}.spans.{}'.format(self.name, span),
+                                 duration)
+        self.log.info('trace span finished', span=span, duration_ms=duration)
+
+    def record_queued(self):
+        """Record how long it took to resume the trace since it was
+        serialized, if it was.
+        """
+        if self.submitted_at is not None:
+            self.record('queued', self.submitted_at)
+
+    @contextlib.contextmanager
+    def span(self, span):
+        """Context manager timing its block as a span. Spans which raise are
+        recorded as `{span}.error`.
+        """
+        start = time.time()
+        try:
+            yield
+        except Exception:
+            self.record('{}.error'.format(span), start)
+            raise
+        else:
+            self.record(span, start)
@@ -14,7 +14,12 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import collections
+import contextlib
+from multiprocessing import pool
+import operator
 import random
+import threading
 import time
 
 
@@ -44,3 +49,172 @@ class IntervalTimer(object):
             return event.wait(self.next_interval)
         else:
             return time.sleep(self.next_interval)
+
+
+class TokenBucket(object):
+    """Allows `rate` events per second on average, in bursts of up to
+    `capacity` events.
+    """
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = self.capacity
+        self.updated_at = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self, tokens=1):
+        """Take `tokens` from the bucket. Returns False, taking nothing, if
+        there aren't enough.
+        """
+        with self.lock:
+            now = time.time()
+            refill = (now - self.updated_at) * self.rate
+            self.tokens = min(self.capacity, self.tokens + refill)
+            self.updated_at = now
+            if self.tokens < tokens:
+                return False
+            self.tokens -= tokens
+            return True
+
+
+class TTLCache(object):
+    """A thread-safe cache of up to `max_size` values, each of which expires
+    `ttl` seconds after it was loaded. A `ttl` of 0 disables caching.
+    """
+    def __init__(self, ttl, negative_ttl, max_size):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get_or_load(self, key, load, missing=()):
+        """Returns the value cached for `key`, or calls `load()` and caches
+        what it returns. If `load` raises one of the exception types in
+        `missing`, the exception is cached for `negative_ttl` seconds and
+        raised again by lookups of `key` until then.
+        """
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] > time.time():
+            expires_at, value, error = entry
+            if error is not None:
+                raise error
+            return value
+
+        try:
+            value = load()
+        except missing as e:
+            self._store(key, None, e, self.negative_ttl)
+            raise
+
+        self._store(key, value, None, self.ttl)
+        return value
+
+    def invalidate(self, key):
+        """Forget any value cached for `key`."""
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def _store(self, key, value, error, ttl):
+        if ttl <= 0:
+            return
+
+        now = time.time()
+        with self.lock:
+            if key not in self.entries and len(self.entries) >= self.max_size:
+                self._evict(now)
+            self.entries[key] = (now + ttl, value, error)
+
+    def _evict(self, now):
+        expired = [key for key, entry in self.entries.iteritems()
+                   if entry[0] <= now]
+        for key in expired:
+            del self.entries[key]
+
+        if len(self.entries) >= self.max_size:
+            self.entries.pop(min(self.entries,
+                                 key=lambda key: self.entries[key][0]))
+
+
+class ClientPool(object):
+    """Keeps up to `size` idle API clients for reuse, since clients aren't
+    generally safe to share between threads. Clients are created by
+    `create(token)` and only reused with the same token, so they are
+    rebuilt when the token rotates. Clients which raised an error are
+    thrown away rather than going back to the pool, unless it was one of
+    the `expected_errors` types (such as "not found").
+    """
+    def __init__(self, create, size, expected_errors=()):
+        self.create = create
+        self.size = size
+        self.expected_errors = expected_errors
+        self.idle = collections.deque()
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def get(self, token):
+        """Context manager checking out a client for `token`."""
+        client = None
+        with self.lock:
+            while self.idle:
+                idle_token, idle_client = self.idle.pop()
+                if idle_token == token:
+                    client = idle_client
+                    break
+
+        if client is None:
+            client = self.create(token)
+
+        try:
+            yield client
+        except self.expected_errors:
+            self._release(token, client)
+            raise
+        self._release(token, client)
+
+    def _release(self, token, client):
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append((token, client))
+
+
+def map_concurrently(func, items, max_threads):
+    """Call `func` with each of `items`, from up to `max_threads` threads at
+    once. Every call is made even if some fail: returns a `(result, error)`
+    pair for each item, in order, where `error` is the exception the call
+    raised (if any).
+    """
+    items = list(items)
+
+    def _call(item):
+        try:
+            return func(item), None
+        except Exception as e:
+            return None, e
+
+    threads = min(len(items), max_threads)
+    if threads <= 1:
+        return [_call(item) for item in items]
+
+    workers = pool.ThreadPool(threads)
+    try:
+        return workers.map(_call, items)
+    finally:
+        # reap the workers, rather than leaving a pool of threads behind
+        # for every call
+        workers.close()
+        workers.join()
+
+
+def get_page(items, marker, limit, get_id=operator.attrgetter('id')):
+    """Returns up to `limit` of `items`, following the one whose id is
+    `marker`, or from the start if `marker` is None. A `limit` of None means
+    no limit. Raises ValueError if no item has the id `marker`.
+    """
+    start = 0
+    if marker is not None:
+        start = [get_id(item) for item in items].index(marker) + 1
+
+    if limit is None:
+        return items[start:]
+    return items[start:start + limit]
@@ -0,0 +1,121 @@
+"""
+Copyright 2013 Rackspace, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+import collections
+import threading
+import time
+
+import structlog
+
+from teeth_overlord import errors
+
+# Cap on the number of ids in each query polling for changes.
+MAX_IDS_PER_QUERY = 100
+
+
+class _Waiter(object):
+    def __init__(self, version):
+        self.version = version
+        self.changed = threading.Event()
+        self.item = None
+
+
+class ChangeHub(object):
+    """Lets callers block until rows of `cls` change. Rather than each
+    waiter polling Cassandra, a single thread polls every watched row once
+    per `interval` seconds and wakes the waiters of rows whose version (see
+    `Base.get_version`) has moved on.
+
+    Waiters hold a server thread each, so at most `max_waiters` may wait at
+    once.
+    """
+    def __init__(self, cls, interval, max_waiters, stats_client):
+        self.cls = cls
+        self.interval = interval
+        self.max_waiters = max_waiters
+        self.stats_client = stats_client
+        self.waiters = collections.defaultdict(list)
+        self.waiter_count = 0
+        self.lock = threading.Lock()
+        self.thread = None
+        self.log = structlog.get_logger(model=cls.__name__)
+
+    def wait(self, id, version, timeout):
+        """Block until the row with `id` no longer has `version`, and
+        return it. Returns None if it hasn't changed within `timeout`
+        seconds.
+        """
+        waiter = _Waiter(version)
+        with self.lock:
+            if self.waiter_count >= self.max_waiters:
+                self.stats_client.incr('watch.rejected')
+                raise errors.TooManyWatchersError()
+            self.waiters[id].append(waiter)
+            self.waiter_count += 1
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run)
+                self.thread.daemon = True
+                self.thread.start()
+
+        try:
+            waiter.changed.wait(timeout)
+        finally:
+            with self.lock:
+                self.waiters[id].remove(waiter)
+                if not self.waiters[id]:
+                    del self.waiters[id]
+                self.waiter_count -= 1
+
+        if waiter.item is None:
+            self.stats_client.incr('watch.timed_out')
+        else:
+            self.stats_client.incr('watch.changed')
+        return waiter.item
+
+    def notify(self, item):
+        """Wake anyone waiting for `item` to change from a version other
+        than its current one.
+        """
+        version = item.get_version()
+        with self.lock:
+            for waiter in self.waiters.get(item.id, []):
+                if waiter.version != version:
+                    waiter.item = item
+                    waiter.changed.set()
+
+    def poll(self, ids):
+        """Fetch the rows with `ids` and notify their waiters."""
+        for start in xrange(0, len(ids), MAX_IDS_PER_QUERY):
+            query = self.cls.objects.filter(
+                id__in=ids[start:start + MAX_IDS_PER_QUERY])
+            for item in query:
+                self.notify(item)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                if not self.waiters:
+                    # a new waiter will start another thread
+                    self.thread = None
+                    return
+                ids = list(self.waiters)
+
+            try:
+                self.poll(ids)
+            except Exception as e:
+                self.log.error('error polling for changes', exception=e)